@@ -1,23 +1,327 @@
+import collections
 import json
-import sys
+import os
 import pickle
+import sqlite3
+import sys
+
+# A key-value store of json values, kept in db.sqlite in the current directory.
+# Usage: python DB.py SET <id> <json>
+#        python DB.py GET <id>        (prints the json, or null if there is no such id)
+#        python DB.py MSET            (sets the values of a json object { <id>: <value> } read from stdin)
+#        python DB.py MGET            (reads a json array of ids from stdin, prints { <id>: <value or null> })
+#        python DB.py PREFIX <prefix> [<limit> [<after>]]
+#        python DB.py RANGE <start> <end> [<limit> [<after>]]
+#                                     (print a page of the ids and values from <start> up to <end>, excluded, or of
+#                                     the ids that start with <prefix>, see scan. An empty <start> or <end> is open.)
+#        python DB.py SERVE           (keeps running, serving requests from stdin, see serve)
+#
+# The values are rows of an SQLite table indexed by id, so reading or writing one doesn't read or write the others,
+# and SQLite locks the file, so several processes can read and write at the same time without losing writes.
+# The space of values that are overwritten is reused, and given back to the file system a bit at a time after writes.
+# The first time the database is opened, the values of the old pickled store (db.p) are moved into it.
+
+DB_FILE = 'db.sqlite'
+PICKLE_FILE = 'db.p'
+
+# How long to wait for another process to finish writing, in seconds
+LOCK_TIMEOUT = 30
+
+# Pages given back to the file system after each write, at most
+VACUUM_PAGES = 64
 
-if len(sys.argv) > 2:
-    dat = None
+# Ids looked up with a single query, well under the number of parameters SQLite allows
+QUERY_IDS = 500
 
-    cmd = sys.argv[1]
-    argID = sys.argv[2]
-    argDict = None
+# Values kept in memory by the server
+CACHE_ENTRIES = 10000
 
+# Entries in a page of a scan, by default and at most
+SCAN_LIMIT = 100
+MAX_SCAN_LIMIT = 10000
+
+def open_db(filename=DB_FILE, pickle_file=PICKLE_FILE):
+    # Transactions are started explicitly, see transaction
+    connection = sqlite3.connect(filename, timeout=LOCK_TIMEOUT, isolation_level=None)
+    # Ids and values come back as they went in, byte strings in Python 2
+    connection.text_factory = str
+    # Only takes effect on a new database, before anything is written to it
+    connection.execute('PRAGMA auto_vacuum=INCREMENTAL')
+    # Readers don't wait for writers, nor writers for readers
+    connection.execute('PRAGMA journal_mode=WAL')
+    connection.execute('CREATE TABLE IF NOT EXISTS entries (id TEXT PRIMARY KEY, value TEXT NOT NULL)')
+    migrate_pickle(connection, pickle_file)
+    return connection
+
+# Runs function(connection) in a write transaction: other writers wait until it's done, and if it fails nothing
+# it wrote is kept
+def transaction(connection, function):
+    connection.execute('BEGIN IMMEDIATE')
     try:
-        dat = pickle.load(open('db.p','r'))
+        result = function(connection)
     except:
-        dat = {}
+        connection.execute('ROLLBACK')
+        raise
+    connection.execute('COMMIT')
+    return result
+
+# The values of a pickled store, { <id>: <value> }, or None if it can't be read: the old store wrote the pickle over
+# the one before, so one that was being written when it stopped is empty or cut short, and the old store read it as
+# an empty one.
+def load_pickle(pickle_file):
+    try:
+        with open(pickle_file, 'rb') as handle:
+            dat = pickle.load(handle)
+        return dict(dat)
+    except EnvironmentError:
+        raise
+    except Exception:
+        return None
+
+# Moves the values of a pickled store into the database, and renames it to <pickle_file>.migrated. Values set in the
+# database since are kept. A pickle that can't be read is renamed to <pickle_file>.corrupt instead, and the database
+# starts empty, as the old store did with it.
+# The pickle is renamed inside the transaction, while no other process can write: one that was waiting to migrate it
+# too finds it gone. If the transaction failed after the rename, the values are still in <pickle_file>.migrated.
+def migrate_pickle(connection, pickle_file):
+    if not os.path.exists(pickle_file):
+        return
+
+    def copy_values(connection):
+        # Another process could have migrated it while we waited
+        if not os.path.exists(pickle_file):
+            return
+        dat = load_pickle(pickle_file)
+        if dat is None:
+            os.rename(pickle_file, pickle_file + '.corrupt')
+            sys.stderr.write('%s could not be read, moved it to %s.corrupt\n' % (pickle_file, pickle_file))
+            return
+        connection.executemany('INSERT OR IGNORE INTO entries (id, value) VALUES (?, ?)',
+                               ((key, json.dumps(value)) for key, value in dat.items()))
+        os.rename(pickle_file, pickle_file + '.migrated')
+
+    transaction(connection, copy_values)
+
+# An id as SQLite gives it back (see open_db): a str, which is the bytes of its utf-8 in Python 2. Every id that comes
+# in goes through here, so the rest only deals with ids of that one type. Ids decoded from json are unicode in Python 2.
+def as_id(id):
+    return id if isinstance(id, str) else id.encode('utf-8')
+
+# The last of the characters of the ids as_id gives: bytes in Python 2, code points in Python 3
+MAX_ID_CHARACTER = 0xff if str is bytes else 0x10ffff
+
+# The json of the value of id, or None if there isn't one
+def get_value(connection, id):
+    row = connection.execute('SELECT value FROM entries WHERE id = ?', (id,)).fetchone()
+    return row[0] if row is not None else None
+
+# The json of the values of ids that have one, { <id>: <json> }
+def get_values(connection, ids):
+    ids = [as_id(id) for id in ids]
+    values = {}
+    for start in range(0, len(ids), QUERY_IDS):
+        chunk = ids[start:start + QUERY_IDS]
+        query = 'SELECT id, value FROM entries WHERE id IN (%s)' % ', '.join(['?'] * len(chunk))
+        values.update(connection.execute(query, chunk).fetchall())
+    return values
+
+# Sets the value of id to value_json, a json text, which is stored as json.dumps writes it
+def set_value(connection, id, value_json):
+    set_values(connection, { id: json.loads(value_json) })
+
+# Sets the values of the ids of values, { <id>: <value> }, all of them or none. Returns the json they are stored as.
+def set_values(connection, values):
+    stored = dict((as_id(id), json.dumps(value)) for id, value in values.items())
+    transaction(connection, lambda connection: connection.executemany(
+        'INSERT OR REPLACE INTO entries (id, value) VALUES (?, ?)', stored.items()))
+    compact(connection)
+    return stored
+
+# Gives some of the unused space of the file back to the file system
+def compact(connection):
+    connection.execute('PRAGMA incremental_vacuum(%d)' % VACUUM_PAGES).fetchall()
+
+# The smallest id after all the ids that start with prefix, or None if there isn't one. Ids are sorted by their
+# characters, the same as by the bytes of their utf-8.
+def prefix_end(prefix):
+    prefix = as_id(prefix)
+    while prefix:
+        last = ord(prefix[-1]) + 1
+        if last <= MAX_ID_CHARACTER:
+            # Surrogate code points can't be stored (bytes never get here)
+            if 0xd800 <= last < 0xe000:
+                last = 0xe000
+            return prefix[:-1] + chr(last)
+        prefix = prefix[:-1]
+    return None
+
+# A page of the entries with ids from start up to end (excluded) in order, or of those that start with prefix.
+# Returns the ids, with their json if values is True, [(<id>, <json>)], and the id to pass as after to get the next
+# page, or None if it's the last one.
+# Pages start after the id after (excluded), and have up to limit entries. Only the entries in the page are read, from
+# the index of the ids.
+def scan(connection, start=None, end=None, prefix=None, after=None, limit=SCAN_LIMIT, values=True):
+    if prefix is not None:
+        start, end = prefix, prefix_end(prefix)
+    if not 0 < limit <= MAX_SCAN_LIMIT:
+        raise ValueError('The limit of a scan goes from 1 to ' + str(MAX_SCAN_LIMIT) + ', not ' + str(limit))
+
+    conditions = []
+    parameters = []
+    for condition, bound in (('id >= ?', start), ('id < ?', end), ('id > ?', after)):
+        if bound is not None:
+            conditions.append(condition)
+            parameters.append(as_id(bound))
+    query = 'SELECT ' + ('id, value' if values else 'id') + ' FROM entries'
+    if conditions:
+        query += ' WHERE ' + ' AND '.join(conditions)
+    # One more, to know whether there's a next page
+    rows = connection.execute(query + ' ORDER BY id LIMIT ?', parameters + [limit + 1]).fetchall()
+
+    next_after = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_after = rows[-1][0]
+    if values:
+        return rows, next_after
+    return [row[0] for row in rows], next_after
+
+# The json object of a page of a scan: { "entries": [[<id>, <value>]], "next": <after for the next page or null> },
+# or with "ids": [<id>] instead of "entries" without values
+def scan_json(entries, next_after, values=True):
+    if values:
+        page = '"entries": [' + ', '.join('[' + json.dumps(id) + ', ' + value + ']' for id, value in entries) + ']'
+    else:
+        page = '"ids": ' + json.dumps(entries)
+    return '{' + page + ', "next": ' + json.dumps(next_after) + '}'
+
+# The json object { <id>: <json or null> } for the ids given, from values as get_values returns them
+def values_json(ids, values):
+    return '{' + ', '.join(json.dumps(id) + ': ' + values.get(as_id(id), 'null') for id in ids) + '}'
+
+# Values read by the server, the ones used the longest time ago forgotten first. They are all forgotten whenever
+# another process writes to the database.
+def create_read_cache(max_entries=CACHE_ENTRIES):
+    return { 'values': collections.OrderedDict(), 'version': None, 'max_entries': max_entries }
+
+def cache_values(cache, values):
+    for id, value in values.items():
+        cache['values'].pop(id, None)
+        cache['values'][id] = value
+    while len(cache['values']) > cache['max_entries']:
+        cache['values'].popitem(last=False)
+
+# Same as get_values, for the ids not in the cache
+def cached_get_values(connection, cache, ids):
+    # data_version changes when someone else commits
+    version = connection.execute('PRAGMA data_version').fetchone()[0]
+    if version != cache['version']:
+        cache['values'].clear()
+        cache['version'] = version
+
+    ids = [as_id(id) for id in ids]
+    values = {}
+    missing = []
+    for id in ids:
+        value = cache['values'].get(id)
+        if value is None:
+            missing.append(id)
+        else:
+            values[id] = value
+    found = get_values(connection, missing)
+    values.update(found)
+    cache_values(cache, dict((id, values[id]) for id in ids if id in values))
+    return values
+
+# The json of the result of a request to the server
+def run_request(connection, cache, request):
+    command = request.get('command')
+    if command == 'GET':
+        return cached_get_values(connection, cache, [request['key']]).get(as_id(request['key']), 'null')
+    if command == 'MGET':
+        return values_json(request['keys'], cached_get_values(connection, cache, request['keys']))
+    if command == 'SET':
+        cache_values(cache, set_values(connection, { request['key']: request['value'] }))
+        return 'null'
+    if command == 'MSET':
+        cache_values(cache, set_values(connection, request['values']))
+        return 'null'
+    if command == 'SCAN':
+        values = request.get('values', True)
+        entries, next_after = scan(connection, request.get('start'), request.get('end'), request.get('prefix'),
+                                   request.get('after'), request.get('limit', SCAN_LIMIT), values)
+        return scan_json(entries, next_after, values)
+    raise ValueError('Unknown command ' + str(command))
+
+# Serves requests from input until it's closed, one json object per line, and writes a response to output for each,
+# in the same order:
+#    { "id": <optional request id>, "command": "GET", "key": <id> }            result: <value or null>
+#    { "id": <optional request id>, "command": "MGET", "keys": [<id>, ...] }   result: { <id>: <value or null> }
+#    { "id": <optional request id>, "command": "SET", "key": <id>, "value": <value> }
+#    { "id": <optional request id>, "command": "MSET", "values": { <id>: <value> } }
+#    { "id": <optional request id>, "command": "SCAN", "prefix": <prefix> or "start": <id> and/or "end": <id>,
+#      "after": <optional id>, "limit": <optional>, "values": <optional, false for only the ids> }
+#                                                                              result: a page, see scan_json
+# Responses look like:
+#    { "id": <request id>, "success": true, "result": <result> }
+#    { "id": <request id>, "success": false, "error": <message> }
+# The database stays open, and the values read are kept in memory (see create_read_cache).
+def serve(connection, input, output):
+    cache = create_read_cache()
+    for line in iter(input.readline, ''):
+        if not line.strip():
+            continue
+        request_id = None
+        try:
+            request = json.loads(line)
+            request_id = request.get('id')
+            result = run_request(connection, cache, request)
+            response = '{"id": %s, "success": true, "result": %s}' % (json.dumps(request_id), result)
+        except Exception as e:
+            response = json.dumps({ 'id': request_id, 'success': False, 'error': str(e) })
+        output.write(response + '\n')
+        output.flush()
+
+if __name__ == '__main__':
+    if len(sys.argv) == 2 and sys.argv[1] in ['MGET', 'MSET', 'SERVE']:
+        cmd = sys.argv[1]
+        connection = open_db()
+
+        if cmd == 'MGET':
+            ids = json.load(sys.stdin)
+            print(values_json(ids, get_values(connection, ids)))
+
+        if cmd == 'MSET':
+            set_values(connection, json.load(sys.stdin))
+
+        if cmd == 'SERVE':
+            serve(connection, sys.stdin, sys.stdout)
+
+        connection.close()
+
+    if len(sys.argv) > 2:
+        cmd = sys.argv[1]
+        argID = sys.argv[2]
+
+        connection = open_db()
+
+        if cmd == 'SET' and len(sys.argv) > 3:
+            set_value(connection, argID, sys.argv[3])
+
+        if cmd == 'GET':
+            value = get_value(connection, argID)
+            print(value if value is not None else json.dumps(None))
 
-    if cmd == 'SET' and len(sys.argv) > 3:
-        argDict = sys.argv[3]
-        dat[argID] = json.loads(argDict)
-        pickle.dump(dat, open('db.p','wb'))
+        if cmd in ['PREFIX', 'RANGE']:
+            if cmd == 'PREFIX':
+                bounds = { 'prefix': argID }
+                page = sys.argv[3:]
+            else:
+                end = sys.argv[3] if len(sys.argv) > 3 else ''
+                bounds = { 'start': argID or None, 'end': end or None }
+                page = sys.argv[4:]
+            limit = int(page[0]) if len(page) > 0 else SCAN_LIMIT
+            after = page[1] if len(page) > 1 else None
+            print(scan_json(*scan(connection, after=after, limit=limit, **bounds)))
 
-    if cmd == 'GET':
-        print json.dumps(dat.get(argID,None))
+        connection.close()
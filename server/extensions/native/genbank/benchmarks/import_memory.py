@@ -0,0 +1,48 @@
+import glob
+import os
+import sys
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from genbank_import import ImportedBlock, convert_genbank_record_to_blocks
+from genbank_scanner import scan_genbank_records
+
+# Measures how much memory the blocks of an import take, kept as ImportedBlocks the way the import does, and as
+# their json structure, the way they were kept before.
+# Usage: python benchmarks/import_memory.py [genbank files...]
+# Defaults to test/res/chromosome.gb. Sizes are the sum of sys.getsizeof over everything reachable from the blocks
+# (each object counted once), so they don't depend on the allocator.
+
+default_files = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "..", "..", "..", "test", "res", "chromosome.gb")
+
+def deep_size(obj, seen):
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        size += sum(deep_size(key, seen) + deep_size(value, seen) for key, value in obj.iteritems())
+    elif isinstance(obj, (list, tuple)):
+        size += sum(deep_size(item, seen) for item in obj)
+    elif isinstance(obj, ImportedBlock):
+        size += sum(deep_size(getattr(obj, key), seen) for key in ImportedBlock.__slots__)
+    return size
+
+def measure(filename):
+    with open(filename, "r") as handle:
+        records = list(scan_genbank_records(handle))
+
+    count = compact_size = json_size = 0
+    for record in records:
+        blocks = convert_genbank_record_to_blocks(record)["blocks"]
+        count += len(blocks)
+        # Only the blocks themselves, the dictionary holding them is the same either way
+        compact_size += deep_size(blocks.values(), set())
+        json_size += deep_size([block.to_json() for block in blocks.values()], set())
+    print("%-40s %7d blocks  as json %8.2fMB  compact %8.2fMB  (%.0f%% less)" % (
+        os.path.basename(filename), count, json_size / 1048576.0, compact_size / 1048576.0,
+        100.0 * (json_size - compact_size) / json_size if json_size else 0))
+
+if __name__ == "__main__":
+    filenames = sys.argv[1:] or sorted(glob.glob(default_files))
+    for filename in filenames:
+        measure(filename)
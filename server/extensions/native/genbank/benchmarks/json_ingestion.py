@@ -0,0 +1,46 @@
+import json
+import os
+import sys
+import tempfile
+import time
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from convert import _decode_dict, load_project
+from synthetic import synthetic_project
+
+# Compares how long loading the project json of to_genbank takes the way it used to be loaded
+# (json.load(..., object_hook=_decode_dict)) and with load_project, on projects shaped like test/res/sampleProject.json
+# with growing numbers of blocks (see synthetic_project), all ascii and with some non ascii names.
+# Usage: python benchmarks/json_ingestion.py [number of blocks...]
+# Defaults to 1000, 10000 and 100000 blocks. Exits with an error if both loads give different projects.
+
+default_sizes = [1000, 10000, 100000]
+
+def measure(block_count, non_ascii):
+    handle, filename = tempfile.mkstemp(suffix=".json")
+    try:
+        with os.fdopen(handle, "w") as output:
+            json.dump(synthetic_project(block_count, non_ascii=non_ascii), output, ensure_ascii=False)
+        size = os.path.getsize(filename)
+
+        start = time.time()
+        expected = json.load(open(filename, "r"), object_hook=_decode_dict)
+        old_time = time.time() - start
+
+        start = time.time()
+        loaded = load_project(filename)
+        new_time = time.time() - start
+    finally:
+        os.remove(filename)
+
+    same = loaded == expected
+    print("%7d blocks %-9s %7.2fMB  object_hook %7.3fs  load_project %7.3fs  (%.1fx)  %s" % (
+        block_count, "non ascii" if non_ascii else "ascii", size / 1048576.0, old_time, new_time,
+        old_time / new_time if new_time else 0, "same" if same else "DIFFERENT"))
+    return same
+
+if __name__ == "__main__":
+    sizes = [int(size) for size in sys.argv[1:]] or default_sizes
+    results = [measure(size, non_ascii) for size in sizes for non_ascii in [False, True]]
+    if not all(results):
+        sys.exit(1)
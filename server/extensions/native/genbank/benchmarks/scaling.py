@@ -0,0 +1,200 @@
+import argparse
+import collections
+import json
+import math
+import multiprocessing
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import time
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from convert import load_project
+from genbank_export import count_export_combinations, create_export_context, export_project
+from genbank_import import build_block_hierarchy, create_child_block_from_feature, create_filler_blocks_for_holes, \
+    create_root_block_from_genbank, genbank_to_project, imported_block_to_json, remove_sequence_from_parents
+from genbank_scanner import scan_genbank_records
+from synthetic import synthetic_project, write_synthetic_genbank
+
+# Times the import and the export, and their main phases, on synthetic inputs of growing size (see synthetic.py),
+# and how the time of each grows with the size, to catch anything that stops scaling linearly.
+# Usage: python benchmarks/scaling.py [--sizes 1000,2000,4000,8000] [--what import|export|both] [options]
+# For the import, the size is the number of features of each record; for the export, the number of blocks. Each
+# measurement runs in a process of its own, so the peak memory it reports is only its own, and the inputs are
+# generated in processes of their own too, so the memory they took isn't there to be reused by the measurements.
+# The exponent of each phase is the slope of log(time) against log(size): about 1 is linear, 2 quadratic.
+
+# Kernel counters of the memory of this process, in MB
+def memory_status(field):
+    try:
+        with open("/proc/self/status", "r") as handle:
+            for line in handle:
+                if line.startswith(field + ":"):
+                    return int(line.split()[1]) / 1024.0
+    except IOError:
+        pass
+    return None
+
+# Runs measure(*args) in a process of its own, and returns what it returns along with how much the memory of the
+# process grew at its peak, in MB
+def run_measurement(measure, *args):
+    def run(connection):
+        # The peak so far is the memory of the parent process: start counting from here
+        try:
+            with open("/proc/self/clear_refs", "w") as handle:
+                handle.write("5")
+        except IOError:
+            pass
+        start_memory = memory_status("VmRSS")
+        result = measure(*args)
+        peak = memory_status("VmHWM")
+        if peak is None:
+            # ru_maxrss is in KB on Linux
+            peak, start_memory = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0, 0
+        connection.send((result, peak - start_memory))
+        connection.close()
+
+    parent_connection, child_connection = multiprocessing.Pipe(duplex=False)
+    process = multiprocessing.Process(target=run, args=(child_connection,))
+    process.start()
+    child_connection.close()
+    result = parent_connection.recv()
+    process.join()
+    return result
+
+def timed(phases, name, function, *args):
+    start = time.time()
+    result = function(*args)
+    phases[name] = phases.get(name, 0) + time.time() - start
+    return result
+
+# The phases of the import of a file, the same steps as genbank_to_project and convert_genbank_record_to_blocks
+def import_phases(filename):
+    phases = collections.OrderedDict()
+    with open(filename, "r") as handle:
+        records = timed(phases, "scan", lambda: list(scan_genbank_records(handle)))
+    with open(os.devnull, "w") as output:
+        for record in records:
+            def create_blocks():
+                sequence = { "sequence": str(record.seq), "blocks": {} }
+                root_block = create_root_block_from_genbank(record, sequence)
+                all_blocks = { root_block.id: root_block }
+                strings = {}
+                for feature in sorted(record.features, key=lambda feat: len(feat)):
+                    create_child_block_from_feature(feature, all_blocks, root_block, sequence, strings)
+                return all_blocks, root_block, sequence
+
+            all_blocks, root_block, sequence = timed(phases, "blocks", create_blocks)
+            timed(phases, "hierarchy", build_block_hierarchy, all_blocks, root_block, sequence)
+            timed(phases, "fillers", lambda: (create_filler_blocks_for_holes(all_blocks, sequence),
+                                              remove_sequence_from_parents(all_blocks)))
+            timed(phases, "json", lambda: json.dump({ "blocks": all_blocks, "sequence": sequence }, output,
+                                                    default=imported_block_to_json))
+    return phases
+
+def import_total(filename):
+    phases = collections.OrderedDict()
+    with open(os.devnull, "w") as output:
+        timed(phases, "genbank_to_project", lambda: json.dump(genbank_to_project(filename), output,
+                                                              default=imported_block_to_json))
+    return phases
+
+def write_synthetic_project(filename, *args):
+    with open(filename, "w") as output:
+        json.dump(synthetic_project(*args), output)
+
+def export_phases(filename, output_file):
+    # Whatever the export prints would get in the middle of the report
+    sys.stdout = open(os.devnull, "w")
+    phases = collections.OrderedDict()
+    project = timed(phases, "load", load_project, filename)
+    timed(phases, "context", create_export_context, project["blocks"])
+    timed(phases, "count", count_export_combinations, project["project"], project["blocks"])
+    timed(phases, "export_project", export_project, output_file, project["project"], project["blocks"])
+    return phases
+
+# The slope of the least squares line through the points (log size, log time)
+def scaling_exponent(sizes, times):
+    points = [(math.log(size), math.log(max(duration, 1e-6))) for size, duration in zip(sizes, times)]
+    mean_x = sum(x for x, _ in points) / len(points)
+    mean_y = sum(y for _, y in points) / len(points)
+    spread = sum((x - mean_x) ** 2 for x, _ in points)
+    if spread == 0:
+        return None
+    return sum((x - mean_x) * (y - mean_y) for x, y in points) / spread
+
+def report(title, sizes, results):
+    phases = []
+    for phase_times, _ in results:
+        phases.extend(phase for phase in phase_times if phase not in phases)
+
+    print("")
+    print(title)
+    print("%10s" % "size" + "".join("%20s" % phase for phase in phases) + "%12s" % "peak MB")
+    for size, (phase_times, peak) in zip(sizes, results):
+        print("%10d" % size + "".join("%19.3fs" % phase_times.get(phase, 0) for phase in phases) + "%12.1f" % peak)
+    if len(sizes) > 1:
+        exponents = [scaling_exponent(sizes, [phase_times.get(phase, 0) for phase_times, _ in results]) for phase in phases]
+        print("%10s" % "exponent" + "".join("%20s" % ("-" if exponent is None else "%.2f" % exponent)
+                                            for exponent in exponents))
+    return [{ "size": size, "phases": phase_times, "peak_mb": peak } for size, (phase_times, peak) in zip(sizes, results)]
+
+def benchmark_import(args, directory):
+    sizes = []
+    results = []
+    for size in args.sizes:
+        filename = os.path.join(directory, "synthetic_%d.gb" % size)
+        run_measurement(write_synthetic_genbank, filename, size, args.depth, args.overlap, args.records, args.seed)
+        phase_times, peak = run_measurement(import_phases, filename)
+        total, total_peak = run_measurement(import_total, filename)
+        phase_times.update(total)
+        sizes.append(size)
+        results.append((phase_times, max(peak, total_peak)))
+        os.remove(filename)
+    return report("Import: %d record(s), depth %d, overlap %.2f (size = features per record)" % (
+        args.records, args.depth, args.overlap), sizes, results)
+
+def benchmark_export(args, directory):
+    sizes = []
+    results = []
+    for size in args.sizes:
+        filename = os.path.join(directory, "synthetic_%d.json" % size)
+        run_measurement(write_synthetic_project, filename, size, args.depth, args.list_blocks, args.options, False,
+                        args.seed)
+        phase_times, peak = run_measurement(export_phases, filename, os.path.join(directory, "export_%d" % size))
+        sizes.append(size)
+        results.append((phase_times, peak))
+        os.remove(filename)
+    return report("Export: depth %d, %d list block(s) with %d options (size = blocks)" % (
+        args.depth, args.list_blocks, args.options), sizes, results)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="How the import and the export scale with the size of their input")
+    parser.add_argument("--sizes", type=lambda text: [int(size) for size in text.split(",")],
+                        default=[1000, 2000, 4000, 8000], help="comma separated sizes")
+    parser.add_argument("--what", choices=["import", "export", "both"], default="both")
+    parser.add_argument("--depth", type=int, default=3, help="how deep features and blocks are nested")
+    parser.add_argument("--overlap", type=float, default=0.1,
+                        help="import: fraction of the features that partially overlap the one before them")
+    parser.add_argument("--records", type=int, default=1, help="import: records per file")
+    parser.add_argument("--list-blocks", type=int, default=0, help="export: list blocks in the first construct")
+    parser.add_argument("--options", type=int, default=4, help="export: options of each list block")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", help="also write the results to this file")
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp()
+    try:
+        results = {}
+        if args.what in ["import", "both"]:
+            results["import"] = benchmark_import(args, directory)
+        if args.what in ["export", "both"]:
+            results["export"] = benchmark_export(args, directory)
+    finally:
+        shutil.rmtree(directory)
+
+    if args.json:
+        with open(args.json, "w") as output:
+            json.dump(results, output, indent=2)
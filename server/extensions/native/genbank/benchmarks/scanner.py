@@ -0,0 +1,55 @@
+import glob
+import os
+import sys
+import time
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from Bio import SeqIO
+from genbank_scanner import ScannedFeature, scan_genbank_records
+
+# Checks that the fast scanner in genbank_scanner reads exactly the same records as SeqIO.parse, and compares how long
+# each of them takes.
+# Usage: python benchmarks/scanner.py [genbank files...]
+# Defaults to the genbank files in test/res. Exits with an error if any record is different.
+
+default_files = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "..", "..", "..", "test", "res", "*.gb")
+
+# What the import uses from a record, in a form that can be compared
+def record_summary(record):
+    references = [(ref.authors, ref.comment, ref.consrtm, ref.journal, ref.medline_id, ref.pubmed_id, ref.title)
+                  for ref in record.annotations.get("references", [])]
+    annotations = dict((key, value) for key, value in record.annotations.items() if key != "references")
+    features = [(f.type, int(f.location.start), int(f.location.end), f.location.strand, len(f),
+                 sorted(f.qualifiers.items())) for f in record.features]
+    return (record.id, record.name, record.description, str(record.seq), annotations, references, features)
+
+def read_all(parse, filename):
+    start = time.time()
+    with open(filename, "r") as handle:
+        records = list(parse(handle))
+    return records, time.time() - start
+
+def biopython_parse(handle):
+    return SeqIO.parse(handle, "genbank")
+
+def compare(filename):
+    try:
+        expected, biopython_time = read_all(biopython_parse, filename)
+    except Exception as e:
+        print("%-40s skipped, Biopython can't read it: %s" % (os.path.basename(filename), e))
+        return True
+
+    scanned, scanner_time = read_all(scan_genbank_records, filename)
+    same = [record_summary(r) for r in expected] == [record_summary(r) for r in scanned]
+    # The features the scanner read itself, the others went to Biopython
+    fast = sum(isinstance(f, ScannedFeature) for r in scanned for f in r.features)
+    print("%-40s %4d records %6d features (%6d scanned)  biopython %7.3fs  scanner %7.3fs  %s" % (
+        os.path.basename(filename), len(expected), sum(len(r.features) for r in expected), fast,
+        biopython_time, scanner_time, "same" if same else "DIFFERENT"))
+    return same
+
+if __name__ == "__main__":
+    filenames = sys.argv[1:] or sorted(glob.glob(default_files))
+    results = [compare(filename) for filename in filenames]
+    if not all(results):
+        sys.exit(1)
@@ -0,0 +1,125 @@
+import random
+from Bio import SeqIO
+from Bio.Alphabet import IUPAC
+from Bio.Seq import Seq
+from Bio.SeqFeature import FeatureLocation, SeqFeature
+from Bio.SeqRecord import SeqRecord
+
+# Synthetic inputs for the benchmarks: genbank files to import, and projects to export, of any size and shape.
+# The same arguments always give the same input.
+
+feature_types = ["CDS", "gene", "promoter", "terminator", "misc_feature", "rep_origin", "mRNA", "rbs"]
+roles = ["cds", "promoter", "terminator", "originReplication", "rbs", ""]
+
+# How many features each feature has inside it, for the features of a record to reach nesting depth
+def branching(features, depth):
+    return 1 if depth <= 1 else max(2, int(round(features ** (1.0 / depth))))
+
+# Adds count features between start and end to features, each with up to depth - 1 levels of features inside.
+# With probability overlap, a feature starts inside the one before it instead of after it.
+def add_features(rng, features, start, end, count, depth, overlap):
+    if count <= 0 or end - start < 2:
+        return
+    children = branching(count, depth) if depth > 1 else count
+    children = min(children, count, (end - start) // 2)
+    inside = count - children
+    slot = (end - start) // children
+    for i in xrange(children):
+        feature_start = start + i * slot + slot // 10
+        feature_end = start + (i + 1) * slot - slot // 10
+        if i > 0 and rng.random() < overlap:
+            feature_start -= slot // 3
+        if feature_end - feature_start < 1:
+            continue
+        features.append(SeqFeature(FeatureLocation(feature_start, feature_end, rng.choice([1, -1])),
+                                   type=rng.choice(feature_types),
+                                   qualifiers={ "label": ["feature %d" % len(features)],
+                                                "note": ["synthetic feature at %d" % feature_start] }))
+        share = inside // children + (1 if i < inside % children else 0)
+        add_features(rng, features, feature_start, feature_end, share, depth - 1, overlap)
+
+# A SeqRecord with about the number of features given (plus a source feature covering the whole sequence), nested
+# depth levels deep, a fraction overlap of them partially overlapping the feature before them
+def synthetic_record(name, features=1000, depth=3, overlap=0.1, seed=0):
+    rng = random.Random(seed)
+    length = max(1000, features * 60)
+    sequence = "".join(rng.choice("acgt") for _ in xrange(length))
+    record = SeqRecord(Seq(sequence, IUPAC.unambiguous_dna), id=name, name=name,
+                       description="synthetic record with %d features" % features)
+    record.annotations["data_file_division"] = "SYN"
+    record.annotations["date"] = "01-JAN-2000"
+    record.annotations["organism"] = "synthetic"
+    record.features.append(SeqFeature(FeatureLocation(0, length, 1), type="source",
+                                      qualifiers={ "organism": ["synthetic"] }))
+    add_features(rng, record.features, 0, length, features, depth, overlap)
+    return record
+
+# Writes a genbank file with records records, each made by synthetic_record. Returns the total number of features.
+def write_synthetic_genbank(filename, features=1000, depth=3, overlap=0.1, records=1, seed=0):
+    generated = [synthetic_record("SYN%d" % i, features, depth, overlap, seed + i) for i in xrange(records)]
+    with open(filename, "w") as handle:
+        SeqIO.write(generated, handle, "genbank")
+    return sum(len(record.features) for record in generated)
+
+# A project to export like the ones the server sends, { "project", "blocks" }: constructs of about blocks blocks in
+# total, nested depth levels deep, the leaves with some sequence and an annotation.
+# The first list_blocks leaves of the first construct become list blocks with options options each, so the project
+# exports options ** list_blocks combinations of it.
+# With non_ascii, some of the names have non ascii characters.
+def synthetic_project(blocks=1000, depth=3, list_blocks=0, options=4, non_ascii=False, seed=0):
+    rng = random.Random(seed)
+    all_blocks = []
+    leaves = []
+    constructs = []
+
+    def make_block(block_depth, sequence=None):
+        number = len(all_blocks) + 1
+        block = {
+            "id": "block-%d" % number,
+            "metadata": {
+                "name": ("caf\xc3\xa9 %d" if non_ascii and number % 10 == 0 else "block %d") % number,
+                "description": "",
+                "genbank": { "type": rng.choice(feature_types), "label": "label %d" % number }
+            },
+            "rules": { "role": rng.choice(roles) },
+            "components": [],
+            "options": {},
+            "notes": {},
+            "sequence": { "md5": "", "length": 0, "annotations": [], "features": [], "sequence": "" }
+        }
+        all_blocks.append(block)
+        if sequence is None and block_depth < depth and len(all_blocks) < blocks:
+            for _ in xrange(rng.randint(1, 4)):
+                if len(all_blocks) >= blocks:
+                    break
+                block["components"].append(make_block(block_depth + 1)["id"])
+        if not block["components"]:
+            if sequence is None:
+                sequence = "".join(rng.choice("ACGT") for _ in xrange(rng.randint(20, 200)))
+                leaves.append(block)
+            block["sequence"]["sequence"] = sequence
+            block["sequence"]["length"] = len(sequence)
+            block["sequence"]["annotations"].append({ "name": "site", "role": "", "start": 0, "end": 9, "isForward": 1 })
+        return block
+
+    while len(all_blocks) < blocks:
+        constructs.append(make_block(0)["id"])
+
+    first_leaves = [leaf for leaf in leaves if leaf["id"] in first_construct_ids(all_blocks, constructs[0])]
+    for leaf in first_leaves[:list_blocks]:
+        for _ in xrange(options):
+            option = make_block(depth, leaf["sequence"]["sequence"] + "".join(rng.choice("ACGT") for _ in xrange(rng.randint(0, 30))))
+            leaf["options"][option["id"]] = True
+
+    project = { "id": "project", "components": constructs, "metadata": { "name": "Synthetic", "description": "" } }
+    return { "project": project, "blocks": all_blocks }
+
+def first_construct_ids(all_blocks, construct_id):
+    by_id = dict((block["id"], block) for block in all_blocks)
+    ids = set()
+    pending = [construct_id]
+    while pending:
+        block_id = pending.pop()
+        ids.add(block_id)
+        pending.extend(by_id[block_id]["components"])
+    return ids
@@ -0,0 +1,165 @@
+import errno
+import fcntl
+import hashlib
+import json
+import os
+import shutil
+import sys
+import tempfile
+import Bio
+
+# On-disk cache of conversion results, shared by every process converting on the same machine.
+# Each result is a file in the cache directory named after its key. Reading a result touches its file, and when the
+# files take more than the size of the cache, the ones that were used the longest time ago are removed.
+# The hits, misses and evictions are counted in stats.json, in the cache directory.
+# A result can also be found under other keys (see cache_alias), that are symlinks to it.
+#
+# Results are written to a temporary file and renamed, so a process never sees half a result, and several
+# processes can look up and store results at the same time.
+
+STATS_FILE = "stats.json"
+LOCK_FILE = "stats.lock"
+RESULT_SUFFIX = ".result"
+
+# A cache in directory (created if needed), holding at most max_size bytes of results
+def create_cache(directory, max_size):
+    try:
+        os.makedirs(directory)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+    return { "directory": directory, "max_size": max_size }
+
+# A key for the parts given, which can be anything json can encode. The same parts give the same key, whatever the
+# order of the keys in their dictionaries.
+def cache_key(*parts):
+    return hashlib.sha1(json.dumps(parts, sort_keys=True, separators=(",", ":"))).hexdigest()
+
+# A version of the conversion made of the code of the modules given and the Biopython version, so results cached by
+# a different converter are never used
+def converter_version(*modules):
+    digest = hashlib.sha1(Bio.__version__)
+    for module in modules:
+        source = os.path.splitext(module.__file__)[0] + ".py"
+        with open(source, "rb") as handle:
+            digest.update(handle.read())
+    return digest.hexdigest()
+
+# The key of the contents of a file
+def file_key(filename):
+    digest = hashlib.sha1()
+    with open(filename, "rb") as handle:
+        for chunk in iter(lambda: handle.read(1024 * 1024), ""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def result_path(cache, key):
+    return os.path.join(cache["directory"], key + RESULT_SUFFIX)
+
+# Opens the result cached under key, or returns None if there isn't one. Doesn't count it as a hit or a miss.
+def cache_open(cache, key):
+    path = result_path(cache, key)
+    try:
+        handle = open(path, "rb")
+        # It's been used now
+        os.utime(path, None)
+    except (IOError, OSError) as e:
+        if e.errno != errno.ENOENT:
+            raise
+        return None
+    return handle
+
+# Copies the result cached under key to output_file. Returns whether there was one.
+# count_miss=False when the result will be looked up under another key if it isn't found under this one
+def cache_lookup(cache, key, output_file, count_miss=True):
+    cached = cache_open(cache, key)
+    if cached is None:
+        if count_miss:
+            cache_count(cache, "misses")
+        return False
+    with cached:
+        with open(output_file, "wb") as output:
+            shutil.copyfileobj(cached, output)
+    cache_count(cache, "hits")
+    return True
+
+# Keeps a copy of result_file under key, after prefix, and makes room for it
+def cache_store(cache, key, result_file, prefix=""):
+    if len(prefix) + os.path.getsize(result_file) > cache["max_size"]:
+        return
+    handle, temporary = tempfile.mkstemp(dir=cache["directory"], prefix=".", suffix=".tmp")
+    try:
+        with os.fdopen(handle, "wb") as output:
+            output.write(prefix)
+            with open(result_file, "rb") as result:
+                shutil.copyfileobj(result, output)
+        os.rename(temporary, result_path(cache, key))
+    except:
+        os.remove(temporary)
+        raise
+    evict(cache)
+
+# Makes the result cached under key also found under alias, for as long as it is cached
+def cache_alias(cache, alias, key):
+    if alias == key:
+        return
+    temporary = os.path.join(cache["directory"], "." + alias + "." + str(os.getpid()) + ".tmp")
+    os.symlink(key + RESULT_SUFFIX, temporary)
+    os.rename(temporary, result_path(cache, alias))
+
+# Removes the results used the longest time ago until the rest fit in the cache, and the aliases of the results
+# that are gone
+def evict(cache):
+    results = []
+    for name in os.listdir(cache["directory"]):
+        if name.endswith(RESULT_SUFFIX):
+            path = os.path.join(cache["directory"], name)
+            try:
+                if os.path.islink(path):
+                    if not os.path.exists(path):
+                        os.remove(path)
+                    continue
+                stat = os.stat(path)
+            except OSError:
+                # Removed by someone else in the meantime
+                continue
+            results.append((stat.st_mtime, stat.st_size, name))
+
+    size = sum(result_size for _, result_size, _ in results)
+    evicted = 0
+    for _, result_size, name in sorted(results):
+        if size <= cache["max_size"]:
+            break
+        try:
+            os.remove(os.path.join(cache["directory"], name))
+            evicted += 1
+        except OSError:
+            pass
+        size -= result_size
+    if evicted:
+        cache_count(cache, "evictions", evicted)
+
+# The hits, misses and evictions of the cache so far
+def cache_stats(cache):
+    stats = { "hits": 0, "misses": 0, "evictions": 0 }
+    try:
+        with open(os.path.join(cache["directory"], STATS_FILE), "r") as handle:
+            stats.update(json.load(handle))
+    except (IOError, ValueError):
+        pass
+    return stats
+
+# Adds to one of the counters of the cache ("hits", "misses" or "evictions")
+def cache_count(cache, counter, amount=1):
+    try:
+        with open(os.path.join(cache["directory"], LOCK_FILE), "a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            stats = cache_stats(cache)
+            stats[counter] += amount
+            temporary = os.path.join(cache["directory"], STATS_FILE + "." + str(os.getpid()))
+            with open(temporary, "w") as handle:
+                json.dump(stats, handle)
+            os.rename(temporary, os.path.join(cache["directory"], STATS_FILE))
+    except (IOError, OSError) as e:
+        # The counters are only informative, they shouldn't make a conversion fail
+        sys.stderr.write("Could not update the cache counters: " + str(e) + "\n")
@@ -0,0 +1,117 @@
+import cProfile
+import errno
+import os
+import pstats
+import re
+import signal
+import sys
+import time
+from conversion_stats import peak_rss_mb
+
+# Profiling of conversions (see convert.py --profile-dir), to find out where a slow conversion spends its time and
+# memory on the very file that was slow. Each conversion profiled writes, in the profile directory:
+#    <name>.prof          the cProfile dump, for pstats, snakeviz and the like ("cpu")
+#    <name>.prof.txt      the functions that took the most time, cumulative and on their own ("cpu")
+#    <name>.memory.txt    the peak resident memory of the process at each checkpoint of the conversion (see
+#                         memory_checkpoint), so the step where it grew shows ("memory")
+# where name is the conversion and the job. Conversions that aren't profiled don't go through here at all.
+
+PROFILE_KINDS = ["cpu", "memory"]
+
+# Functions listed in the text report of the cpu profile
+TOP_ENTRIES = 40
+
+# The checkpoints of the conversion whose memory is being profiled, see memory_checkpoint. "checkpoints" is None when
+# memory isn't being profiled.
+memory_profile = { "started": None, "checkpoints": None }
+
+# Parses a comma separated list of kinds of profiling for --profile
+def profile_kinds(text):
+    kinds = [kind.strip() for kind in text.split(",") if kind.strip()]
+    for kind in kinds:
+        if kind not in PROFILE_KINDS:
+            raise ValueError("Unknown kind of profiling " + kind + ", expected some of " + ", ".join(PROFILE_KINDS))
+    return kinds
+
+# The name of the files of a profile: the conversion and the job (any json value the job id is), without anything a
+# file name can't have
+def profile_name(conversion, job):
+    return re.sub(r"[^\w.-]", "_", conversion + "-" + str(job))
+
+# SIGTERM handler while profiling: exits through the finally blocks, so the profiles get written
+def exit_on_signal(signum, frame):
+    sys.exit(1)
+
+# Runs function(*args, **kwargs) profiled as kinds says, and writes the profiles to directory, under name.
+# The profiles are written even if the function fails, or the process gets SIGTERM: slow conversions are often the
+# ones that time out (see conversion_server.stop).
+def run_profiled(directory, name, kinds, function, *args, **kwargs):
+    try:
+        os.makedirs(directory)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+    path = os.path.join(directory, name)
+
+    tracing = "memory" in kinds
+    if tracing:
+        memory_profile.update(started=time.time(), checkpoints=[])
+        memory_checkpoint("start")
+    profiler = cProfile.Profile() if "cpu" in kinds else None
+
+    # The conversion server's jobs already exit this way
+    terminate_handler = signal.getsignal(signal.SIGTERM)
+    if terminate_handler == signal.SIG_DFL:
+        signal.signal(signal.SIGTERM, exit_on_signal)
+    if profiler is not None:
+        profiler.enable()
+    try:
+        return function(*args, **kwargs)
+    finally:
+        if terminate_handler == signal.SIG_DFL:
+            signal.signal(signal.SIGTERM, terminate_handler)
+        if tracing:
+            # Before writing the cpu profile, which takes time and memory of its own
+            memory_checkpoint("end")
+            write_memory_profile(path)
+            memory_profile.update(started=None, checkpoints=None)
+        if profiler is not None:
+            profiler.disable()
+            write_cpu_profile(profiler, path)
+
+def write_cpu_profile(profiler, path):
+    profiler.dump_stats(path + ".prof")
+    with open(path + ".prof.txt", "w") as output:
+        stats = pstats.Stats(profiler, stream=output)
+        stats.strip_dirs()
+        stats.sort_stats("cumulative").print_stats(TOP_ENTRIES)
+        stats.sort_stats("time").print_stats(TOP_ENTRIES)
+
+# Called by the conversions where they hold the most memory (a whole project, say). When memory is being profiled,
+# notes the peak resident memory of the process so far, labelled with label, and the time. Checkpoints one after the
+# other with the same label (one per record, say) are noted once, with how many times it was reached.
+# Does nothing otherwise.
+def memory_checkpoint(label):
+    checkpoints = memory_profile["checkpoints"]
+    if checkpoints is None:
+        return
+    seconds = time.time() - memory_profile["started"]
+    if checkpoints and checkpoints[-1]["label"] == label:
+        checkpoints[-1].update(seconds=seconds, peak=peak_rss_mb(), times=checkpoints[-1]["times"] + 1)
+    else:
+        checkpoints.append({ "label": label, "seconds": seconds, "peak": peak_rss_mb(), "times": 1 })
+
+def write_memory_profile(path):
+    checkpoints = memory_profile["checkpoints"]
+    with open(path + ".memory.txt", "w") as output:
+        output.write("Peak resident memory: %.1f MB, %.1f MB more than when the conversion started\n\n" %
+                     (checkpoints[-1]["peak"], checkpoints[-1]["peak"] - checkpoints[0]["peak"]))
+        output.write("%9s %9s %9s  %s\n" % ("seconds", "peak MB", "grew MB", "checkpoint"))
+        previous = checkpoints[0]["peak"]
+        for checkpoint in checkpoints:
+            label = checkpoint["label"]
+            if checkpoint["times"] > 1:
+                label += " (%d times)" % checkpoint["times"]
+            output.write("%9.3f %9.1f %9.1f  %s\n" % (checkpoint["seconds"], checkpoint["peak"],
+                                                      checkpoint["peak"] - previous, label))
+            previous = checkpoint["peak"]
@@ -0,0 +1,225 @@
+import json
+import multiprocessing
+import os
+import select
+import signal
+import sys
+import time
+import traceback
+
+# Long running conversion server. It keeps the interpreter and the conversion modules loaded, reads jobs from stdin
+# and writes their results to stdout, one json object per line.
+#
+# Jobs look like:
+#    { "id": <job id>, "conversion": "from_genbank" or "to_genbank", "input": <file>, "output": <file>,
+#      "options": <optional keyword arguments for the conversion>, "timeout": <optional, in seconds> }
+# A queued or running job can be cancelled with:
+#    { "cancel": <job id> }
+# Each job gets exactly one result:
+#    { "id": <job id>, "success": true } or { "id": <job id>, "success": false, "error": <message> }
+# A job that isn't valid (see job_error) gets an error result right away and nothing else, even if its id is the one of
+# a job that is queued or running. Lines that aren't json are ignored.
+#
+# Every job runs in its own process forked from the server, and at most max_jobs run at the same time. Forking from
+# the server is cheap because everything is already imported, and lets us kill a job that times out or gets
+# cancelled without affecting the others.
+# Each job is in a process group of its own, with the processes it starts (the workers of --workers). Stopping a job
+# sends SIGTERM to the whole group, which makes the job exit the way it would on an error (so it terminates its
+# workers and writes its profile, see conversion_profile), and whatever is left when it exits, or STOP_GRACE seconds
+# later, is killed. The result of a stopped job is written right away, and the other jobs go on in the meantime.
+
+# Seconds a stopped job has to exit before it and its workers are killed
+STOP_GRACE = 5
+
+# SIGTERM handler of the jobs: exits through the finally blocks of whatever is running
+def exit_on_signal(signum, frame):
+    sys.exit(1)
+
+# Runs in the forked process. Sends None through the connection if the conversion worked, or the error otherwise
+def run_job(convert, job, connection):
+    # The server does it as well, whichever is first (see start)
+    os.setpgid(0, 0)
+    signal.signal(signal.SIGTERM, exit_on_signal)
+    try:
+        convert(job["conversion"], job["input"], job["output"], **job.get("options", {}))
+        connection.send(None)
+    except Exception:
+        connection.send(traceback.format_exc())
+    finally:
+        connection.close()
+
+# Sends a signal to a job and the processes it started, if there are any left
+def signal_job(process, signum):
+    try:
+        os.killpg(process.pid, signum)
+    except OSError:
+        pass
+
+def is_job_id(value):
+    return isinstance(value, (basestring, int, long, float)) and not isinstance(value, bool)
+
+# What's wrong with a job, or None if it can be run. conversions are the ones the server does, None for any.
+def job_error(job, conversions):
+    if not is_job_id(job.get("id")):
+        return "A job needs an id, a string or a number"
+    for field in ["conversion", "input", "output"]:
+        if not isinstance(job.get(field), basestring):
+            return "A job needs a " + field + ", a string"
+    if conversions is not None and job["conversion"] not in conversions:
+        return "Unknown conversion: " + job["conversion"]
+    if not isinstance(job.get("options", {}), dict):
+        return "The options of a job are an object"
+    timeout = job.get("timeout")
+    if timeout is not None and (not isinstance(timeout, (int, long, float)) or isinstance(timeout, bool) or
+                                timeout <= 0):
+        return "The timeout of a job is a number of seconds"
+    return None
+
+def write_result(results, job_id, error=None):
+    result = { "id": job_id, "success": error is None }
+    if error is not None:
+        result["error"] = error
+    results.write(json.dumps(result) + "\n")
+    results.flush()
+
+# Serves conversion jobs until stdin is closed and all the jobs received are done.
+# convert is called as convert(conversion, input, output, **options) in a process of its own, with conversion one of
+# conversions (None for any).
+# default_timeout (seconds) applies to the jobs that don't have their own. None means no timeout.
+def serve(convert, max_jobs=2, default_timeout=None, conversions=None):
+    # stdout is reserved for results. Anything the conversions print goes to stderr instead.
+    results = os.fdopen(os.dup(sys.stdout.fileno()), "w")
+    sys.stdout.flush()
+    os.dup2(sys.stderr.fileno(), sys.stdout.fileno())
+
+    requests_fd = sys.stdin.fileno()
+    reading = True
+    pending_input = ""
+
+    queued = []
+    # job id -> { "job", "process", "connection", "deadline" }
+    running = {}
+    # The jobs stopped that haven't exited yet: [{ "process", "connection", "deadline" }], killed at their deadline
+    stopping = []
+
+    def start(job):
+        parent_connection, child_connection = multiprocessing.Pipe(duplex=False)
+        process = multiprocessing.Process(target=run_job, args=(convert, job, child_connection))
+        process.start()
+        # So a job stopped right away doesn't leave anything behind
+        try:
+            os.setpgid(process.pid, process.pid)
+        except OSError:
+            # It has already done it, or it's gone
+            pass
+        # Only the child writes to the pipe. Closing our copy lets us see EOF if the child dies without a result.
+        child_connection.close()
+
+        timeout = job.get("timeout", default_timeout)
+        running[job["id"]] = {
+            "job": job,
+            "process": process,
+            "connection": parent_connection,
+            "deadline": time.time() + timeout if timeout else None
+        }
+
+    def stop(job_id, error):
+        entry = running.pop(job_id)
+        signal_job(entry["process"], signal.SIGTERM)
+        stopping.append({
+            "process": entry["process"],
+            "connection": entry["connection"],
+            "deadline": time.time() + STOP_GRACE
+        })
+        write_result(results, job_id, error)
+
+    # Kills what's left of a stopped job, once it has exited or its time is up
+    def reap(entry):
+        stopping.remove(entry)
+        signal_job(entry["process"], signal.SIGKILL)
+        entry["process"].join()
+        entry["connection"].close()
+
+    # A stopped job closes its end of the pipe when it exits, after sending its result if it was done already
+    def stopped_job_ready(entry):
+        try:
+            entry["connection"].recv()
+        except EOFError:
+            reap(entry)
+
+    def finish(job_id):
+        entry = running.pop(job_id)
+        try:
+            error = entry["connection"].recv()
+        except EOFError:
+            error = None
+        entry["process"].join()
+        entry["connection"].close()
+        if error is None and entry["process"].exitcode != 0:
+            error = "Conversion process exited with code " + str(entry["process"].exitcode)
+        write_result(results, job_id, error)
+
+    def handle(line):
+        try:
+            request = json.loads(line)
+        except ValueError:
+            request = None
+
+        if not isinstance(request, dict) or ("cancel" in request and not is_job_id(request["cancel"])):
+            sys.stderr.write("Ignoring invalid request: " + line + "\n")
+        elif "cancel" in request:
+            job_id = request["cancel"]
+            if job_id in running:
+                stop(job_id, "Cancelled")
+            for job in [job for job in queued if job["id"] == job_id]:
+                queued.remove(job)
+                write_result(results, job_id, "Cancelled")
+        else:
+            error = job_error(request, conversions)
+            if error is None and (request["id"] in running or any(job["id"] == request["id"] for job in queued)):
+                error = "There is already a job with id " + json.dumps(request["id"])
+            if error is not None:
+                write_result(results, request.get("id"), error)
+            else:
+                queued.append(request)
+
+    while reading or queued or running or stopping:
+        while queued and len(running) < max_jobs:
+            start(queued.pop(0))
+
+        deadlines = [entry["deadline"] for entry in running.values() + stopping if entry["deadline"] is not None]
+        wait = max(0, min(deadlines) - time.time()) if deadlines else None
+
+        watched = [entry["connection"] for entry in running.values() + stopping]
+        if reading:
+            watched.append(requests_fd)
+        ready, _, _ = select.select(watched, [], [], wait)
+
+        for job_id, entry in running.items():
+            if entry["connection"] in ready:
+                finish(job_id)
+        for entry in list(stopping):
+            if entry["connection"] in ready:
+                stopped_job_ready(entry)
+
+        if requests_fd in ready:
+            data = os.read(requests_fd, 65536)
+            if not data:
+                reading = False
+                data = "\n"
+            pending_input += data
+            lines = pending_input.split("\n")
+            pending_input = lines.pop()
+            for line in lines:
+                if line.strip():
+                    handle(line)
+
+        now = time.time()
+        for job_id, entry in running.items():
+            if entry["deadline"] is not None and entry["deadline"] <= now:
+                stop(job_id, "Timed out")
+        for entry in list(stopping):
+            if entry["deadline"] <= now:
+                reap(entry)
+
+    results.close()
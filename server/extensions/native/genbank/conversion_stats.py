@@ -0,0 +1,54 @@
+import json
+import resource
+import sys
+import time
+
+# Stats of a conversion (see convert.py --stats): the wall time spent in each phase, in seconds, and counts of what
+# was converted:
+#    { "phases": { <phase>: <seconds> }, "counts": { <what>: <how many> } }
+# Functions that collect stats take an optional stats dict and do nothing more than look at the clock without one.
+# Records converted in worker processes have stats of their own, added up with add_stats when they come back, so the
+# time of a phase is the time all the processes spent in it.
+
+def create_stats():
+    return { "phases": {}, "counts": {} }
+
+# Adds the time since started to phase, and returns the time now, for the next phase to start from
+def record_phase(stats, phase, started):
+    now = time.time()
+    if stats is not None:
+        stats["phases"][phase] = stats["phases"].get(phase, 0) + now - started
+    return now
+
+def add_count(stats, what, amount):
+    if stats is not None:
+        stats["counts"][what] = stats["counts"].get(what, 0) + amount
+
+def add_stats(total, stats):
+    for phase, seconds in stats["phases"].iteritems():
+        total["phases"][phase] = total["phases"].get(phase, 0) + seconds
+    for what, amount in stats["counts"].iteritems():
+        add_count(total, what, amount)
+
+# Says the conversion ran a pool of that many worker processes, which add_peak_memory reports the memory of
+def add_pool(stats, workers):
+    if stats is not None:
+        stats["pool_workers"] = workers
+
+# The peak resident memory of this process, in MB, and if the conversion ran a pool (see add_pool) the peak of the
+# largest of its workers. Without a pool the processes waited for aren't workers of the conversion (the ones of
+# Python itself or of the jobs of the server before it), so they aren't reported.
+def add_peak_memory(stats):
+    stats["peak_rss_mb"] = peak_rss_mb()
+    if "pool_workers" in stats:
+        stats["pool_peak_rss_mb"] = peak_rss_mb(resource.RUSAGE_CHILDREN)
+
+# The peak resident memory, in MB, of this process or of the largest of the processes it waited for
+def peak_rss_mb(who=resource.RUSAGE_SELF):
+    # ru_maxrss is in KB on Linux, and in bytes on macOS
+    unit = 1024.0 * 1024.0 if sys.platform == "darwin" else 1024.0
+    return resource.getrusage(who).ru_maxrss / unit
+
+def write_stats(stats, filename):
+    with open(filename, "w") as handle:
+        json.dump(stats, handle, indent=2, sort_keys=True)
@@ -1,5 +1,8 @@
 #import requests
+import argparse
+import errno
 import json
+import re
 from io import StringIO
 from Bio import Seq
 from Bio import SeqIO
@@ -7,8 +10,27 @@ from Bio import SeqFeature
 import sys
 import uuid
 import sys
+import functools
+import os
+import time
+import zipfile
+import conversion_cache
+import genbank_export
+import genbank_import
+import genbank_scanner
 from genbank_import import *
 from genbank_export import *
+from conversion_server import serve
+from conversion_cache import create_cache, cache_key, file_key, cache_open, cache_lookup, cache_store, cache_alias, \
+    cache_count, converter_version
+from conversion_stats import add_count, add_peak_memory, create_stats, record_phase, write_stats
+from conversion_profile import memory_checkpoint, profile_kinds, profile_name, run_profiled
+
+# The modules a conversion is done by, besides the ones of the export or import: this one, which puts together what's
+# cached, and conversion_cache, which stores it. Changing any of them changes converter_version, so the results
+# cached before it aren't used.
+def conversion_modules():
+    return [sys.modules[__name__], conversion_cache]
 
 def _decode_list(data):
     rv = []
@@ -36,15 +58,241 @@ def _decode_dict(data):
         rv[key] = value
     return rv
 
-to_genbank = sys.argv[1] == "to_genbank"
-
-if to_genbank:
-    genbank_file = sys.argv[3]
-    project_file = sys.argv[2]
-    project = json.load(open(project_file,"r"), object_hook=_decode_dict)
-    export_project(genbank_file, project['project'], project['blocks'])
-else:
-    genbank_file = sys.argv[2]
-    project_file = sys.argv[3]
-    project = genbank_to_project(genbank_file)
-    json.dump(project, open(project_file,'w'))
+# \u escapes in a json text past 007f (those that are not an escaped backslash followed by a u). The group is the
+# escaped backslashes before the escape.
+non_ascii_escape = re.compile(r"(?<!\\)((?:\\\\)*)\\u(?!00[0-7])[0-9a-fA-F]{4}")
+
+def strip_non_ascii_escape(match):
+    return match.group(1)
+
+ascii_characters = "".join(chr(code) for code in xrange(128))
+
+# Loads the project json for to_genbank.
+# The exporter needs the strings it writes to be ascii. Decoding with object_hook=_decode_dict made sure of that by
+# rebuilding every dict and list of the project (the nested ones several times), which took most of the loading time.
+# Now the json is decoded once, with its strings as they come: ascii unicode strings are written the same as byte
+# strings. Whatever isn't ascii is dropped from the text before decoding it, which is what encoding the strings with
+# encode('ascii', 'ignore') did.
+def load_project(input_file):
+    with open(input_file, "r") as handle:
+        text = handle.read()
+    if text.translate(None, ascii_characters):
+        text = text.decode("utf-8").encode("ascii", "ignore")
+    if "\\u" in text:
+        text = non_ascii_escape.sub(strip_non_ascii_escape, text)
+    return json.loads(text)
+
+# Exports a project, see convert.
+# With a cache, the export is looked up first by the contents of the input file, and then by what it depends on (see
+# export_dependencies), so an export of the same input doesn't even need decoding it.
+# If stats are given, the stats of the export (see conversion_stats) are added to them
+def to_genbank(input_file, output_file, workers=1, start=0, stop=None, dry_run=False, cache=None, stats=None):
+    started = time.time()
+    if cache is not None and not dry_run:
+        version = converter_version(genbank_export, genbank_import, *conversion_modules())
+        input_key = cache_key(version, start, stop, file_key(input_file))
+        hit = cache_lookup(cache, input_key, output_file, count_miss=False)
+        started = record_phase(stats, "cache", started)
+        if hit:
+            count_exported_files(output_file, stats, True)
+            return
+
+    project = load_project(input_file)
+    memory_checkpoint("project loaded")
+    started = record_phase(stats, "load", started)
+    add_count(stats, "blocks", len(project['blocks']))
+    add_count(stats, "constructs", len(project['project']['components']))
+    if dry_run:
+        json.dump(count_export_combinations(project['project'], project['blocks']), open(output_file,'w'))
+        record_phase(stats, "count", started)
+        return
+    elif cache is not None:
+        key = cache_key(version, start, stop, export_dependencies(project['project'], project['blocks']))
+        hit = cache_lookup(cache, key, output_file)
+        started = record_phase(stats, "cache", started)
+        if not hit:
+            export_project(output_file, project['project'], project['blocks'], workers, start, stop, stats)
+            started = record_phase(stats, "export", started)
+            cache_store(cache, key, output_file)
+        cache_alias(cache, input_key, key)
+        record_phase(stats, "cache", started)
+    else:
+        hit = None
+        export_project(output_file, project['project'], project['blocks'], workers, start, stop, stats)
+        record_phase(stats, "export", started)
+    count_exported_files(output_file, stats, hit)
+
+# Adds the number of genbank files an export wrote (a zip of them, or a single one) to stats, and whether it was
+# found in the cache (hit is None without a cache)
+def count_exported_files(output_file, stats, hit):
+    if stats is None:
+        return
+    if zipfile.is_zipfile(output_file):
+        add_count(stats, "files", len(zipfile.ZipFile(output_file).namelist()))
+    else:
+        add_count(stats, "files", 1)
+    if hit is not None:
+        stats["cache"] = "hit" if hit else "miss"
+
+# Imports a genbank file, see convert.
+# With a cache, the output of an import is kept after a line with its import_summary, and an import of the same file
+# with the same options is a copy of it with new ids for the blocks. A cached import that wrote its sequences to files
+# is only used if the files are still there.
+# If stats are given, the stats of the import (see conversion_stats) are added to them. The counts of an import found
+# in the cache are those of the import that was cached, only the time is its own.
+def from_genbank(input_file, output_file, stream=False, workers=1, sequence_dir=None, fast_scan=True, cache=None,
+                 stats=None):
+    started = time.time()
+    if sequence_dir is not None:
+        # The workers write the sequences there
+        try:
+            os.makedirs(sequence_dir)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+    if cache is not None:
+        version = converter_version(genbank_import, genbank_scanner, *conversion_modules())
+        key = cache_key(version, stream, sequence_dir is not None, fast_scan, file_key(input_file))
+        cached = cache_open(cache, key)
+        if cached is not None:
+            with cached:
+                summary = json.loads(cached.readline())
+                if sequence_dir is None or all(os.path.exists(os.path.join(sequence_dir, md5)) for md5 in summary["md5s"]):
+                    with open(output_file, 'w') as output:
+                        copy_with_new_block_ids(cached, output, summary["ids"])
+                    cache_count(cache, "hits")
+                    record_phase(stats, "cache", started)
+                    if stats is not None:
+                        stats["counts"].update(summary.get("counts", {}))
+                        stats["cache"] = "hit"
+                    return
+        cache_count(cache, "misses")
+        started = record_phase(stats, "cache", started)
+        if stats is not None:
+            stats["cache"] = "miss"
+
+    # The cached import keeps the counts, for the stats of the imports that find it. They are only collected when
+    # there are stats to give: without them the summary has no counts, and a cache hit reports none.
+    # The summary itself is only needed by the cache.
+    if stream:
+        summary = { "ids": [], "md5s": [] } if cache is not None else None
+        with open(output_file, 'w') as output:
+            genbank_to_project_stream(input_file, output, workers, sequence_dir, fast_scan, summary, stats)
+    else:
+        project = genbank_to_project(input_file, workers, sequence_dir, fast_scan, stats)
+        memory_checkpoint("project imported")
+        started = time.time()
+        json.dump(project, open(output_file,'w'), default=imported_block_to_json)
+        record_phase(stats, "json", started)
+        if cache is not None:
+            summary = import_summary(project)
+
+    if cache is not None:
+        if stats is not None:
+            summary["counts"] = stats["counts"]
+        cache_store(cache, key, output_file, json.dumps(summary) + "\n")
+
+# Runs a single conversion. workers and the cache apply to both conversions, start, stop and dry_run only to
+# to_genbank and the rest only to from_genbank.
+# With dry_run, to_genbank writes what the export would produce to the output as json (see count_export_combinations)
+# instead of exporting.
+# With a cache_dir, conversions are kept there (see conversion_cache.py), exports and imports each up to cache_size
+# bytes, and converting the same thing again is just a copy.
+# With stats, the stats of the conversion are written next to the output, to output_file + ".stats.json" (see
+# conversion_stats): the time of each phase, the total time, the peak memory and counts of what was converted.
+# With a profile_dir, the conversion is profiled as profile says (see conversion_profile.py), and the profiles are
+# written there named after the conversion and the job (the name of the output file if there isn't one).
+def convert(conversion, input_file, output_file, stream=False, workers=1, sequence_dir=None, fast_scan=True,
+            start=0, stop=None, dry_run=False, cache_dir=None, cache_size=1024 * 1024 * 1024, stats=False,
+            profile_dir=None, profile=("cpu",), job=None):
+    if profile_dir is not None:
+        name = profile_name(conversion, job or os.path.basename(output_file))
+        return run_profiled(profile_dir, name, profile, convert, conversion, input_file, output_file, stream, workers,
+                            sequence_dir, fast_scan, start, stop, dry_run, cache_dir, cache_size, stats)
+
+    started = time.time()
+    conversion_stats = create_stats() if stats else None
+    if conversion == "to_genbank":
+        cache = None
+        if cache_dir is not None:
+            cache = create_cache(os.path.join(cache_dir, "export"), cache_size)
+        to_genbank(input_file, output_file, workers, start, stop, dry_run, cache, conversion_stats)
+    else:
+        cache = None
+        if cache_dir is not None:
+            cache = create_cache(os.path.join(cache_dir, "import"), cache_size)
+        from_genbank(input_file, output_file, stream, workers, sequence_dir, fast_scan, cache, conversion_stats)
+
+    if stats:
+        conversion_stats["conversion"] = conversion
+        conversion_stats["total"] = time.time() - started
+        add_peak_memory(conversion_stats)
+        write_stats(conversion_stats, output_file + ".stats.json")
+
+# Parses START:STOP (either can be left out) for --range
+def combination_range(text):
+    try:
+        start, stop = text.split(":")
+        return int(start or 0), int(stop) if stop else None
+    except ValueError:
+        raise argparse.ArgumentTypeError("expected START:STOP, got " + text)
+
+# Parses the kinds of profiling for --profile
+def profile_argument(text):
+    try:
+        return profile_kinds(text)
+    except ValueError as e:
+        raise argparse.ArgumentTypeError(str(e))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Convert between genbank files and GC projects")
+    parser.add_argument("conversion", choices=["to_genbank", "from_genbank", "server"],
+                        help="server keeps running, taking jobs from stdin (see conversion_server.py)")
+    parser.add_argument("input", nargs="?", help="project json for to_genbank, genbank file for from_genbank")
+    parser.add_argument("output", nargs="?", help="genbank file (or zip) for to_genbank, project json for from_genbank")
+    parser.add_argument("--stream", action="store_true",
+                        help="from_genbank only: write one json object per record (newline delimited) as soon as it's converted")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="number of processes converting records (from_genbank) or combinations of list blocks "
+                             "(to_genbank) in parallel (0 = one per CPU, 1 = serial)")
+    parser.add_argument("--sequence-dir",
+                        help="from_genbank only: write each record's sequence to a file in this directory named after its md5, "
+                             "and leave only the md5 and length in the output")
+    parser.add_argument("--full-parse", action="store_true",
+                        help="from_genbank only: parse every record with Biopython instead of the fast feature scanner")
+    parser.add_argument("--range", type=combination_range, default=(0, None), metavar="START:STOP",
+                        help="to_genbank only: export only the files START to STOP - 1 (from 0) of the full export, "
+                             "named as they are in the full export")
+    parser.add_argument("--dry-run", action="store_true",
+                        help="to_genbank only: write how many files the export would produce (json) instead of exporting")
+    parser.add_argument("--cache-dir",
+                        help="keep the conversions in this directory, and copy them from there when the same thing is "
+                             "converted again")
+    parser.add_argument("--cache-size", type=int, default=1024,
+                        help="size of the export and of the import cache in MB, the conversions used the longest time "
+                             "ago are removed past it")
+    parser.add_argument("--stats", action="store_true",
+                        help="write the time of each phase, the peak memory and counts of what was converted to "
+                             "OUTPUT.stats.json")
+    parser.add_argument("--profile-dir", default=os.environ.get("GENBANK_PROFILE_DIR"),
+                        help="profile the conversions and write their profiles to this directory, named after the "
+                             "conversion and the job (default $GENBANK_PROFILE_DIR, not profiling if it isn't set)")
+    parser.add_argument("--profile", type=profile_argument, default=os.environ.get("GENBANK_PROFILE", "cpu"),
+                        help="comma separated kinds of profiling with --profile-dir: cpu (cProfile) and memory "
+                             "(peak resident memory at checkpoints). Default $GENBANK_PROFILE or cpu")
+    parser.add_argument("--jobs", type=int, default=2, help="server only: number of jobs to run at the same time")
+    parser.add_argument("--timeout", type=float,
+                        help="server only: seconds after which a job is killed, unless the job sets its own timeout")
+    args = parser.parse_args()
+
+    if args.conversion == "server":
+        # The cache and the profiling apply to all the jobs, unless they say otherwise
+        serve(functools.partial(convert, cache_dir=args.cache_dir, cache_size=args.cache_size * 1024 * 1024,
+                                profile_dir=args.profile_dir, profile=args.profile),
+              args.jobs, args.timeout, ["to_genbank", "from_genbank"])
+    else:
+        if args.input is None or args.output is None:
+            parser.error("input and output are required for " + args.conversion)
+        convert(args.conversion, args.input, args.output, args.stream, args.workers, args.sequence_dir,
+                not args.full_parse, args.range[0], args.range[1], args.dry_run, args.cache_dir,
+                args.cache_size * 1024 * 1024, args.stats, args.profile_dir, args.profile)
@@ -14,21 +14,117 @@
  limitations under the License.
  */
 const cp = require('child_process');
+const fs = require('fs');
+const readline = require('readline');
+
+//a long running python process (convert.py server) does the conversions, so we don't pay for starting python and
+//loading Biopython on every job. It reads jobs from stdin and writes results to stdout, one JSON object per line.
+let server = null;
+//job id -> output file
+const pending = {};
+
+//set GENBANK_CACHE_DIR to keep the conversions on disk, so converting the same thing again is just a copy
+const serverArgs = () => {
+  const args = ['convert.py', 'server'];
+  if (process.env.GENBANK_CACHE_DIR) {
+    args.push('--cache-dir', process.env.GENBANK_CACHE_DIR);
+  }
+  return args;
+};
+
+//every job writes its stats (time of each phase, peak memory, counts of what was converted) next to its output, see
+//conversion_stats.py. They go back with the result, for the parent to log. Stats we can't read are just left out.
+const readStats = (output) => {
+  const statsFile = output + '.stats.json';
+  try {
+    const stats = JSON.parse(fs.readFileSync(statsFile, 'utf8'));
+    fs.unlinkSync(statsFile);
+    return stats;
+  } catch (err) {
+    return undefined;
+  }
+};
+
+//the server is gone (it exited, couldn't start, or we can't write to it): whatever was in progress is lost, and the
+//next job starts a new one
+const serverFailed = (child, error) => {
+  if (server === child) {
+    server = null;
+  }
+  Object.keys(pending).forEach(id => {
+    delete pending[id];
+    process.send({ id, success: false, error, result: '' });
+  });
+};
+
+const handleResponse = (line) => {
+  let response;
+  try {
+    response = JSON.parse(line);
+  } catch (err) {
+    console.log('Python server output: ' + line);
+    return;
+  }
+
+  const output = pending[response.id];
+  if (!output) {
+    return;
+  }
+  delete pending[response.id];
+
+  if (!response.success) {
+    console.log('Python server job error: ' + response.id);
+    console.log(response.error);
+    process.send({ id: response.id, success: false, error: response.error, result: '' });
+    return;
+  }
+
+  process.send({ id: response.id, success: true, result: '', stats: readStats(output) });
+};
+
+const startServer = () => {
+  const child = cp.spawn('python', serverArgs());
+
+  readline.createInterface({ input: child.stdout }).on('line', handleResponse);
+
+  child.stderr.on('data', (data) => process.stderr.write(data));
+
+  //python is missing, or couldn't be started
+  child.on('error', (err) => serverFailed(child, `Python server error: ${err.message}`));
+
+  //the server died with jobs still being written to it (EPIPE)
+  child.stdin.on('error', (err) => {
+    serverFailed(child, `Python server error: ${err.message}`);
+    child.kill();
+  });
+
+  //'close' comes after the last of its output has been read, unlike 'exit'
+  child.on('close', (code, signal) => serverFailed(child, `Python server exited (${code === null ? signal : code})`));
+
+  return child;
+};
+
+process.on('exit', () => {
+  if (server) {
+    server.kill();
+  }
+});
 
 process.on('message', (message) => {
   //whether we are importing or exporting
   const conversion = message.type === 'import' ? 'from_genbank' : 'to_genbank';
 
-  const command = `python convert.py ${conversion} ${message.input} ${message.output}`;
+  if (!server) {
+    server = startServer();
+  }
 
-  cp.exec(command, function runPython(err, stdout) {
-    if (err) {
-      console.log('Python childProcess error: ' + command);
-      console.log(err);
-      console.log(err.stack);
-      return process.send({ id: message.id, success: false, error: err, result: stdout });
-    }
-
-    process.send({ id: message.id, success: true, result: stdout });
-  });
+  pending[message.id] = message.output;
+  //the job id names its profiles, when the server profiles (GENBANK_PROFILE_DIR, see conversion_profile.py)
+  server.stdin.write(JSON.stringify({
+    id: message.id,
+    conversion,
+    input: message.input,
+    output: message.output,
+    options: { stats: true, job: message.id },
+  }) + '\n');
 });
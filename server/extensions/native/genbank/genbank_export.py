@@ -1,8 +1,63 @@
 from Bio import Seq
 from Bio import SeqIO
 from Bio import SeqFeature
+from Bio.SeqIO.InsdcIO import GenBankWriter
+from cStringIO import StringIO
 from genbank_import import name_qualifier_table
+from conversion_profile import memory_checkpoint
+from conversion_stats import add_pool
 import json
+import multiprocessing
+import stat
+import time
+import zipfile
+
+# Indexes used while exporting a project, built once by create_export_context:
+#    "blocks": the blocks by id
+#    "parents": for each block id, the ids of the blocks that have it as a component (in the order of allblocks)
+#    "lengths": the length of the sequence of each block, once its children are in (see subtree_length)
+#    "has_options": whether each block has list blocks under it (see has_options)
+#    "sequences": the sequence of the blocks without list blocks under it that have been assembled (see assemble_sequence)
+#    "features": the feature of each block, rendered (see block_feature_template)
+#    "annotation_features": the features of the annotations of each block, rendered (see add_annotation_plan)
+#    "feature_plans": the features of the blocks without list blocks under them, laid out (see add_feature_plan)
+# Only what doesn't depend on the options selected in list blocks is kept, so the context stays valid from one
+# combination of options to the next
+def create_export_context(allblocks):
+    context = { "blocks": {}, "parents": {}, "lengths": {}, "has_options": {}, "sequences": {}, "features": {},
+                "annotation_features": {}, "feature_plans": {} }
+    for block in allblocks:
+        context["blocks"].setdefault(block["id"], block)
+    for block in allblocks:
+        seen = set()
+        for child_id in block["components"]:
+            if child_id not in seen:
+                seen.add(child_id)
+                context["parents"].setdefault(child_id, []).append(block["id"])
+    return context
+
+def get_block(block_id, context):
+    return context["blocks"][block_id]
+
+# The length of the sequence of a block in the exported record: the length of its children put together, or the
+# length of its own sequence if that's nothing. For list blocks, the length of the option selected.
+# Only the lengths of blocks without list blocks under them are kept
+def subtree_length(block, context):
+    if block["id"] in context["lengths"]:
+        return context["lengths"][block["id"]]
+
+    if is_filler(block):
+        length = block["sequence"]["length"]
+    elif "current_option" in block:
+        length = subtree_length(get_block(block["current_option"], context), context)
+    else:
+        length = sum(subtree_length(get_block(child_id, context), context) for child_id in block["components"])
+        if length == 0 and "sequence" in block:
+            length = block["sequence"]["length"]
+
+    if not has_options(block, context):
+        context["lengths"][block["id"]] = length
+    return length
 
 def is_filler(block):
     # It's a filler block when it has no name, it has a sequence, and no color
@@ -20,7 +75,7 @@ def convert_block_name(sf, block):
                 sf.qualifiers[name_qualifier_table[genbank_type][0]] = block["metadata"]["name"]
             # Unfortunately if the name doesn't fit in genbank we have to drop it!
 
-def add_GC_info(sf, block, allblocks):
+def add_GC_info(sf, block, context):
     encoded_data = { "GC": { "name": block["metadata"]["name"], "type": "block", "id": block["id"], "parents": [] } }
 
     # The color
@@ -34,23 +89,12 @@ def add_GC_info(sf, block, allblocks):
     if "genbank" in block["metadata"] and "note" in block["metadata"]["genbank"]:
         encoded_data["note"] = block["metadata"]["genbank"]["note"]
 
-    for potential_parent in allblocks:
-        if block["id"] in potential_parent["components"]:
-            encoded_data["GC"]["parents"].append(potential_parent["id"])
+    encoded_data["GC"]["parents"].extend(context["parents"].get(block["id"], []))
 
     sf.qualifiers["note"] = json.dumps(encoded_data).replace("\"", "'").replace("\n", " ")
 
-def add_features(block, allblocks, gb, start):
-    # Disregard fillers... don't create features for them
-    if is_filler(block):
-        return start + block["sequence"]["length"]
-
-    # For handling list blocks!
-    if "current_option" in block:
-        option = [b for b in allblocks if b["id"] == block["current_option"]][0]
-        return add_features(option, allblocks, gb, start)
-
-    # Add Myself as a feature
+# The feature for a block, without its location. Returns the feature and the strand its location should have
+def create_block_feature(block, context):
     sf = SeqFeature.SeqFeature()
     # Set the type based on the original type or the role type
     if "genbank" in block["metadata"] and "type" in block["metadata"]["genbank"]:
@@ -73,186 +117,421 @@ def add_features(block, allblocks, gb, start):
 
     convert_block_name(sf, block)
 
-    add_GC_info(sf, block, allblocks)
-
-    convert_annotations(block, gb, start)
-
-    # Add my children as features
-    child_start = start
-    for i in range(0, len(block["components"])):
-        block_id = block["components"][i]
-        bl = [b for b in allblocks if b["id"] == block_id][0]
-        child_start = add_features(bl, allblocks, gb, child_start)
-
-    if child_start != start:
-        # The end is where the last child ended...
-        end = child_start
+    add_GC_info(sf, block, context)
+
+    return sf, feature_strand
+
+# The feature for an annotation of a block, without its location. Returns the feature and the strand its location
+# should have
+def create_annotation_feature(annotation, block):
+    gb_annot = SeqFeature.SeqFeature()
+    annotation_type = "misc_feature"
+
+    if "role" in annotation and annotation["role"] != "":
+        annotation_type = annotation["role"]
+
+    for key, value in annotation.iteritems():
+        if key not in ["start", "end", "notes", "strand", "color", "role", "isForward"]:
+            gb_annot.qualifiers[key] = value
+        elif key == "notes" and "genbank" in annotation["notes"]:
+            for gb_key, gb_value in annotation["notes"]["genbank"].iteritems():
+                if gb_key not in ["type", "note"]:
+                    gb_annot.qualifiers[gb_key] = gb_value
+                elif gb_key == "type":
+                    annotation_type = gb_value
+
+    gc_info = { "GC": { "name": annotation["name"], "type": "annotation", "parents": [block["id"]] } }
+    if "color" in annotation:
+        gc_info["GC"]["color"] = annotation["color"]
+    if "notes" in annotation and "genbank" in annotation["notes"] and "note" in annotation["notes"]["genbank"]:
+        gc_info["note"] = annotation["notes"]["genbank"]["note"]
+    gb_annot.qualifiers["note"] = json.dumps(gc_info).replace("\"", "'")
+
+    strand = 1
+    if "isForward" in annotation and annotation["isForward"] == -1:
+        strand = -1
+
+    gb_annot.type = annotation_type
+    return gb_annot, strand
+
+
+# Whether there is a list block anywhere in the hierarchy of a block, itself included. If there isn't, its sequence
+# is the same whatever options are selected.
+def has_options(block, context):
+    if block["id"] not in context["has_options"]:
+        context["has_options"][block["id"]] = (block.get("options") is not None and len(block["options"]) > 0) or \
+            any(has_options(get_block(child_id, context), context) for child_id in block["components"])
+    return context["has_options"][block["id"]]
+
+# Collects the pieces of the sequence of a block, in order, in fragments: the sequences of its leaves, without
+# putting them together. The sequence of a block without list blocks under it doesn't change from one combination of
+# options to the next, so when one is under a list block it's put together once and kept in the context.
+def assemble_sequence(block, context, fragments):
+    if len(block["components"]) > 0:
+        children = [get_block(component, context) for component in block["components"]]
+    elif "sequence" in block and "sequence" in block["sequence"] and block["sequence"]["sequence"]:
+        fragments.append(block["sequence"]["sequence"])
+        return
+    elif "current_option" in block:
+        # For handling list blocks!
+        children = [get_block(block["current_option"], context)]
     else:
-        # No children, look at the block's length
-        if "sequence" in block:
-            end = start + block["sequence"]["length"]
-        else:
-            end = start
-
-    sf.location = SeqFeature.FeatureLocation(start, end, strand=feature_strand)
-    gb.features.append(sf)
-
-    return end
-
-# Parameters: the block to take annotations from,
-# the biopython SeqRecord object to add the annotations to,
-# the start position of the current block
-def convert_annotations(block, gb, start):
-    if "sequence" not in block:
         return
 
-    # Add My annotations as features
-    for annotation in block["sequence"]["annotations"]:
-        gb_annot = SeqFeature.SeqFeature()
-        annotation_type = "misc_feature"
-
-        if "role" in annotation and annotation["role"] != "":
-            annotation_type = annotation["role"]
-
-        for key, value in annotation.iteritems():
-            if key not in ["start", "end", "notes", "strand", "color", "role", "isForward"]:
-                gb_annot.qualifiers[key] = value
-            elif key == "notes" and "genbank" in annotation["notes"]:
-                for gb_key, gb_value in annotation["notes"]["genbank"].iteritems():
-                    if gb_key not in ["type", "note"]:
-                        gb_annot.qualifiers[gb_key] = gb_value
-                    elif gb_key == "type":
-                        annotation_type = gb_value
-
-        gc_info = { "GC": { "name": annotation["name"], "type": "annotation", "parents": [block["id"]] } }
-        if "color" in annotation:
-            gc_info["GC"]["color"] = annotation["color"]
-        if "notes" in annotation and "genbank" in annotation["notes"] and "note" in annotation["notes"]["genbank"]:
-            gc_info["note"] = annotation["notes"]["genbank"]["note"]
-        gb_annot.qualifiers["note"] = json.dumps(gc_info).replace("\"", "'")
-
-        if "start" in annotation:
-            strand = 1
-            if "isForward" in annotation and annotation["isForward"] == -1:
-                strand = -1
-            # Remember: annotations start and end are relative to the block
-            gb_annot.location = SeqFeature.FeatureLocation(annotation["start"] + start, annotation["end"] + start + 1, strand)
-
-        gb_annot.type = annotation_type
-
-        gb.features.append(gb_annot)
-
+    for child in children:
+        if child["id"] in context["sequences"]:
+            fragments.append(context["sequences"][child["id"]])
+        elif has_options(block, context) and not has_options(child, context):
+            child_fragments = []
+            assemble_sequence(child, context, child_fragments)
+            context["sequences"][child["id"]] = "".join(child_fragments)
+            fragments.append(context["sequences"][child["id"]])
+        else:
+            assemble_sequence(child, context, fragments)
 
 # Return the full sequence from a block,
 # building it from the sequence of children
-def build_sequence(block, allblocks):
-    seq = ""
-    if len(block["components"]) > 0:
-        for component in block["components"]:
-            child_block = [b for b in allblocks if b["id"] == component][0]
-            seq = seq + build_sequence(child_block, allblocks)
-    else:
-        # For handling list blocks!
-        if "current_option" in block:
-            option = [b for b in allblocks if b["id"] == block["current_option"]][0]
-            seq = seq + build_sequence(option, allblocks)
-        if "sequence" in block and "sequence" in block["sequence"] and block["sequence"]["sequence"]:
-            seq = block["sequence"]["sequence"]
-    return seq
-
-def get_children_ids(block, allblocks):
+def build_sequence(block, context):
+    fragments = []
+    assemble_sequence(block, context, fragments)
+    return "".join(fragments)
+
+# Writes the ORIGIN section of a record from the fragments of its sequence, the same way Biopython does, without
+# putting the whole sequence together
+def write_origin(handle, fragments):
+    letters_per_line = 60
+    handle.write("ORIGIN\n")
+    position = 0
+    pending = ""
+    for fragment in fragments:
+        pending += fragment.lower()
+        complete = len(pending) - len(pending) % letters_per_line
+        for line_start in xrange(0, complete, letters_per_line):
+            write_origin_line(handle, position + line_start, pending[line_start:line_start + letters_per_line])
+        position += complete
+        pending = pending[complete:]
+    if pending:
+        write_origin_line(handle, position, pending)
+
+def write_origin_line(handle, position, letters):
+    handle.write(str(position + 1).rjust(9))
+    for word_start in xrange(0, len(letters), 10):
+        handle.write(" " + letters[word_start:word_start + 10])
+    handle.write("\n")
+
+# GenBank writer for the records of create_construct_record: their seq is an UnknownSeq of the right length, and the
+# actual sequence is written from their sequence_fragments. Only the header of the records is written with it (see
+# render_construct), so with a Biopython that doesn't call _write_sequence, it just writes an ORIGIN that is dropped.
+class AssembledGenBankWriter(GenBankWriter):
+    def _write_sequence(self, record):
+        write_origin(self.handle, record.sequence_fragments)
+
+def get_children_ids(block, context):
     # Remove filler blocks from the list of children ids! Then add the children ids to the genbank file
     children = list(block["components"])
     for child_id in block["components"]:
-        child_block = [b for b in allblocks if b["id"] == child_id][0]
-        if is_filler(child_block):
+        if is_filler(get_block(child_id, context)):
             children.remove(child_id)
     return children
 
 # Take a project structure and a list of all the current blocks, convert this data to a genbank file and store it
 # in filename. If you pass a construct in, only convert that particular construct.
-def project_to_genbank(filename, project, allblocks, construct_id=None):
+# context is the export context of allblocks (see create_export_context), built here if not given
+# Each record is written as soon as it's rendered (see render_construct), so only one construct is held at a time.
+def project_to_genbank(filename, project, allblocks, construct_id=None, context=None):
+    if context is None:
+        context = create_export_context(allblocks)
+
     if construct_id is not None:
         blocks = [construct_id]
     else:
         blocks = project["components"]
 
-    seq_obj_lst = []
+    with open(filename, "w") as handle:
+        # For each of the construct in the project
+        for block_id in blocks:
+            template = create_construct_template(get_block(block_id, context), context)
+            render_construct(template, context, handle)
+            forget_rendered_features(context)
+
+# Creates the record for a construct, with the fragments of its sequence (see assemble_sequence) and the 'source'
+# feature as its only feature
+def create_construct_record(block, context, fragments):
+    # Grab the original ID that came from genbank before if available, otherwise the GD Name as the name
+    if "genbank" in block["metadata"] and "id" in block["metadata"]["genbank"]:
+        genbank_id = block["metadata"]["genbank"]["id"]
+    elif "genbank" in block["metadata"] and "name" in block["metadata"]["genbank"]:
+        genbank_id = block["metadata"]["genbank"]["name"]
+    else:
+        genbank_id = "GC_DNA"
 
-    # For each of the construct in the project
-    for block_id in blocks:
-        block = [b for b in allblocks if b["id"] == block_id][0]
-        if not block:
-            continue
+    sequence_length = sum(len(fragment) for fragment in fragments)
+    seq_obj = SeqIO.SeqRecord(Seq.UnknownSeq(sequence_length, Seq.Alphabet.DNAAlphabet()), genbank_id)
+    seq_obj.sequence_fragments = fragments
+
+    # Create a 'source' feature
+    sf = SeqFeature.SeqFeature()
+    sf.type = "source"
+    sf.location = SeqFeature.FeatureLocation(0, len(seq_obj.seq))
+
+    add_GC_info(sf, block, context)
+
+    if "genbank" in block["metadata"]:
+        # Set up all the annotations in the genbank record. These came originally from genbank.
+        if "annotations" in block["metadata"]["genbank"]:
+            for annot_key, annot_value in block["metadata"]["genbank"]["annotations"].iteritems():
+                seq_obj.annotations[annot_key] = annot_value
+        # Set up all the references in the genbank record. These came originally from genbank.
+        if "references" in block["metadata"]["genbank"]:
+            for ref in block["metadata"]["genbank"]["references"]:
+                genbank_ref = SeqFeature.Reference()
+                genbank_ref.authors = ref['authors']
+                genbank_ref.comment = ref['comment']
+                genbank_ref.consrtm = ref['consrtm']
+                genbank_ref.journal = ref['journal']
+                genbank_ref.medline_id = ref['medline_id']
+                genbank_ref.pubmed_id = ref['pubmed_id']
+                genbank_ref.title = ref['title']
+                if "references" not in seq_obj.annotations:
+                    seq_obj.annotations["references"] = []
+                seq_obj.annotations["references"].append(genbank_ref)
+        # Add the original annotations to the source feature
+        if "feature_annotations" in block["metadata"]["genbank"]:
+            for annot_key, annot_value in block["metadata"]["genbank"]["feature_annotations"].iteritems():
+                sf.qualifiers[annot_key] = annot_value
+
+    seq_obj.features.append(sf)
 
-        # Grab the original ID that came from genbank before if available, otherwise the GD Name as the name
-        if "genbank" in block["metadata"] and "id" in block["metadata"]["genbank"]:
-            genbank_id = block["metadata"]["genbank"]["id"]
-        elif "genbank" in block["metadata"] and "name" in block["metadata"]["genbank"]:
-            genbank_id = block["metadata"]["genbank"]["name"]
+    if "description" in block["metadata"]:
+        seq_obj.description = block["metadata"]["description"]
+    if "genbank" in block["metadata"] and "name" in block["metadata"]["genbank"]:
+        seq_obj.name = block["metadata"]["genbank"]["name"]
+    elif "name" in block["metadata"]:
+        seq_obj.name = block["metadata"]["name"].replace(" ", "")[:5]
+    else:
+        seq_obj.name = "GC_DNA"
+
+    return seq_obj
+
+# Writing the records.
+# The header of a record is written by Biopython, and the features and the sequence straight from the blocks, without
+# creating a SeqFeature for each of them or putting the whole sequence together.
+# From one combination of options to the next, only the list blocks change, and what comes after them moves. So the
+# features of each block are rendered to text once, all but their location line, and the features of the blocks
+# without list blocks under them are laid out once too (relative to the start of the block). Writing a combination
+# only needs to lay out the features of the blocks with list blocks under them and write the location lines.
+
+# The layout of the features table, as Biopython's GenBankWriter has it
+MAX_WIDTH = 80
+QUALIFIER_INDENT = 21
+# The qualifiers whose values aren't quoted, besides numbers
+UNQUOTED_QUALIFIERS = ["anticodon", "citation", "codon_start", "compare", "direction", "estimated_length", "mod_base",
+                       "number", "rpt_type", "rpt_unit_range", "tag_peptide", "transl_except", "transl_table"]
+
+# Renders a feature, all but its location line. Returns the type of the feature and the text of its qualifiers
+def render_feature_template(sf):
+    handle = StringIO()
+    for key in sorted(sf.qualifiers.keys()):
+        values = sf.qualifiers[key]
+        if isinstance(values, (list, tuple)):
+            for value in values:
+                write_qualifier(handle, key, value)
         else:
-            genbank_id = "GC_DNA"
-
-        sequence = build_sequence(block, allblocks)
-        seq_obj = SeqIO.SeqRecord(Seq.Seq(sequence,Seq.Alphabet.DNAAlphabet()), genbank_id)
-
-        # Create a 'source' feature
-        sf = SeqFeature.SeqFeature()
-        sf.type = "source"
-        sf.location = SeqFeature.FeatureLocation(0, len(seq_obj.seq))
-
-        add_GC_info(sf, block, allblocks)
-
-        if "genbank" in block["metadata"]:
-            # Set up all the annotations in the genbank record. These came originally from genbank.
-            if "annotations" in block["metadata"]["genbank"]:
-                for annot_key, annot_value in block["metadata"]["genbank"]["annotations"].iteritems():
-                    seq_obj.annotations[annot_key] = annot_value
-            # Set up all the references in the genbank record. These came originally from genbank.
-            if "references" in block["metadata"]["genbank"]:
-                for ref in block["metadata"]["genbank"]["references"]:
-                    genbank_ref = SeqFeature.Reference()
-                    genbank_ref.authors = ref['authors']
-                    genbank_ref.comment = ref['comment']
-                    genbank_ref.consrtm = ref['consrtm']
-                    genbank_ref.journal = ref['journal']
-                    genbank_ref.medline_id = ref['medline_id']
-                    genbank_ref.pubmed_id = ref['pubmed_id']
-                    genbank_ref.title = ref['title']
-                    if "references" not in seq_obj.annotations:
-                        seq_obj.annotations["references"] = []
-                    seq_obj.annotations["references"].append(genbank_ref)
-            # Add the original annotations to the source feature
-            if "feature_annotations" in block["metadata"]["genbank"]:
-                for annot_key, annot_value in block["metadata"]["genbank"]["feature_annotations"].iteritems():
-                    sf.qualifiers[annot_key] = annot_value
-
-        seq_obj.features.append(sf)
-
-        if "description" in block["metadata"]:
-            seq_obj.description = block["metadata"]["description"]
-        if "genbank" in block["metadata"] and "name" in block["metadata"]["genbank"]:
-            seq_obj.name = block["metadata"]["genbank"]["name"]
-        elif "name" in block["metadata"]:
-            seq_obj.name = block["metadata"]["name"].replace(" ", "")[:5]
+            write_qualifier(handle, key, values)
+    return sf.type, handle.getvalue()
+
+# Writes a qualifier of a feature, wrapped at spaces where it can be, the same way Biopython does
+def write_qualifier(handle, key, value):
+    indent = " " * QUALIFIER_INDENT
+    if value is None:
+        handle.write("%s/%s\n" % (indent, key))
+        return
+
+    if isinstance(value, (int, long)) or key in UNQUOTED_QUALIFIERS:
+        line = "%s/%s=%s" % (indent, key, value)
+    else:
+        line = '%s/%s="%s"' % (indent, key, value)
+
+    while len(line) > MAX_WIDTH and line.lstrip():
+        # Break at the last space that fits, or at the width if there's none
+        index = line.rfind(" ", QUALIFIER_INDENT + 2, min(len(line) - 1, MAX_WIDTH) + 1)
+        if index == -1:
+            index = MAX_WIDTH
+        handle.write(line[:index] + "\n")
+        line = indent + line[index:].lstrip()
+    if line.lstrip():
+        handle.write(line + "\n")
+
+# The location line of a feature, with the location wrapped at commas if it's too long
+def location_line(feature_type, location):
+    line = ("     " + feature_type.replace(" ", "_")).ljust(QUALIFIER_INDENT)[:QUALIFIER_INDENT]
+    width = MAX_WIDTH - QUALIFIER_INDENT
+    while len(location) > width:
+        index = location.rfind(",", 0, width)
+        if index == -1:
+            break
+        line += location[:index + 1] + "\n" + " " * QUALIFIER_INDENT
+        location = location[index + 1:]
+    return line + location + "\n"
+
+# The feature of a block, rendered: (type, qualifiers text, strand)
+def block_feature_template(block, context):
+    if block["id"] not in context["features"]:
+        sf, feature_strand = create_block_feature(block, context)
+        context["features"][block["id"]] = render_feature_template(sf) + (feature_strand,)
+    return context["features"][block["id"]]
+
+# Adds the features of the annotations of a block that starts at start to plan. Annotations start and end are relative
+# to the block.
+def add_annotation_plan(block, context, start, plan):
+    if block["id"] not in context["annotation_features"]:
+        annotation_features = []
+        if "sequence" in block:
+            for annotation in block["sequence"]["annotations"]:
+                gb_annot, strand = create_annotation_feature(annotation, block)
+                annotation_type, qualifiers = render_feature_template(gb_annot)
+                if "start" in annotation:
+                    annotation_features.append((annotation["start"], annotation["end"] + 1, strand, annotation_type, qualifiers))
+                else:
+                    annotation_features.append((None, None, strand, annotation_type, qualifiers))
+        context["annotation_features"][block["id"]] = annotation_features
+    add_moved_plan(context["annotation_features"][block["id"]], start, plan)
+
+# Adds the features of a plan laid out from 0 to another plan, moved to start
+def add_moved_plan(features, start, plan):
+    for feature_start, feature_end, strand, feature_type, qualifiers in features:
+        if feature_start is None:
+            plan.append((None, None, strand, feature_type, qualifiers))
         else:
-            seq_obj.name = "GC_DNA"
+            plan.append((feature_start + start, feature_end + start, strand, feature_type, qualifiers))
 
-        convert_annotations(block, seq_obj, 0)
+# Lays out the features of a block that starts at start, adding them to plan as (start, end, strand, type, qualifiers
+# text): the features of its annotations, then those of its children, then its own. Returns where the block ends.
+def add_feature_plan(block, context, start, plan):
+    # Disregard fillers... don't create features for them
+    if is_filler(block):
+        return start + block["sequence"]["length"]
 
-        # Add a block for each of the features, recursively
-        start = 0
-        for child_id in block['components']:
-            child_block = [b for b in allblocks if b["id"] == child_id][0]
-            start = add_features(child_block, allblocks, seq_obj, start)
+    # For handling list blocks!
+    if "current_option" in block:
+        return add_feature_plan(get_block(block["current_option"], context), context, start, plan)
 
-        seq_obj_lst.append(seq_obj)
+    if has_options(block, context):
+        return add_block_plan(block, context, start, plan)
 
-    SeqIO.write(seq_obj_lst, open(filename, "w"), "genbank")
+    # Without list blocks under it, the features of the block are always laid out the same way, wherever it starts
+    if block["id"] not in context["feature_plans"]:
+        block_plan = []
+        add_block_plan(block, context, 0, block_plan)
+        context["feature_plans"][block["id"]] = block_plan
+    add_moved_plan(context["feature_plans"][block["id"]], start, plan)
+    return start + subtree_length(block, context)
+
+def add_block_plan(block, context, start, plan):
+    add_annotation_plan(block, context, start, plan)
+
+    child_start = start
+    for child_id in block["components"]:
+        child_start = add_feature_plan(get_block(child_id, context), context, child_start, plan)
+
+    # The end is where the last child ended or, with no children, after the block's own sequence
+    end = start + subtree_length(block, context)
+    feature_type, qualifiers, feature_strand = block_feature_template(block, context)
+    plan.append((start, end, feature_strand, feature_type, qualifiers))
+    return end
+
+# What doesn't change in the record of a construct from one combination of options to the next
+def create_construct_template(construct, context):
+    record = create_construct_record(construct, context, [])
+    writer = AssembledGenBankWriter(None)
+    source_type, source_qualifiers = render_feature_template(record.features.pop())
+    return {
+        "construct": construct,
+        "record": record,
+        "writer": writer,
+        "source": (source_type, source_qualifiers),
+        # The header of the record for each sequence length, everything up to the features
+        "headers": {}
+    }
+
+# Writes the record of a construct to handle, with the options currently selected in its list blocks
+def render_construct(template, context, handle):
+    construct = template["construct"]
+    writer = template["writer"]
+
+    fragments = []
+    assemble_sequence(construct, context, fragments)
+    length = sum(len(fragment) for fragment in fragments)
+
+    if length not in template["headers"]:
+        header = StringIO()
+        writer.handle = header
+        template["record"].seq = Seq.UnknownSeq(length, Seq.Alphabet.DNAAlphabet())
+        writer.write_record(template["record"])
+        header = header.getvalue()
+        # The record has no features and no sequence: drop its empty ORIGIN section
+        template["headers"][length] = header[:header.rindex("ORIGIN\n")]
+
+    source_type, source_qualifiers = template["source"]
+    plan = [(0, length, None, source_type, source_qualifiers)]
+    add_annotation_plan(construct, context, 0, plan)
+    start = 0
+    for child_id in construct["components"]:
+        start = add_feature_plan(get_block(child_id, context), context, start, plan)
+
+    handle.write(template["headers"][length])
+    for feature_start, feature_end, strand, feature_type, qualifiers in plan:
+        handle.write(location_line(feature_type, location_string(feature_start, feature_end, strand, length)))
+        handle.write(qualifiers)
+    write_origin(handle, fragments)
+    handle.write("//\n")
+
+# The location of a feature, the same way Biopython writes a FeatureLocation, without creating one
+def location_string(start, end, strand, record_length):
+    if start is None:
+        raise ValueError("A feature has no location")
+    if strand not in [1, -1, 0, None]:
+        raise ValueError("Strand should be +1, -1, 0 or None, not %r" % strand)
+
+    if start == end:
+        # Between two bases, or at the very end of the sequence
+        if end == record_length:
+            location = "%i^1" % record_length
+        else:
+            location = "%i^%i" % (end, end + 1)
+    elif start + 1 == end:
+        location = "%i" % end
+    else:
+        location = "%i..%i" % (start + 1, end)
+
+    if strand == -1:
+        return "complement(%s)" % location
+    return location
+
+# Adds a file to a zip file, straight from its contents
+def write_zip_entry(zf, name, data):
+    info = zipfile.ZipInfo(name, time.localtime(time.time())[:6])
+    info.compress_type = zf.compression
+    # A regular file, readable by everyone
+    info.external_attr = (stat.S_IFREG | 0644) << 16
+    zf.writestr(info, data)
+
+# Drops the features rendered for the blocks (see block_feature_template and add_feature_plan), once they won't be
+# written again
+def forget_rendered_features(context):
+    context["features"].clear()
+    context["annotation_features"].clear()
+    context["feature_plans"].clear()
+
+# Adds the record of a construct, with the options currently selected in its list blocks, to a zip file
+def add_construct_to_zip(zf, gb_filename, template, context):
+    record = StringIO()
+    render_construct(template, context, record)
+    write_zip_entry(zf, gb_filename, record.getvalue())
 
 
 # Returns a list of blocks that are optional from this block down in the hierarchy
-def get_optional_children(block, allblocks):
+def get_optional_children(block, context):
     result = []
     if block.get("options") is not None and len(block["options"]) > 0:
         # Is there at least one "enabled" option?
@@ -262,8 +541,7 @@ def get_optional_children(block, allblocks):
                 return result
     else:
         for child_id in block["components"]:
-            child = [b for b in allblocks if b["id"] == child_id][0]
-            childs_options = get_optional_children(child, allblocks)
+            childs_options = get_optional_children(get_block(child_id, context), context)
             result.extend(childs_options)
     return result
 
@@ -292,18 +570,178 @@ def build_next_optional_construct(optional_children):
             block["current_option"] = next_viable_option(block["options"])
     return False
 
+# The options of each optional block that build_next_optional_construct goes through, in the same order
+def enabled_options(optional_children):
+    return [[option_id for option_id, option_enabled in block["options"].iteritems() if option_enabled]
+            for block in optional_children]
+
+# Combinations are numbered in the order build_next_optional_construct goes through them: the option of the first
+# optional block changes first. choices are the enabled_options of the optional blocks.
+def select_combination(optional_children, choices, index):
+    for block, block_choices in zip(optional_children, choices):
+        block["current_option"] = block_choices[index % len(block_choices)]
+        index //= len(block_choices)
+
+def count_combinations(choices):
+    count = 1
+    for block_choices in choices:
+        count *= len(block_choices)
+    return count
+
+# The number of the combination selected in the optional blocks, or None if what's selected can't be numbered
+# (the same block is optional in more than one place, or the selected option isn't one of the enabled ones)
+def selected_combination(optional_children, choices):
+    if len(set(block["id"] for block in optional_children)) != len(optional_children):
+        return None
+    index = 0
+    scale = 1
+    for block, block_choices in zip(optional_children, choices):
+        if block.get("current_option") not in block_choices:
+            return None
+        index += block_choices.index(block["current_option"]) * scale
+        scale *= len(block_choices)
+    return index
+
+# Selects the first combination of options of a construct, the way the export starts from it.
+# Returns the optional children, their enabled options, the number of the first combination (None if it can't be
+# numbered, see selected_combination) and how many combinations the export goes through from there, without
+# rendering any of them. A construct with no list blocks has a single combination.
+def start_construct_combinations(construct, context):
+    optional_children = get_optional_children(construct, context)
+    build_first_optional_construct(optional_children)
+    choices = enabled_options(optional_children)
+    first = selected_combination(optional_children, choices)
+    if first is not None:
+        return optional_children, choices, first, count_combinations(choices) - first
+
+    # Count them going through them like the export does, and come back to the first one. When a list block is used
+    # more than once, build_next_optional_construct can go round in circles: it can't go through more combinations
+    # than there are ways to set the options of the distinct blocks.
+    selected = [block["current_option"] for block in optional_children]
+    distinct = dict((block["id"], len(block_choices) + 1) for block, block_choices in zip(optional_children, choices))
+    limit = count_combinations(range(size) for size in distinct.values())
+    count = 1
+    while build_next_optional_construct(optional_children):
+        count += 1
+        if count > limit:
+            raise ValueError("The combinations of list blocks of " + construct["metadata"]["name"] + " never end")
+    for block, option in zip(optional_children, selected):
+        block["current_option"] = option
+    return optional_children, choices, None, count
+
+# Leaves the options of a construct where the export does after going through all its combinations
+def finish_construct_combinations(optional_children, choices, first):
+    if first is not None:
+        select_combination(optional_children, choices, 0)
+    else:
+        while build_next_optional_construct(optional_children):
+            pass
+
+# Counts the files export_project would write, without rendering anything: one per combination of options of each
+# construct when the project has list blocks (a zip), or one record per construct otherwise (a genbank file).
+# Returns { "zip", "total", "constructs": [{ "id", "name", "count" }] }, constructs in the order they're exported.
+# The options of the blocks are left as they were.
+def count_export_combinations(project, allblocks):
+    context = create_export_context(allblocks)
+    option_blocks = [block for block in allblocks if block.get("options") is not None and len(block["options"]) > 0]
+    saved = [(block, "current_option" in block, block.get("current_option")) for block in option_blocks]
+
+    constructs = []
+    try:
+        for construct_id in project["components"]:
+            construct = get_block(construct_id, context)
+            if len(option_blocks) > 0:
+                optional_children, choices, first, count = start_construct_combinations(construct, context)
+                finish_construct_combinations(optional_children, choices, first)
+            else:
+                count = 1
+            constructs.append({ "id": construct_id, "name": construct["metadata"]["name"], "count": count })
+    finally:
+        for block, had_option, option in saved:
+            if had_option:
+                block["current_option"] = option
+            else:
+                block.pop("current_option", None)
+
+    return {
+        "zip": len(option_blocks) > 0,
+        "total": sum(construct["count"] for construct in constructs),
+        "constructs": constructs
+    }
+
+# Splits the combinations [first, first + count) of a construct in tasks for render_combinations, enough of them so
+# the workers stay busy until the end
+def combination_tasks(construct_id, first, count, workers):
+    size = max(1, min(256, count // (workers * 8)))
+    for task_first in xrange(first, first + count, size):
+        yield (construct_id, task_first, min(size, first + count - task_first))
+
+# What the export worker processes use, set up when they start (see init_export_worker)
+export_worker = {}
+
+def init_export_worker(context):
+    export_worker["context"] = context
+    export_worker["templates"] = {}
+
+# Renders combinations of options of a construct in a worker process. Returns the records, in order.
+# task is (construct id, number of the first combination, number of combinations)
+def render_combinations(task):
+    construct_id, first, count = task
+    context = export_worker["context"]
+    construct = get_block(construct_id, context)
+    if construct_id not in export_worker["templates"]:
+        export_worker["templates"][construct_id] = create_construct_template(construct, context)
+    template = export_worker["templates"][construct_id]
+
+    optional_children = get_optional_children(construct, context)
+    choices = enabled_options(optional_children)
+    records = []
+    for index in xrange(first, first + count):
+        select_combination(optional_children, choices, index)
+        record = StringIO()
+        render_construct(template, context, record)
+        records.append(record.getvalue())
+    return records
+
+# Everything the export of a project (or of one of its constructs) depends on, to tell whether two exports give the
+# same file: the project, the blocks in its constructs with all their options, and the parents of each of those
+# blocks, which are written in the features
+def export_dependencies(project, allblocks, construct_id=None):
+    context = create_export_context(allblocks)
+    pending = [construct_id] if construct_id is not None else list(project["components"])
+    seen = set(pending)
+    blocks = []
+    while pending:
+        block = get_block(pending.pop(), context)
+        blocks.append((block, context["parents"].get(block["id"], [])))
+        for child_id in list(block["components"]) + list((block.get("options") or {}).keys()):
+            if child_id not in seen:
+                seen.add(child_id)
+                pending.append(child_id)
+    blocks.sort(key=lambda dependency: dependency[0]["id"])
+    return { "project": project, "construct": construct_id, "blocks": blocks }
+
 # Take a project and create a file. This file can be a genbank file or a zip with
 # lots of genbank files, depending on whether the project has list blocks in it.
-from pprint import pprint
-import zipfile
-import os
-def export_project(filename, project, allblocks):
+# With more than one worker, the combinations of list blocks are rendered by a pool of that many processes (0 means
+# one per CPU), and still added to the zip in order.
+# start and stop limit the export to the files [start, stop) of the full export, numbered from 0 in the order they're
+# written (see count_export_combinations). They keep the name they have in the full export.
+# If stats are given, whether a pool was used is added to them (see conversion_stats.add_pool)
+def export_project(filename, project, allblocks, workers=1, start=0, stop=None, stats=None):
+    if start < 0 or (stop is not None and stop < start):
+        raise ValueError("Invalid range of combinations: " + str(start) + " to " + str(stop))
+
+    context = create_export_context(allblocks)
+    memory_checkpoint("export context")
     all_options = [block["id"] for block in allblocks if block.get("options") is not None and len(block["options"]) > 0]
 
     # There are no list blocks
     if len(all_options) == 0:
         print "No options!"
-        project_to_genbank(filename, project, allblocks)
+        if start != 0 or stop is not None:
+            project = dict(project, components=project["components"][start:stop])
+        project_to_genbank(filename, project, allblocks, context=context)
         return
 
     # There are list blocks. We need to create a zip file with all the combinations. Include in the zip file the non-list-block constructs
@@ -314,38 +752,68 @@ def export_project(filename, project, allblocks):
 
     zf = zipfile.ZipFile(filename, mode='w')
 
-    for construct_id in constructs:
-        construct = [b for b in allblocks if b["id"] == construct_id][0]
-
-        optional_children = get_optional_children(construct, allblocks)
-        if len(optional_children) > 0:
-            build_first_optional_construct(optional_children)
-
-            gb_filename = name_prefix + construct["metadata"]["name"] + " - " + str(construct_number) + ".gb"
-            gb_filepath = '/tmp/' + gb_filename
-            construct_number = construct_number + 1
-
-            project_to_genbank(gb_filepath, project,
-                               allblocks, construct_id=construct_id)
-            zf.write(gb_filepath, gb_filename)
-            os.remove(gb_filepath)
-
-            while build_next_optional_construct(optional_children):
-                gb_filename = name_prefix + construct["metadata"]["name"] + " - " + str(construct_number) + ".gb"
-                gb_filepath = '/tmp/' + gb_filename
-                construct_number = construct_number + 1
-
-                project_to_genbank(gb_filepath, project,
-                                   allblocks, construct_id=construct_id)
-                zf.write(gb_filepath, gb_filename)
-                os.remove(gb_filepath)
-
-        else:
-            gb_filename = name_prefix + construct["metadata"]["name"] + " - " + str(construct_number) + ".gb"
-            gb_filepath = '/tmp/' + gb_filename
-            construct_number = construct_number + 1
-            project_to_genbank(gb_filepath, project, allblocks, construct_id=construct_id)
-            zf.write(gb_filepath, gb_filename)
-            os.remove(gb_filepath)
+    if workers == 0:
+        workers = multiprocessing.cpu_count()
+    pool = None
+    if workers > 1:
+        # The workers get a copy of everything as it is now
+        pool = multiprocessing.Pool(workers, init_export_worker, (context,))
+        add_pool(stats, workers)
+
+    try:
+        for construct_id in constructs:
+            construct = get_block(construct_id, context)
+            optional_children, choices, first, count = start_construct_combinations(construct, context)
+
+            # The combinations of this construct to export, counted from its first one
+            offset = construct_number - 1
+            lowest = max(start, offset) - offset
+            highest = count if stop is None else min(stop - offset, count)
+            if lowest >= highest:
+                finish_construct_combinations(optional_children, choices, first)
+                construct_number = construct_number + count
+                continue
+
+            template = create_construct_template(construct, context)
+            construct_number = construct_number + lowest
+
+            if first is None:
+                # Can't be numbered, go through them one by one
+                number = 0
+                while True:
+                    if lowest <= number < highest:
+                        gb_filename = name_prefix + construct["metadata"]["name"] + " - " + str(construct_number) + ".gb"
+                        construct_number = construct_number + 1
+                        add_construct_to_zip(zf, gb_filename, template, context)
+                    number = number + 1
+                    if not build_next_optional_construct(optional_children):
+                        break
+                construct_number = construct_number + count - highest
+                continue
+
+            if pool is not None and len(optional_children) > 0:
+                tasks = combination_tasks(construct_id, first + lowest, highest - lowest, workers)
+                for records in pool.imap(render_combinations, tasks):
+                    for record in records:
+                        gb_filename = name_prefix + construct["metadata"]["name"] + " - " + str(construct_number) + ".gb"
+                        construct_number = construct_number + 1
+                        write_zip_entry(zf, gb_filename, record)
+            else:
+                for index in xrange(first + lowest, first + highest):
+                    select_combination(optional_children, choices, index)
+                    gb_filename = name_prefix + construct["metadata"]["name"] + " - " + str(construct_number) + ".gb"
+                    construct_number = construct_number + 1
+                    add_construct_to_zip(zf, gb_filename, template, context)
+
+            # Leave the options where build_next_optional_construct would have
+            finish_construct_combinations(optional_children, choices, first)
+            construct_number = construct_number + count - highest
+
+        if pool is not None:
+            pool.close()
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
 
     zf.close()
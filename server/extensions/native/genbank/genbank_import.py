@@ -1,5 +1,17 @@
+import bisect
+import functools
+import hashlib
+import itertools
 import json
+import multiprocessing
+import os
+import re
+from cStringIO import StringIO
 from Bio import SeqIO
+from genbank_scanner import scan_genbank_records, scan_genbank_text, split_genbank_records
+from conversion_stats import add_count, add_pool, add_stats, create_stats, record_phase
+from conversion_profile import memory_checkpoint
+import time
 import uuid
 import sys
 
@@ -75,17 +87,76 @@ name_qualifier_table = {
     "5'utr": ["standard_name", "gene", "function", "label"],
 }
 
-# Creates a scaffold structure for a block
-def create_block_json(id):
-    return {
-        "id": id,
-        "metadata" : { "genbank" : {}},
-        "rules": {},
-        "components": [],
-        "sequence" : {
-            "features": []
+# Marks the metadata that a block doesn't have, so it's left out of its json (None is a valid value for some of it)
+NOT_SET = object()
+
+# A block while its record is being converted.
+# The json structure of a block is a handful of nested dicts and lists, and big records have hundreds of thousands of
+# blocks, so during the import blocks are kept as flat objects instead and turned into json only when they are written
+# out (see to_json and imported_block_to_json). Start, end and what is used to rebuild the hierarchy of a file exported
+# from GC (old_id, old_parents, is_annotation) are only needed while converting, so they never make it to the json.
+class ImportedBlock(object):
+    __slots__ = ("id", "start", "end", "length", "strand", "name", "description", "color", "initial_bases", "genbank",
+                 "role", "components", "annotations", "old_id", "old_parents", "is_annotation")
+
+    def __init__(self, id):
+        self.id = id
+        self.start = 0
+        self.end = 0
+        self.length = 0
+        self.strand = NOT_SET
+        self.name = NOT_SET
+        self.description = NOT_SET
+        self.color = NOT_SET
+        self.initial_bases = NOT_SET
+        self.genbank = {}
+        self.role = NOT_SET
+        self.components = []
+        self.annotations = None
+        self.old_id = None
+        self.old_parents = None
+        self.is_annotation = False
+
+    # The metadata that goes to the json, with the name it has there
+    def exported_metadata(self):
+        for key, value in (("name", self.name), ("description", self.description), ("color", self.color),
+                           ("strand", self.strand), ("initialBases", self.initial_bases)):
+            if value is not NOT_SET:
+                yield key, value
+
+    def to_json(self):
+        metadata = dict(self.exported_metadata())
+        metadata["genbank"] = self.genbank
+
+        block = {
+            "id": self.id,
+            "metadata": metadata,
+            "rules": {},
+            "components": self.components,
+            "sequence": {
+                "features": [],
+                "length": self.length
+            }
         }
-      }
+        if self.role is not NOT_SET:
+            block["rules"]["role"] = self.role
+        if self.annotations is not None:
+            block["sequence"]["annotations"] = self.annotations
+        return block
+
+    # Objects with __slots__ need these to be pickled, which is how they get back from the worker processes
+    def __getstate__(self):
+        return dict((key, getattr(self, key)) for key in self.__slots__ if getattr(self, key) is not NOT_SET)
+
+    def __setstate__(self, state):
+        for key in self.__slots__:
+            setattr(self, key, state.get(key, NOT_SET))
+
+# Passed as default to json.dump, so each block is turned into json just as it's written out
+def imported_block_to_json(obj):
+    if isinstance(obj, ImportedBlock):
+        return obj.to_json()
+    raise TypeError(repr(obj) + " is not JSON serializable")
 
 # Determines the kind of relationship between 2 blocks, using only the length, start and end positions
 # Output can be:
@@ -96,18 +167,18 @@ def create_block_json(id):
 #    "before": block1 comes before than block2 in the sequence
 #    "after": block1 comes after block2 in the sequence
 def relationship(block1, block2):
-    if block1["sequence"]["length"] < block2["sequence"]["length"] and block2["metadata"]["start"] <= block1["metadata"]["start"] and block2["metadata"]["end"] >= block1["metadata"]["end"]:
+    if block1.length < block2.length and block2.start <= block1.start and block2.end >= block1.end:
         return "child"
-    if block1["sequence"]["length"] == block2["sequence"]["length"] and block2["metadata"]["start"] == block1["metadata"]["start"] and block2["metadata"]["end"] == block1["metadata"]["end"]:
+    if block1.length == block2.length and block2.start == block1.start and block2.end == block1.end:
         return "equal"
-    if block1["sequence"]["length"] > block2["sequence"]["length"] and block1["metadata"]["start"] <= block2["metadata"]["start"] and block1["metadata"]["end"] >= block2["metadata"]["end"]:
+    if block1.length > block2.length and block1.start <= block2.start and block1.end >= block2.end:
         return "parent"
-    if (block1["metadata"]["start"] <= block2["metadata"]["start"] and block1["metadata"]["end"] > block2["metadata"]["start"]) or \
-        (block1["metadata"]["start"] < block2["metadata"]["end"] and block1["metadata"]["end"] >= block2["metadata"]["end"]):
+    if (block1.start <= block2.start and block1.end > block2.start) or \
+        (block1.start < block2.end and block1.end >= block2.end):
         return "partial"
-    if block1["metadata"]["end"]-1 < block2["metadata"]["start"]:
+    if block1.end-1 < block2.start:
         return "before"
-    if block1["metadata"]["start"] > block2["metadata"]["end"]-1:
+    if block1.start > block2.end-1:
         return "after"
     raise Exception("This relationship between blocks can never happen")
     return "disjoint"
@@ -116,124 +187,174 @@ def relationship(block1, block2):
 # This function takes all the children of the block to embed in the parent and in turn makes them
 # also features of the parent.
 # Parameters: An array with all the blocks, the block to convert, the parent it should be a feature of,
-# and a list of IDs of blocks that need to be removed.
+# a set of IDs of blocks that need to be removed, and optionally the hierarchy index to keep up to date.
 # The function does NOT take the blocks from all_blocks
-def convert_block_to_annotation(all_blocks, to_convert, parent, to_remove_list):
+def convert_block_to_annotation(all_blocks, to_convert, parent, to_remove, index=None):
     annotation = { "name": "", "notes": {} }
-    for key, value in to_convert["metadata"].iteritems():
-        if key in ["name", "description", "start", "end", "tags", "color"]:
+    for key, value in to_convert.exported_metadata():
+        if key in ["name", "description", "color"]:
             annotation[key] = value
         elif key == "strand":
             annotation["isForward"] = (value == 1)
         else:
-            if key not in ["is_annotation", "old_parents", "old_id"]:
-                annotation["notes"][key] = value
+            annotation["notes"][key] = value
+    annotation["notes"]["genbank"] = to_convert.genbank
 
-    if "role" in to_convert["rules"]:
-        annotation["role"] = to_convert["rules"]["role"]
+    if to_convert.role is not NOT_SET:
+        annotation["role"] = to_convert.role
 
     # Start and end of the annotation are relative to the block containing them
-    annotation["start"] = to_convert["metadata"]["start"] - parent["metadata"]["start"]
-    annotation["end"] = to_convert["metadata"]["end"] - parent["metadata"]["start"]
+    annotation["start"] = to_convert.start - parent.start
+    annotation["end"] = to_convert.end - parent.start
 
-    if "annotations" not in parent["sequence"]:
-        parent["sequence"]["annotations"] = []
+    if parent.annotations is None:
+        parent.annotations = []
 
-    parent["sequence"]["annotations"].append(annotation)
-    to_remove_list.append(to_convert["id"])
+    parent.annotations.append(annotation)
+    to_remove.add(to_convert.id)
+    if index is not None:
+        index["parents"].pop(to_convert.id, None)
 
-    if "annotations" in to_convert["sequence"]:
-        for annotation in to_convert["sequence"]["annotations"]:
+    if to_convert.annotations is not None:
+        for annotation in to_convert.annotations:
             # We need to normalize the start and end for the annotation to the new parent start and end
-            annotation["start"] = annotation["start"] + to_convert["metadata"]["start"] - parent["metadata"]["start"]
-            annotation["end"] = annotation["end"] + to_convert["metadata"]["start"] - parent["metadata"]["start"]
-            parent["sequence"]["annotations"].append(annotation)
+            annotation["start"] = annotation["start"] + to_convert.start - parent.start
+            annotation["end"] = annotation["end"] + to_convert.start - parent.start
+            parent.annotations.append(annotation)
 
     # And also convert to features all the components of the removed block, recursively
-    for to_convert_child_id in to_convert["components"]:
+    for to_convert_child_id in sorted_components(to_convert, index):
         to_convert_child = all_blocks[to_convert_child_id]
-        convert_block_to_annotation(all_blocks, to_convert_child, parent, to_remove_list)
+        convert_block_to_annotation(all_blocks, to_convert_child, parent, to_remove, index)
+
+# Finds the first byte of a string that is not ASCII
+non_ascii = re.compile(r"[\x80-\xff]")
+
+# Whether json.dumps can serialize a value, checked by its type instead of trying to serialize it.
+# Like json.dumps, byte strings have to be valid UTF-8, and dictionary keys have to be strings, numbers, booleans or None
+def is_serializable(value):
+    if isinstance(value, str):
+        try:
+            value.decode("utf-8")
+            return True
+        except UnicodeDecodeError:
+            return False
+    if value is None or isinstance(value, (unicode, bool, int, long, float)):
+        return True
+    if isinstance(value, (list, tuple)):
+        return all(is_serializable(item) for item in value)
+    if isinstance(value, dict):
+        return all((key is None or isinstance(key, (str, unicode, bool, int, long, float))) and is_serializable(key)
+                   and is_serializable(item) for key, item in value.iteritems())
+    return False
+
+# Keeps a single copy of each string in a record. Features repeat the same qualifier names and a lot of the same
+# values (/organism, /db_xref, /product...), and the parser gives us a new copy of each every time.
+# strings is the dictionary of the strings seen so far in the record
+def shared_string(value, strings):
+    if not isinstance(value, str):
+        return value
+    return strings.setdefault(value, value)
+
+# Takes the qualifiers of a feature and returns the first value of each of the ones that can go in the json, with
+# their names and values shared across the record (see shared_string)
+def normalize_qualifiers(qualifiers, strings):
+    normalized = {}
+    for key, values in qualifiers.iteritems():
+        value = values[0]
+        # Almost every value is a plain ASCII string, which can always go in the json
+        if type(value) is str:
+            if non_ascii.search(value) is not None and not is_serializable(value):
+                continue
+            value = strings.setdefault(value, value)
+        elif not is_serializable(value):
+            continue
+        normalized[strings.setdefault(key, key)] = value
+    return normalized
 
 # Takes a genbank record and creates a root block
 def create_root_block_from_genbank(gb, sequence):
     full_length = len(sequence["sequence"])
 
     root_id = str(uuid.uuid4())
-    root_block = create_block_json(root_id)
-    root_block["metadata"]["description"] = gb.description
-    root_block["metadata"]["name"] = gb.name
-    root_block["metadata"]["genbank"]["name"] = gb.name
+    root_block = ImportedBlock(root_id)
+    root_block.description = gb.description
+    root_block.name = gb.name
+    root_block.genbank["name"] = gb.name
 
-    root_block["metadata"]["start"] = 0
-    root_block["metadata"]["end"] = full_length
-    sequence["blocks"][root_id] = [root_block["metadata"]["start"], root_block["metadata"]["end"]]
+    root_block.start = 0
+    root_block.end = full_length
+    sequence["blocks"][root_id] = [root_block.start, root_block.end]
 
-    root_block["metadata"]["genbank"]["id"] = gb.id
-    root_block["sequence"]["length"] = full_length
+    root_block.genbank["id"] = gb.id
+    root_block.length = full_length
     if "references" in gb.annotations:
         for ref in gb.annotations["references"]:
-            if "references" not in root_block["metadata"]["genbank"]:
-                root_block["metadata"]["genbank"]["references"] = []
+            if "references" not in root_block.genbank:
+                root_block.genbank["references"] = []
             try:
                 reference = {'authors': ref.authors, 'comment': ref.comment, 'consrtm': ref.consrtm, 'journal': ref.journal,
                              'medline_id': ref.medline_id, 'pubmed_id': ref.pubmed_id, 'title': ref.title}
-                root_block["metadata"]["genbank"]["references"].append(reference)
+                root_block.genbank["references"].append(reference)
             except:
                 pass
 
     for annot in gb.annotations:
-        if "annotations" not in root_block["metadata"]["genbank"]:
-            root_block["metadata"]["genbank"]["annotations"] = {}
-        try:
-            json.dumps(gb.annotations[annot])
-            root_block["metadata"]["genbank"]["annotations"][annot] = gb.annotations[annot]
-        except:
-            pass
+        if "annotations" not in root_block.genbank:
+            root_block.genbank["annotations"] = {}
+        if is_serializable(gb.annotations[annot]):
+            root_block.genbank["annotations"][annot] = gb.annotations[annot]
     return root_block
 
 # Create the name for the block based on preference rules in the name qualifier table
 # Defaults to the genbank type if we don't have anything else to go on
-def convert_block_name(f, block):
+def convert_block_name(f, block, strings):
     genbank_type = f.type.lower()
     if genbank_type in name_qualifier_table:
         preferences = name_qualifier_table[genbank_type]
         for key in preferences:
             if key in f.qualifiers:
-                block["metadata"]["name"] = f.qualifiers[key][0]
-                block["metadata"]["genbank"]["name_source"] = key
+                block.name = shared_string(f.qualifiers[key][0], strings)
+                block.genbank["name_source"] = key
                 return
     else:
-        block["metadata"]["name"] = f.type
+        block.name = f.type
 
 # The information for GC is stored in the notes qualifier, encoded in json. Get it back out.
 def convert_GC_info(f, block):
     if "note" not in f.qualifiers:
         return
 
+    # Only the notes we wrote on export are json, don't try to decode anything else
+    if not f.qualifiers["note"][0].lstrip().startswith("{"):
+        block.genbank["note"] = f.qualifiers["note"][0]
+        return
+
     try:
         all_info = json.loads(f.qualifiers["note"][0].replace("'", "\""))
-        block["metadata"]["name"] = all_info["GC"]["name"]
+        block.name = all_info["GC"]["name"]
         if "color" in all_info["GC"]:
-            block["metadata"]["color"] = all_info["GC"]["color"]
+            block.color = all_info["GC"]["color"]
         if "description" in all_info["GC"]:
-            block["metadata"]["description"] = all_info["GC"]["description"]
+            block.description = all_info["GC"]["description"]
         if "note" in all_info:
-            block["metadata"]["genbank"]["note"] = all_info["note"]
+            block.genbank["note"] = all_info["note"]
         if "id" in all_info["GC"]:
-            block["metadata"]["old_id"] = all_info["GC"]["id"]
+            block.old_id = all_info["GC"]["id"]
         if "parents" in all_info["GC"] and len(all_info["GC"]["parents"]) > 0:
-            block["metadata"]["old_parents"] = all_info["GC"]["parents"]
+            block.old_parents = all_info["GC"]["parents"]
         if "type" in all_info["GC"]:
-            block["metadata"]["is_annotation"] = (all_info["GC"]["type"] == "annotation")
+            block.is_annotation = (all_info["GC"]["type"] == "annotation")
 
     except:
-        block["metadata"]["genbank"]["note"] = f.qualifiers["note"][0]
+        block.genbank["note"] = f.qualifiers["note"][0]
 
 # Takes a BioPython SeqFeature and turns it into a block
-def create_child_block_from_feature(f, all_blocks, root_block, sequence):
-    qualifiers = f.qualifiers
-    start = f.location.start.position
-    end = f.location.end.position
+# strings has the strings seen so far in the record (see shared_string)
+def create_child_block_from_feature(f, all_blocks, root_block, sequence, strings):
+    qualifiers = normalize_qualifiers(f.qualifiers, strings)
+    start = int(f.location.start)
+    end = int(f.location.end)
     strand = f.location.strand
     role_type = role_type_table.get(f.type)
 
@@ -243,50 +364,208 @@ def create_child_block_from_feature(f, all_blocks, root_block, sequence):
         # 'source' refers to the root block. So, the root block aggregates information
         # from the header of the genbank file as well as the 'source' feature
         for key, value in qualifiers.iteritems():
-            if "feature_annotations" not in root_block["metadata"]["genbank"]:
-                root_block["metadata"]["genbank"]["feature_annotations"] = {}
+            if "feature_annotations" not in root_block.genbank:
+                root_block.genbank["feature_annotations"] = {}
             if key not in ["note"]:
-                root_block["metadata"]["genbank"]["feature_annotations"][key] = value[0]
+                root_block.genbank["feature_annotations"][key] = value
     else:
         # It's a regular annotation, create a block
         block_id = str(uuid.uuid4())
-        child_block = create_block_json(block_id)
-        convert_block_name(f, child_block)
+        child_block = ImportedBlock(block_id)
+        convert_block_name(f, child_block, strings)
         convert_GC_info(f, child_block)
 
-        for q in f.qualifiers:
-            try:
-                json.dumps(qualifiers[q][0])
-                if q not in ["note"]:
-                    child_block["metadata"]["genbank"][q] = f.qualifiers[q][0]
-            except:
-                pass
+        for key, value in qualifiers.iteritems():
+            if key not in ["note"]:
+                child_block.genbank[key] = value
 
-        child_block["metadata"]["start"] = start
-        child_block["metadata"]["end"] = end
-        sequence["blocks"][block_id] = [child_block["metadata"]["start"], child_block["metadata"]["end"]]
+        child_block.start = start
+        child_block.end = end
+        sequence["blocks"][block_id] = [child_block.start, child_block.end]
 
-        child_block["sequence"]["length"] = child_block["metadata"]["end"] - child_block["metadata"]["start"]
-        child_block["metadata"]["strand"] = strand
-        child_block["metadata"]["genbank"]["type"] = f.type
+        child_block.length = child_block.end - child_block.start
+        child_block.strand = strand
+        child_block.genbank["type"] = shared_string(f.type, strings)
 
         if role_type:
-            child_block["rules"]["role"] = role_type
+            child_block.role = role_type
 
         all_blocks[block_id] = child_block
 
-# Returns true if a block id is a children of any other block
-def has_parent(block_id, all_blocks):
+# Indexes used while building the hierarchy:
+#    "old_ids": the blocks by the id they had in GC, to rebuild the hierarchy of a file that was exported from GC
+#    "parents": the ids of the blocks each block has been inserted in so far
+#    "slots": for each block that can get children, where they go (see add_child_slots)
+# insert_child_in_parent and convert_block_to_annotation keep "parents" and "slots" up to date
+def create_hierarchy_index(all_blocks):
+    index = { "old_ids": {}, "parents": {}, "slots": {} }
     for block in all_blocks.values():
-        if block_id in block["components"]:
-            return True
-    return False
+        if block.old_id is not None:
+            index["old_ids"].setdefault(block.old_id, block)
+    return index
+
+def block_by_old_id(old_id, index):
+    if old_id not in index["old_ids"]:
+        raise Exception("Block not Found!")
+    return index["old_ids"][old_id]
+
+# The children a block can get while the hierarchy is built are known before it's built: the blocks it's the
+# container of (see find_containers) and the ones that had it as a parent in GC. They're ranked by start and end, the
+# order the ones that make it into the block have among themselves (siblings never overlap). Inserting a child marks
+# its rank as taken in a Fenwick tree, which finds the siblings next to it in O(log n) (see insert_child_in_parent),
+# and the components are only sorted by rank when they're read (see sorted_components).
+# The slots of a block are:
+#    "children": the blocks that can be its children, by rank
+#    "ranks": the rank of each of them, by id
+#    "tree": the Fenwick tree of the ranks taken
+#    "taken": for each rank, whether it's taken
+#    "count": how many ranks are taken
+#    "sorted": whether the components of the block are sorted by rank
+def add_child_slots(index, sorted_blocks, containers):
+    candidates = {}
+    for block in sorted_blocks:
+        if block.old_parents:
+            parents = [index["old_ids"][old_id] for old_id in block.old_parents if old_id in index["old_ids"]]
+        elif block.id in containers:
+            parents = [containers[block.id]]
+        else:
+            continue
+        for parent in parents:
+            candidates.setdefault(parent.id, {})[block.id] = block
+
+    for parent_id, children in candidates.iteritems():
+        children = sorted(children.itervalues(), key=lambda child: (child.start, child.end))
+        index["slots"][parent_id] = {
+            "children": children,
+            "ranks": dict((child.id, rank) for rank, child in enumerate(children)),
+            "tree": [0] * (len(children) + 1),
+            "taken": bytearray(len(children)),
+            "count": 0,
+            "sorted": True
+        }
 
-def block_by_old_id(old_id, all_blocks):
-    for block in all_blocks.values():
-        if "old_id" in block["metadata"] and block["metadata"]["old_id"] == old_id:
-            return block
-    raise Exception("Block not Found!")
+def take_rank(tree, rank):
+    position = rank + 1
+    while position < len(tree):
+        tree[position] += 1
+        position += position & -position
+
+# How many ranks lower than rank are taken
+def count_taken(tree, rank):
+    count = 0
+    while rank > 0:
+        count += tree[rank]
+        rank -= rank & -rank
+    return count
+
+# The rank of the k-th rank taken, counting from 1
+def find_taken(tree, k):
+    size = len(tree)
+    position = 0
+    step = 1 << ((size - 1).bit_length() - 1) if size > 1 else 0
+    while step:
+        next_position = position + step
+        if next_position < size and tree[next_position] < k:
+            position = next_position
+            k -= tree[position]
+        step >>= 1
+    return position
+
+# The components of a block, sorted by where they go
+def sorted_components(block, index):
+    slots = index["slots"].get(block.id) if index is not None else None
+    if slots is not None and not slots["sorted"]:
+        block.components.sort(key=slots["ranks"].__getitem__)
+        slots["sorted"] = True
+    return block.components
+
+# Finds the tightest container of every block that doesn't span the whole sequence: the first block in sorted_blocks
+# (sorted from shorter to longer) that is strictly longer and completely contains it. Blocks spanning the whole sequence
+# are never containers, except for the root, which contains everything that nothing else does.
+# Works as a sweep over the blocks from shorter to longer: blocks waiting for a container are kept in a segment tree
+# ordered by start that holds the minimum end of each range, so every container pops the pending blocks it covers in
+# O(log n) each. The whole pass is O(n log n).
+# Returns a dictionary of block id -> container block
+def find_containers(sorted_blocks, root_block):
+    full_length = root_block.length
+    pending = [block for block in sorted_blocks if block.length < full_length]
+    count = len(pending)
+
+    by_start = sorted(range(count), key=lambda k: pending[k].start)
+    starts = [pending[k].start for k in by_start]
+    leaf_of = [0] * count
+    for leaf, k in enumerate(by_start):
+        leaf_of[k] = leaf
+
+    size = 1
+    while size < count:
+        size *= 2
+    no_end = float("inf")
+    min_end = [no_end] * (2 * size)
+
+    def set_end(leaf, value):
+        node = leaf + size
+        min_end[node] = value
+        node //= 2
+        while node:
+            min_end[node] = min(min_end[2 * node], min_end[2 * node + 1])
+            node //= 2
+
+    # Collects the leaves in [lo, hi) whose end is <= end, and takes them out of the tree
+    def pop_covered(node, node_lo, node_hi, lo, hi, end, covered):
+        if node_hi <= lo or hi <= node_lo or min_end[node] > end:
+            return
+        if node >= size:
+            covered.append(node - size)
+            min_end[node] = no_end
+            return
+        middle = (node_lo + node_hi) // 2
+        pop_covered(2 * node, node_lo, middle, lo, hi, end, covered)
+        pop_covered(2 * node + 1, middle, node_hi, lo, hi, end, covered)
+        min_end[node] = min(min_end[2 * node], min_end[2 * node + 1])
+
+    containers = {}
+
+    def claim(container, lo, hi):
+        covered = []
+        pop_covered(1, 0, size, lo, hi, container.end, covered)
+        for leaf in covered:
+            containers[pending[by_start[leaf]].id] = container
+
+    i = 0
+    while i < count:
+        # Blocks of the same length can't contain each other, so they only become pending after they all had their turn
+        length = pending[i].length
+        group_end = i
+        while group_end < count and pending[group_end].length == length:
+            group_end += 1
+
+        for k in range(i, group_end):
+            container = pending[k]
+            lo = bisect.bisect_left(starts, container.start)
+            hi = bisect.bisect_right(starts, container.end)
+            claim(container, lo, hi)
+        for k in range(i, group_end):
+            set_end(leaf_of[k], pending[k].end)
+        i = group_end
+
+    claim(root_block, 0, count)
+    return containers
+
+# Groups the blocks that have exactly the same start and end. For each block, returns the list of blocks after it in
+# sorted_blocks that it is "equal" to, skipping the ones that span the whole sequence (other than the root).
+def find_equals(sorted_blocks, root_block):
+    full_length = root_block.length
+    groups = {}
+    for block in sorted_blocks:
+        groups.setdefault((block.start, block.end), []).append(block)
+
+    equals = {}
+    for group in groups.values():
+        for k, block in enumerate(group):
+            equals[block.id] = [other for other in group[k + 1:]
+                                   if other == root_block or other.length != full_length]
+    return equals
 
 # Traverse an array of blocks and build a hierarchy. The hierarchy embeds blocks into other blocks in order,
 # and create filler blocks where needed
@@ -295,62 +574,57 @@ def build_block_hierarchy(all_blocks, root_block, sequence):
     # the ones that convert to blocks instead of features
 
     # Hack to make Root the last one (beyond all the other ones with the same length)
-    root_block["metadata"]["end"] = root_block["metadata"]["end"] + 1
-    sorted_blocks = sorted(all_blocks.values(), key=lambda block: block["metadata"]["end"] - block["metadata"]["start"])
-    root_block["metadata"]["end"] = root_block["metadata"]["end"] - 1
+    root_block.end = root_block.end + 1
+    sorted_blocks = sorted(all_blocks.values(), key=lambda block: block.end - block.start)
+    root_block.end = root_block.end - 1
+
+    # The possible parents of a block are the blocks after it in sorted_blocks that contain it. The first ones are
+    # the "equal" blocks, followed by the ones that are strictly longer, of which only the first (the tightest) matters.
+    containers = find_containers(sorted_blocks, root_block)
+    equals = find_equals(sorted_blocks, root_block)
+    index = create_hierarchy_index(all_blocks)
+    add_child_slots(index, sorted_blocks, containers)
 
-    blocks_count = len(sorted_blocks)
-    to_remove = []
+    to_remove = set()
 
-    for i in range(blocks_count):
-        block = sorted_blocks[i]
+    for block in sorted_blocks:
         # Don't try to sort out the root block, anything to remove, or anything that we have already determined that it has a parent
-        if block == root_block or block["id"] in to_remove or has_parent(block["id"], all_blocks):
+        if block == root_block or block.id in to_remove or block.id in index["parents"]:
             continue
 
         # Try to rebuild the hierarchy if it's an import from GC
-        if "old_parents" in block["metadata"] and len(block["metadata"]["old_parents"]) > 0:
-            if "is_annotation" in block["metadata"] and block["metadata"]["is_annotation"]:
-                convert_block_to_annotation(all_blocks, block, block_by_old_id(block["metadata"]["old_parents"][0], all_blocks), to_remove)
+        if block.old_parents:
+            if block.is_annotation:
+                convert_block_to_annotation(all_blocks, block, block_by_old_id(block.old_parents[0], index), to_remove, index)
             else:
-                for old_parent_id in block["metadata"]["old_parents"]:
-                    insert_child_in_parent(all_blocks, block, block_by_old_id(old_parent_id, all_blocks), to_remove)
+                for old_parent_id in block.old_parents:
+                    insert_child_in_parent(all_blocks, block, block_by_old_id(old_parent_id, index), to_remove, index)
             continue
 
         inserted = False
 
-        parents = []
-        # Look for all the possible parents of the current block
-        for j in range(i + 1, blocks_count):
-            # If it is a child of root, don't add it as child of any other block with the same size
-            if sorted_blocks[j]["sequence"]["length"] == root_block["sequence"]["length"] and sorted_blocks[j] != root_block:
-                continue
-
-            if sorted_blocks[j]["metadata"]["end"] >= block["metadata"]["end"] and sorted_blocks[j]["metadata"]["start"] <= \
-                    block["metadata"]["start"]:
-                parents.append(sorted_blocks[j])
-
-        for other_block in parents:
-            rel = relationship(block, other_block)
-            if rel == "child":
-                insert_child_in_parent(all_blocks, block, other_block, to_remove)
+        for other_block in equals[block.id]:
+            # If the blocks overlap, make the one with less amount of children the feature of
+            # the other one
+            if len(block.components) <= len(other_block.components):
+                convert_block_to_annotation(all_blocks, block, other_block, to_remove, index)
                 inserted = True
                 break
-            elif rel == "equal":
-                # If the blocks overlap, make the one with less amount of children the feature of
-                # the other one
-                if len(block["components"]) <= len(other_block["components"]):
-                    convert_block_to_annotation(all_blocks, block, other_block, to_remove)
-                    inserted = True
-                    break
-                else:
-                    convert_block_to_annotation(all_blocks, other_block, block, to_remove)
+            else:
+                convert_block_to_annotation(all_blocks, other_block, block, to_remove, index)
+
+        if not inserted and block.id in containers:
+            insert_child_in_parent(all_blocks, block, containers[block.id], to_remove, index)
+            inserted = True
 
         if not inserted:  # This should never happen because the block should be at least child of root!
-            if block["sequence"]["length"] == root_block["sequence"]["length"]:
-                convert_block_to_annotation(all_blocks, block, root_block, to_remove)
+            if block.length == root_block.length:
+                convert_block_to_annotation(all_blocks, block, root_block, to_remove, index)
             else:
-                print('Error processing block ' + str(block["metadata"].get("name")) + "[" + str(block["metadata"]["start"]) + ":" + str(block["metadata"]["end"]) + "]")
+                print('Error processing block ' + str(block.name if block.name is not NOT_SET else None) + "[" + str(block.start) + ":" + str(block.end) + "]")
+
+    for parent_id in index["slots"]:
+        sorted_components(all_blocks[parent_id], index)
 
     # Delete all the blocks that were converted to features
     for removing in to_remove:
@@ -358,26 +632,62 @@ def build_block_hierarchy(all_blocks, root_block, sequence):
         sequence["blocks"].pop(removing)
 
 
-def insert_child_in_parent(all_blocks, block, parent_block, to_remove):
-    i = 0
-    is_partial_overlap = False
-    # Go through the siblins to see where to insert the current block
-    for sib_id in parent_block["components"]:
-        sibling = all_blocks[sib_id]
-        relationship_to_sibling = relationship(block, sibling)
-        # Keep moving forward until we get to one where we need to be "before"
-        if relationship_to_sibling == "after":
-            i += 1
-        elif relationship_to_sibling != "before":  # Partial match!
-            is_partial_overlap = True
+# Inserts a block in one of the parents it has a slot in (see add_child_slots), or makes it an annotation of the parent
+# if it partially overlaps one of the children the parent has already.
+# All the siblings that end before the block starts are "after" it, and all the ones that start after the block ends
+# are "before" it, so only the few in between, next to its rank, need to be looked at.
+def insert_child_in_parent(all_blocks, block, parent_block, to_remove, index):
+    slots = index["slots"][parent_block.id]
+    children = slots["children"]
+    tree = slots["tree"]
+    rank = slots["ranks"][block.id]
+
+    # Already in it, which is as good as overlapping itself
+    is_partial_overlap = bool(slots["taken"][rank])
+    lower = count_taken(tree, rank)
+    k = lower
+    while not is_partial_overlap and k > 0:
+        sibling = children[find_taken(tree, k)]
+        if sibling.end < block.start:
             break
+        is_partial_overlap = relationship(block, sibling) not in ["before", "after"]
+        k -= 1
+    k = lower + 1
+    while not is_partial_overlap and k <= slots["count"]:
+        sibling = children[find_taken(tree, k)]
+        if sibling.start > block.end:
+            break
+        is_partial_overlap = relationship(block, sibling) not in ["before", "after"]
+        k += 1
+
     # Insert the block where it goes
     if not is_partial_overlap:
-        parent_block["components"].insert(i, block["id"])
+        take_rank(tree, rank)
+        slots["taken"][rank] = 1
+        slots["count"] += 1
+        parent_block.components.append(block.id)
+        slots["sorted"] = False
+        index["parents"].setdefault(block.id, []).append(parent_block.id)
     else:
         # Partial match, make this block just an annotation of the parent
-        convert_block_to_annotation(all_blocks, block, parent_block, to_remove)
+        convert_block_to_annotation(all_blocks, block, parent_block, to_remove, index)
+
+# Creates a filler block for the sequence between start and end
+def create_filler_block(all_blocks, sequence, start, end):
+    block_id = str(uuid.uuid4())
+    filler_block = ImportedBlock(block_id)
+    filler_block.color = None
+
+    filler_block.start = start
+    filler_block.end = end
+    sequence["blocks"][block_id] = [filler_block.start, filler_block.end]
 
+    filler_block.length = filler_block.end - filler_block.start
+
+    filler_block.initial_bases = sequence["sequence"][filler_block.start:filler_block.start+3] + "..."
+
+    all_blocks[block_id] = filler_block
+    return block_id
 
 # Create blocks that fill holes between siblings.
 def create_filler_blocks_for_holes(all_blocks, sequence):
@@ -385,104 +695,246 @@ def create_filler_blocks_for_holes(all_blocks, sequence):
     current_block_structures = [block for block in all_blocks.values()]
     # Go through all the blocks
     for block in current_block_structures:
-        current_position = block["metadata"]["start"]
-        child = None
-        i = 0
-        # For each block go through all the children
-        for i, child_id in enumerate(block["components"]):
-            child = all_blocks[child_id]
-            # If the child starts AFTER where it should start
-            if child["metadata"]["start"] > current_position:
-                # Create a filler block before the current block, encompassing the sequence between where the child should
-                # start and where it actually starts. Add the filler block to the parent.
-                block_id = str(uuid.uuid4())
-                filler_block = create_block_json(block_id)
-                filler_block["metadata"]["color"] = None
-
-                filler_block["metadata"]["start"] = current_position
-                filler_block["metadata"]["end"] = child["metadata"]["start"]
-                sequence["blocks"][block_id] = [filler_block["metadata"]["start"], filler_block["metadata"]["end"]]
-
-                filler_block["sequence"]["length"] = filler_block["metadata"]["end"] - filler_block["metadata"]["start"]
-
-                filler_block["metadata"]["initialBases"] = sequence["sequence"][filler_block["metadata"]["start"]:filler_block["metadata"]["start"]+3] + "..."
+        if len(block.components) == 0:
+            continue
 
-                all_blocks[block_id] = filler_block
-                block["components"].insert(i, block_id)
-            current_position = child["metadata"]["end"]
+        # Build the new list of children in one go, with the fillers where they go
+        components = []
+        current_position = block.start
+        for child_id in block.components:
+            child = all_blocks[child_id]
+            # If the child starts AFTER where it should start, create a filler block before it, encompassing the
+            # sequence between where the child should start and where it actually starts.
+            if child.start > current_position:
+                components.append(create_filler_block(all_blocks, sequence, current_position, child.start))
+            components.append(child_id)
+            current_position = child.end
         # If the last block doesn't end at the end of the parent, create a filler too!
-        if child and current_position < block["metadata"]["end"]:
-            block_id = str(uuid.uuid4())
-            filler_block = create_block_json(block_id)
-            filler_block["metadata"]["color"] = None
-
-            filler_block["metadata"]["start"] = current_position
-            filler_block["metadata"]["end"] = block["metadata"]["end"]
-            sequence["blocks"][block_id] = [filler_block["metadata"]["start"], filler_block["metadata"]["end"]]
-
-            filler_block["sequence"]["length"] = filler_block["metadata"]["end"] - filler_block["metadata"]["start"]
-
-            filler_block["metadata"]["initialBases"] = sequence["sequence"][filler_block["metadata"]["start"]:filler_block["metadata"]["start"]+3] + "..."
-
-            all_blocks[block_id] = filler_block
-            block["components"].insert(i + 1, block_id)
+        if current_position < block.end:
+            components.append(create_filler_block(all_blocks, sequence, current_position, block.end))
+        block.components = components
 
 # If a block has children, remove its sequence
 def remove_sequence_from_parents(all_blocks):
     for block in all_blocks.values():
-        if len(block["components"]) > 0:
-            block["sequence"]["length"] = 0
-
-# Once we have arranged all blocks, there is no need to keep the start and end values for each block. We do keep
-# the start and end of annotations
-def remove_start_and_end_of_blocks(all_blocks):
-    for block in all_blocks.values():
-        try:
-            del block["metadata"]["start"]
-            del block["metadata"]["end"]
-            del block["metadata"]["is_annotation"]
-            del block["metadata"]["old_id"]
-            del block["metadata"]["old_parents"]
-        except KeyError:
-            pass
+        if len(block.components) > 0:
+            block.length = 0
 
 # Takes a BioPython SeqRecord and converts it to our blocks structures,
-# with temporary ids
-def convert_genbank_record_to_blocks(gb):
+# with temporary ids. The blocks are ImportedBlocks, see imported_block_to_json to write them out.
+# Once we have arranged all blocks, there is no need to keep the start and end values for each block, so they are
+# not in their json. We do keep the start and end of annotations
+# If stats are given (see conversion_stats), the time of each phase and what was made is added to them
+def convert_genbank_record_to_blocks(gb, stats=None):
+    started = time.time()
     all_blocks = {}
     sequence = { "sequence": str(gb.seq), "blocks": {}}
 
     root_block = create_root_block_from_genbank(gb, sequence)
-    all_blocks[root_block["id"]] = root_block
+    all_blocks[root_block.id] = root_block
 
     # Create a block for each feature
+    strings = {}
     for f in sorted(gb.features, key = lambda feat: len(feat)):
-        create_child_block_from_feature(f, all_blocks, root_block, sequence)
+        create_child_block_from_feature(f, all_blocks, root_block, sequence, strings)
+    started = record_phase(stats, "blocks", started)
 
     build_block_hierarchy(all_blocks, root_block, sequence)
+    started = record_phase(stats, "hierarchy", started)
 
+    block_count = len(all_blocks)
     create_filler_blocks_for_holes(all_blocks, sequence)
 
     remove_sequence_from_parents(all_blocks)
-    remove_start_and_end_of_blocks(all_blocks)
+    record_phase(stats, "fillers", started)
+
+    if stats is not None:
+        add_count(stats, "records", 1)
+        add_count(stats, "features", len(gb.features))
+        add_count(stats, "blocks", len(all_blocks))
+        add_count(stats, "fillers", len(all_blocks) - block_count)
+        add_count(stats, "annotations", sum(len(block.annotations) for block in all_blocks.itervalues()
+                                            if block.annotations is not None))
 
-    return { "root": all_blocks[root_block["id"]], "blocks": all_blocks, "sequence": sequence }
+    return { "root": all_blocks[root_block.id], "blocks": all_blocks, "sequence": sequence }
 
 
+# The part of the project that comes from a single record, as returned by convert_genbank_record_to_blocks
+def record_project_fragment(results):
+    return {
+        "components": [results["root"].id],
+        "name": results["root"].name,
+        "description": results["root"].description
+    }
+
+# Writes the sequence of a record to a file in directory named after its md5, the same hash the sequence storage
+# uses, and leaves only the md5 and the length in the sequence structure (the block ranges stay as they are).
+# Files are written once: if a file for that md5 is already there, it's not written again.
+def externalize_sequence(sequence, directory):
+    sequence_text = sequence.pop("sequence")
+    sequence["md5"] = hashlib.md5(sequence_text).hexdigest()
+    sequence["length"] = len(sequence_text)
+
+    path = os.path.join(directory, sequence["md5"])
+    if not os.path.exists(path):
+        # Write to a temporary file first so nobody reads a half written sequence
+        temp_path = path + "." + str(uuid.uuid4())
+        with open(temp_path, "w") as f:
+            f.write(sequence_text)
+        os.rename(temp_path, path)
+
+def convert_record(record, sequence_dir=None, stats=None):
+    results = convert_genbank_record_to_blocks(record, stats)
+    if sequence_dir is not None:
+        started = time.time()
+        externalize_sequence(results["sequence"], sequence_dir)
+        record_phase(stats, "sequences", started)
+    return results
+
+# Converts the text of a genbank record. Runs in the worker processes when importing in parallel.
+# With collect_stats, the stats of each record (see conversion_stats) come back in its results, under "stats"
+def convert_genbank_text(text, sequence_dir=None, fast_scan=True, collect_stats=False):
+    started = time.time()
+    records = scan_genbank_text(text) if fast_scan else list(SeqIO.parse(StringIO(text), "genbank"))
+    parse_time = time.time() - started
+
+    converted = []
+    for record in records:
+        stats = create_stats() if collect_stats else None
+        results = convert_record(record, sequence_dir, stats)
+        if collect_stats:
+            # The text is parsed all at once, the first record takes the time
+            stats["phases"]["parse"] = parse_time
+            parse_time = 0
+            results["stats"] = stats
+        converted.append(results)
+    return converted
+
+# Converts the records of a genbank file one at a time, yielding the results of each one as soon as it's done.
+# With more than one worker, the records are converted by a pool of that many processes (0 means one per CPU), but
+# still yielded in the order they appear in the file. Files with a single record are always converted here.
+# If sequence_dir is given, sequences are written there instead of being returned (see externalize_sequence)
+# Records are read with the fast scanner in genbank_scanner, unless fast_scan is False
+# If stats are given, the stats of the conversion (see conversion_stats) are added to them
+def convert_genbank_records(filename, workers=1, sequence_dir=None, fast_scan=True, stats=None):
+    if workers == 0:
+        workers = multiprocessing.cpu_count()
+
+    with open(filename, "r") as handle:
+        if workers <= 1:
+            records = iter(scan_genbank_records(handle) if fast_scan else SeqIO.parse(handle, "genbank"))
+            while True:
+                started = time.time()
+                record = next(records, None)
+                if record is None:
+                    return
+                record_phase(stats, "parse", started)
+                yield convert_record(record, sequence_dir, stats)
+
+        texts = split_genbank_records(handle)
+        first_texts = list(itertools.islice(texts, 2))
+        if len(first_texts) < 2:
+            for text in first_texts:
+                for results in convert_genbank_text(text, sequence_dir, fast_scan, stats is not None):
+                    yield collect_record_stats(results, stats)
+            return
+
+        pool = multiprocessing.Pool(workers)
+        add_pool(stats, workers)
+        try:
+            convert_text = functools.partial(convert_genbank_text, sequence_dir=sequence_dir, fast_scan=fast_scan,
+                                             collect_stats=stats is not None)
+            for record_results in pool.imap(convert_text, itertools.chain(first_texts, texts)):
+                for results in record_results:
+                    yield collect_record_stats(results, stats)
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
+
+# Adds the stats that came with the results of a record (see convert_genbank_text) to stats
+def collect_record_stats(results, stats):
+    if "stats" in results:
+        add_stats(stats, results.pop("stats"))
+    return results
+
 # Given a file, create project and blocks structures to import into GD
-def genbank_to_project(filename):
+# The blocks are ImportedBlocks, write the result with json.dump(..., default=imported_block_to_json)
+# If stats are given, the stats of the conversion (see conversion_stats) are added to them
+def genbank_to_project(filename, workers=1, sequence_dir=None, fast_scan=True, stats=None):
     project = { "components": []}
     blocks = {}
     sequences = []
 
-    generator = SeqIO.parse(open(filename,"r"),"genbank")
-    for record in generator:
-        results = convert_genbank_record_to_blocks(record)
+    for results in convert_genbank_records(filename, workers, sequence_dir, fast_scan, stats):
+        fragment = record_project_fragment(results)
 
-        project["components"].append(results["root"]["id"])
-        project["name"] = results["root"]["metadata"]["name"]
-        project["description"] = results["root"]["metadata"]["description"]
+        project["components"].extend(fragment["components"])
+        project["name"] = fragment["name"]
+        project["description"] = fragment["description"]
 
         blocks.update(results["blocks"])
         sequences.append(results["sequence"])
     return { "project": project, "blocks": blocks, "sequences": sequences }
+
+# Same as genbank_to_project, but writes each record to output as soon as it's converted instead of keeping
+# all of them in memory. Each record is a line with a json object { "project", "blocks", "sequence" }, where
+# "project" is the fragment of the project for that record: its components get appended, and the name
+# and description of the last record win.
+# If summary is given, what import_summary would say about the records is added to it, and if stats are given, the
+# stats of the conversion, writing the json included.
+# Returns the number of records written
+def genbank_to_project_stream(filename, output, workers=1, sequence_dir=None, fast_scan=True, summary=None,
+                              stats=None):
+    count = 0
+    for results in convert_genbank_records(filename, workers, sequence_dir, fast_scan, stats):
+        memory_checkpoint("record imported")
+        started = time.time()
+        json.dump({ "project": record_project_fragment(results), "blocks": results["blocks"], "sequence": results["sequence"] }, output,
+                  default=imported_block_to_json)
+        output.write("\n")
+        output.flush()
+        record_phase(stats, "json", started)
+        if summary is not None:
+            add_to_import_summary(summary, results["blocks"], [results["sequence"]])
+        count += 1
+    return count
+
+# What an import generated: the ids it made up for the blocks, and the md5 of the sequences it wrote to files (see
+# externalize_sequence). { "ids": [...], "md5s": [...] }
+def import_summary(project):
+    summary = { "ids": [], "md5s": [] }
+    add_to_import_summary(summary, project["blocks"], project["sequences"])
+    return summary
+
+def add_to_import_summary(summary, blocks, sequences):
+    summary["ids"].extend(blocks.keys())
+    summary["md5s"].extend(sequence["md5"] for sequence in sequences if "md5" in sequence)
+
+block_id_pattern = re.compile(r"[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}")
+
+# Copies the output of an import from source to output, giving new ids to the blocks it made up (ids, see
+# import_summary), so it can be imported again as new blocks
+def copy_with_new_block_ids(source, output, ids):
+    new_ids = dict((block_id, str(uuid.uuid4())) for block_id in ids)
+    def new_id(match):
+        return new_ids.get(match.group(0), match.group(0))
+
+    # An id can be cut between two chunks: what could be the start of one is kept for the next chunk
+    id_length = 36
+    pending = ""
+    for chunk in iter(lambda: source.read(1024 * 1024), ""):
+        text = pending + chunk
+        done = len(text) - id_length + 1
+        position = 0
+        for match in block_id_pattern.finditer(text):
+            if match.start() >= done:
+                break
+            output.write(text[position:match.start()])
+            output.write(new_id(match))
+            position = match.end()
+        if position < done:
+            output.write(text[position:done])
+            position = done
+        pending = text[position:]
+    output.write(block_id_pattern.sub(new_id, pending))
@@ -0,0 +1,221 @@
+import re
+from cStringIO import StringIO
+from Bio import Alphabet
+from Bio import SeqIO
+
+# Fast path to read genbank records on import.
+# Most of the time SeqIO.parse spends on a feature-rich record goes to the feature table, parsing each location and
+# qualifier through Biopython's generic consumer. Here Biopython still reads the header and the sequence (skipping the
+# feature table out, which is cheap), and the feature table is scanned directly into lightweight features that have
+# just what the import uses from a SeqFeature (see ScannedFeature).
+# The scanner only handles simple locations ("12..345", "12" and their complement(...), with fuzzy ends like
+# "<12..>345") and well formed qualifiers. A feature with anything else (a compound or remote location, a qualifier
+# wrapped in an unusual way...) is left in the feature table Biopython reads with the header, so it gets the SeqFeature
+# it would from SeqIO.parse(..., "genbank"). When the layout of the feature table itself is unusual, the whole record is
+# parsed by Biopython.
+
+FEATURE_START_MARKERS = ["FEATURES             Location/Qualifiers", "FEATURES"]
+SEQUENCE_HEADERS = ["CONTIG", "ORIGIN", "BASE COUNT", "WGS"]
+HEADER_WIDTH = 12
+QUALIFIER_INDENT = 21
+QUALIFIER_SPACER = " " * QUALIFIER_INDENT
+
+# Fuzzy ends (<12, >345) are at the same position as exact ones for the import, which only uses the start and the end
+simple_location = re.compile(r"^[<>]?(\d+)\.\.[<>]?(\d+)$")
+simple_complement_location = re.compile(r"^complement\([<>]?(\d+)\.\.[<>]?(\d+)\)$")
+single_base_location = re.compile(r"^(\d+)$")
+single_base_complement_location = re.compile(r"^complement\((\d+)\)$")
+
+# Lightweight stand-ins for Biopython's SeqFeature and FeatureLocation, with just what the import uses.
+# start and end are plain ints (Biopython's positions are int subclasses)
+class ScannedLocation(object):
+    __slots__ = ("start", "end", "strand")
+
+    def __init__(self, start, end, strand):
+        self.start = start
+        self.end = end
+        self.strand = strand
+
+class ScannedFeature(object):
+    __slots__ = ("type", "location", "qualifiers")
+
+    def __init__(self, type, location, qualifiers):
+        self.type = type
+        self.location = location
+        self.qualifiers = qualifiers
+
+    def __len__(self):
+        return self.location.end - self.location.start
+
+# Raised when a feature needs the full Biopython parser
+class UnsupportedFeature(Exception):
+    pass
+
+# Splits a genbank file into the text of each record, without parsing them
+def split_genbank_records(handle):
+    lines = []
+    for line in handle:
+        lines.append(line)
+        if line.startswith("//"):
+            yield "".join(lines)
+            lines = []
+    if "".join(lines).strip():
+        yield "".join(lines)
+
+# Builds a feature from its key and lines (the location line, then the stripped qualifier lines), the same way
+# Biopython's scanner and consumer do for simple features
+def scan_feature(key, lines, default_strand):
+    location = "".join(lines[0].split())
+    strand = default_strand
+    match = simple_location.match(location)
+    if not match:
+        match = simple_complement_location.match(location)
+        strand = -1
+    if match:
+        start = int(match.group(1)) - 1
+        end = int(match.group(2))
+    else:
+        strand = default_strand
+        match = single_base_location.match(location)
+        if not match:
+            match = single_base_complement_location.match(location)
+            strand = -1
+        if not match:
+            raise UnsupportedFeature(location)
+        end = int(match.group(1))
+        start = end - 1
+    if start > end:
+        raise UnsupportedFeature(location)
+
+    qualifiers = {}
+    i = 1
+    count = len(lines)
+    while i < count:
+        line = lines[i]
+        i += 1
+        # Anything that is not the start of a qualifier here is a continuation Biopython would have to sort out
+        if line[0] != "/":
+            raise UnsupportedFeature(line)
+
+        equals = line.find("=")
+        if equals == -1:
+            # Qualifier with no value, e.g. /pseudo
+            if line[1:] not in qualifiers:
+                qualifiers[line[1:]] = [""]
+            continue
+
+        qualifier = line[1:equals]
+        value = line[equals + 1:]
+        if value[:1] == '"':
+            if value == '"':
+                raise UnsupportedFeature(line)
+            # Quoted values go on until the line that ends with a quote
+            if value[-1] != '"':
+                parts = [value]
+                while parts[-1][-1] != '"':
+                    if i == count:
+                        raise UnsupportedFeature(line)
+                    parts.append(lines[i])
+                    i += 1
+                value = " ".join(parts)
+            value = value.replace('"', '')
+
+        if qualifier == "translation":
+            value = "".join(value.split())
+        if qualifier in qualifiers:
+            qualifiers[qualifier].append(value)
+        else:
+            qualifiers[qualifier] = [value]
+
+    return ScannedFeature(key, ScannedLocation(start, end, strand), qualifiers)
+
+# Scans the feature table in the lines of a record.
+# Returns the features, the ranges of lines [start, end) of the features the scanner can't read (None in the features),
+# and the range of lines [start, end) the features took
+def scan_features(lines, default_strand):
+    i = 0
+    while i < len(lines) and lines[i].rstrip() not in FEATURE_START_MARKERS:
+        if lines[i][:HEADER_WIDTH].rstrip() in SEQUENCE_HEADERS:
+            return [], [], i, i
+        i += 1
+    while i < len(lines) and lines[i].rstrip() in FEATURE_START_MARKERS:
+        i += 1
+    start = i
+
+    features = []
+    unsupported = []
+    key = None
+    feature_lines = None
+    feature_start = None
+
+    def add_feature(feature_end):
+        try:
+            features.append(scan_feature(key, feature_lines, default_strand))
+        except UnsupportedFeature:
+            features.append(None)
+            unsupported.append((feature_start, feature_end))
+
+    for end in xrange(start, len(lines)):
+        line = lines[end]
+        if line[:QUALIFIER_INDENT] == QUALIFIER_SPACER:
+            if key is None:
+                raise UnsupportedFeature(line)
+            content = line[QUALIFIER_INDENT:].strip()
+            if content:
+                feature_lines.append(content)
+            continue
+
+        if line[:HEADER_WIDTH].rstrip() in SEQUENCE_HEADERS:
+            break
+        line = line.rstrip()
+        if not line:
+            # Blank lines are ignored, even in the middle of a feature
+            continue
+        if line == "//" or line[2:QUALIFIER_INDENT].strip() == "" or len(line) < QUALIFIER_INDENT or \
+                (line[QUALIFIER_INDENT] != " " and " " in line[QUALIFIER_INDENT:]):
+            raise UnsupportedFeature(line)
+
+        # Start of a new feature
+        if key is not None:
+            add_feature(end)
+        key = line[2:QUALIFIER_INDENT].strip()
+        feature_lines = [line[QUALIFIER_INDENT:]]
+        feature_start = end
+    else:
+        raise UnsupportedFeature("Premature end of features table")
+
+    if key is not None:
+        add_feature(end)
+    return features, unsupported, start, end
+
+# Returns the SeqRecords in the text of a genbank record
+def scan_genbank_text(text):
+    lines = text.split("\n")
+    try:
+        features, unsupported, start, end = scan_features(lines, 1)
+    except UnsupportedFeature:
+        return list(SeqIO.parse(StringIO(text), "genbank"))
+
+    # Biopython reads everything else, with only the features the scanner can't read in the feature table
+    unsupported_lines = [line for feature_start, feature_end in unsupported
+                         for line in lines[feature_start:feature_end]]
+    records = list(SeqIO.parse(StringIO("\n".join(lines[:start] + unsupported_lines + lines[end:])), "genbank"))
+    if len(records) != 1 or len(records[0].features) != len(unsupported):
+        return list(SeqIO.parse(StringIO(text), "genbank"))
+
+    record = records[0]
+    # Biopython doesn't give a strand to the features of protein records
+    if isinstance(record.seq.alphabet, Alphabet.ProteinAlphabet):
+        return list(SeqIO.parse(StringIO(text), "genbank"))
+
+    if unsupported:
+        parsed = iter(record.features)
+        features = [next(parsed) if feature is None else feature for feature in features]
+    record.features = features
+    return [record]
+
+# Replacement for SeqIO.parse(handle, "genbank") on import
+def scan_genbank_records(handle):
+    for text in split_genbank_records(handle):
+        for record in scan_genbank_text(text):
+            yield record
@@ -0,0 +1,13 @@
+import path from 'path';
+import { execFile } from 'child_process';
+
+describe('DB', () => {
+  //the tests of DB.py are in ./test_db.py
+  it('should pass the tests of DB.py', function pythonTests(done) {
+    this.timeout(60000);
+    execFile('python', ['-m', 'unittest', 'discover', '-p', 'test_*.py'], {
+      cwd: __dirname,
+      maxBuffer: 10 * 1024 * 1024,
+    }, (err, stdout, stderr) => done(err ? new Error('DB.py tests failed:\n' + stderr) : undefined));
+  });
+});
@@ -0,0 +1,135 @@
+import json
+import os
+import pickle
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+
+# Tests of DB.py, run as it's run: a process of its own in the directory of the database (see db.spec.js)
+
+DB_SCRIPT = os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "DB.py"))
+
+class DBTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+    def db(self, *arguments, **kwargs):
+        process = subprocess.Popen([sys.executable, DB_SCRIPT] + list(arguments), cwd=self.directory,
+                                   stdin=subprocess.PIPE, stdout=subprocess.PIPE, universal_newlines=True)
+        output, _ = process.communicate(kwargs.get("input"))
+        self.assertEqual(process.returncode, 0)
+        return output
+
+    def path(self, name):
+        return os.path.join(self.directory, name)
+
+    def test_get_and_set_print_what_they_used_to(self):
+        self.assertEqual(self.db("SET", "block", '{"name":"promoter","components":[1, 2]}'), "")
+        self.assertEqual(json.loads(self.db("GET", "block")), { "name": "promoter", "components": [1, 2] })
+        self.assertEqual(self.db("SET", "list", '[1,"two",null]'), "")
+        self.assertEqual(self.db("GET", "list"), '[1, "two", null]\n')
+        self.assertEqual(self.db("GET", "missing"), "null\n")
+        self.db("SET", "list", '"replaced"')
+        self.assertEqual(self.db("GET", "list"), '"replaced"\n')
+
+    def test_migrates_the_pickled_store(self):
+        # Set before the pickle shows up, so it's newer than what's in it
+        self.db("SET", "kept", '"newer"')
+        with open(self.path("db.p"), "wb") as handle:
+            pickle.dump({ "a": { "x": 1 }, "b": [1, 2], "kept": "older" }, handle)
+
+        self.assertEqual(self.db("GET", "a"), '{"x": 1}\n')
+        self.assertEqual(self.db("GET", "b"), "[1, 2]\n")
+        self.assertEqual(self.db("GET", "kept"), '"newer"\n')
+        self.assertFalse(os.path.exists(self.path("db.p")))
+        self.assertTrue(os.path.exists(self.path("db.p.migrated")))
+
+    def test_moves_away_a_pickle_that_cannot_be_read(self):
+        for number, contents in enumerate([b"", b"(dp0\nS'a'\np1\n", b"not a pickle"]):
+            key = "key%d" % number
+            with open(self.path("db.p"), "wb") as handle:
+                handle.write(contents)
+
+            process = subprocess.Popen([sys.executable, DB_SCRIPT, "GET", key], cwd=self.directory,
+                                       stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+            output, errors = process.communicate()
+            self.assertEqual(process.returncode, 0)
+            self.assertEqual(output, "null\n")
+            self.assertIn("db.p.corrupt", errors)
+            self.assertFalse(os.path.exists(self.path("db.p")))
+            with open(self.path("db.p.corrupt"), "rb") as handle:
+                self.assertEqual(handle.read(), contents)
+
+            # And it's usable from then on
+            self.db("SET", key, "1")
+            self.assertEqual(self.db("GET", key), "1\n")
+            os.remove(self.path("db.p.corrupt"))
+
+    def test_migrates_once_with_processes_starting_together(self):
+        with open(self.path("db.p"), "wb") as handle:
+            pickle.dump(dict(("key%d" % i, i) for i in range(5000)), handle)
+        processes = [subprocess.Popen([sys.executable, DB_SCRIPT, "GET", "key7"], cwd=self.directory,
+                                      stdout=subprocess.PIPE, universal_newlines=True) for _ in range(4)]
+        for process in processes:
+            output, _ = process.communicate()
+            self.assertEqual(process.returncode, 0)
+            self.assertEqual(output, "7\n")
+
+    def test_mget_and_mset(self):
+        self.db("MSET", input='{"a": 1, "b": {"c": [2]}}')
+        self.assertEqual(json.loads(self.db("MGET", input='["a", "b", "missing"]')),
+                         { "a": 1, "b": { "c": [2] }, "missing": None })
+
+    def test_pages_of_a_prefix_scan(self):
+        self.db("MSET", input=json.dumps(dict(("project1/block%d" % i, i) for i in range(5))))
+        self.db("MSET", input='{"project10/block": 10, "project2/block": 20, "project1": 1}')
+
+        # 5 entries in pages of 2, the last one alone
+        first = json.loads(self.db("PREFIX", "project1/", "2"))
+        self.assertEqual(first, { "entries": [["project1/block0", 0], ["project1/block1", 1]],
+                                  "next": "project1/block1" })
+        second = json.loads(self.db("PREFIX", "project1/", "2", first["next"]))
+        self.assertEqual(second, { "entries": [["project1/block2", 2], ["project1/block3", 3]],
+                                   "next": "project1/block3" })
+        third = json.loads(self.db("PREFIX", "project1/", "2", second["next"]))
+        self.assertEqual(third, { "entries": [["project1/block4", 4]], "next": None })
+
+        # A last page that's full doesn't have a next one
+        self.assertEqual(json.loads(self.db("PREFIX", "project1/", "5"))["next"], None)
+
+    def test_range_scan(self):
+        self.db("MSET", input='{"a": 1, "b": 2, "c": 3, "d": 4}')
+        self.assertEqual(json.loads(self.db("RANGE", "b", "d")), { "entries": [["b", 2], ["c", 3]], "next": None })
+        self.assertEqual(json.loads(self.db("RANGE", "", "b")), { "entries": [["a", 1]], "next": None })
+        self.assertEqual(json.loads(self.db("RANGE", "c", "")), { "entries": [["c", 3], ["d", 4]], "next": None })
+
+    def test_server_sees_writes_of_other_processes(self):
+        self.db("SET", "shared", '"before"')
+        server = subprocess.Popen([sys.executable, DB_SCRIPT, "SERVE"], cwd=self.directory,
+                                  stdin=subprocess.PIPE, stdout=subprocess.PIPE, universal_newlines=True)
+
+        def request(request):
+            server.stdin.write(json.dumps(request) + "\n")
+            server.stdin.flush()
+            return json.loads(server.stdout.readline())
+
+        try:
+            self.assertEqual(request({ "id": 1, "command": "GET", "key": "shared" }),
+                             { "id": 1, "success": True, "result": "before" })
+            # Read again, from the cache
+            self.assertEqual(request({ "id": 2, "command": "GET", "key": "shared" })["result"], "before")
+            self.db("SET", "shared", '"after"')
+            self.assertEqual(request({ "id": 3, "command": "MGET", "keys": ["shared"] })["result"],
+                             { "shared": "after" })
+            self.assertEqual(request({ "id": 4, "command": "SET", "key": "shared", "value": "mine" })["success"], True)
+            self.assertEqual(self.db("GET", "shared"), '"mine"\n')
+            self.assertEqual(request({ "id": 5, "command": "NOPE" })["success"], False)
+        finally:
+            server.stdin.close()
+            server.wait()
+
+if __name__ == "__main__":
+    unittest.main()
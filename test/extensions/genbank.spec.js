@@ -1,6 +1,7 @@
 import { assert, expect } from 'chai';
 import path from 'path';
 import fs from 'fs';
+import { execFile } from 'child_process';
 import _ from 'lodash';
 import JSZip from 'jszip';
 import { importProject, exportProject, exportConstruct } from '../../server/extensions/native/genbank/convert';
@@ -221,5 +222,14 @@ describe('Extensions', () => {
           assert(end[0] - 20 < start[0], 'should take less than 20 seconds (this is very long)');
         });
     });
+
+    //the python tests of the converter are in ./genbank (test_*.py)
+    it('should pass the tests of the python converter', function pythonTests(done) {
+      this.timeout(300000);
+      execFile('python', ['-m', 'unittest', 'discover', '-p', 'test_*.py'], {
+        cwd: path.resolve(__dirname, 'genbank'),
+        maxBuffer: 10 * 1024 * 1024,
+      }, (err, stdout, stderr) => done(err ? new Error('Python converter tests failed:\n' + stderr) : undefined));
+    });
   });
 });
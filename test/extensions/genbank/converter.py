@@ -0,0 +1,69 @@
+import itertools
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import uuid
+
+# Shared by the tests of the python GenBank converter (server/extensions/native/genbank), which run with
+# python -m unittest discover (see genbank.spec.js)
+
+TEST_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT_DIR = os.path.abspath(os.path.join(TEST_DIR, "..", "..", ".."))
+CONVERTER_DIR = os.path.join(ROOT_DIR, "server", "extensions", "native", "genbank")
+RES_DIR = os.path.join(ROOT_DIR, "test", "res")
+EXPECTED_DIR = os.path.join(TEST_DIR, "expected")
+
+sys.path.insert(0, CONVERTER_DIR)
+
+# The GenBank files of test/res, and the ones next to the tests
+def genbank_fixtures():
+    fixtures = [os.path.join(RES_DIR, name) for name in sorted(os.listdir(RES_DIR))
+                if name.endswith(".gb") and name != "badFormatGenbank.gb"]
+    fixtures.extend(os.path.join(TEST_DIR, name) for name in sorted(os.listdir(TEST_DIR)) if name.endswith(".gb"))
+    return fixtures
+
+# Makes uuid.uuid4 give the same ids, in the same order, every time it's called after this, so the ids the import
+# makes up are always the same. Returns the function to call to undo it.
+def seed_uuids():
+    original = uuid.uuid4
+    counter = itertools.count()
+    uuid.uuid4 = lambda: uuid.UUID(int=(next(counter) * 2654435761) % (1 << 128))
+
+    def restore():
+        uuid.uuid4 = original
+    return restore
+
+# Runs convert.py with arguments in a process of its own, and returns its output
+def run_convert(*arguments):
+    return subprocess.check_output([sys.executable, os.path.join(CONVERTER_DIR, "convert.py")] + list(arguments),
+                                   stderr=subprocess.STDOUT)
+
+def load_json(filename):
+    with open(filename, "r") as handle:
+        return json.load(handle)
+
+# The import with its block ids replaced by names given in the order the blocks are found going down from the project,
+# so imports that only differ in their ids are the same
+def without_ids(imported):
+    names = {}
+
+    def name_blocks(ids):
+        for block_id in ids:
+            if block_id not in names:
+                names[block_id] = "block%d" % len(names)
+                name_blocks(imported["blocks"][block_id]["components"])
+    name_blocks(imported["project"]["components"])
+
+    text = json.dumps(imported, sort_keys=True)
+    for block_id, name in names.items():
+        text = text.replace('"%s"' % block_id, '"%s"' % name)
+    return json.loads(text)
+
+# A temporary directory for a test, removed when the test is done
+def temporary_directory(test):
+    directory = tempfile.mkdtemp()
+    test.addCleanup(shutil.rmtree, directory)
+    return directory
@@ -0,0 +1,44 @@
+import os
+import unittest
+from converter import RES_DIR, TEST_DIR, load_json, run_convert, temporary_directory, without_ids
+
+# Converting the same thing twice with --cache-dir: the second time comes from the cache (see conversion_cache.py)
+
+class CacheTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = temporary_directory(self)
+        self.cache_dir = os.path.join(self.directory, "cache")
+
+    def output(self, name):
+        return os.path.join(self.directory, name)
+
+    def convert_cached(self, conversion, input_file, output):
+        run_convert(conversion, input_file, output, "--cache-dir", self.cache_dir, "--stats")
+        return load_json(output + ".stats.json")["cache"]
+
+    def test_import_is_cached_with_new_ids(self):
+        genbank = os.path.join(RES_DIR, "sampleGenbankSimpleNested.gb")
+        self.assertEqual(self.convert_cached("from_genbank", genbank, self.output("first.json")), "miss")
+        self.assertEqual(self.convert_cached("from_genbank", genbank, self.output("second.json")), "hit")
+        self.assertEqual(load_json(os.path.join(self.cache_dir, "import", "stats.json"))["hits"], 1)
+
+        first = load_json(self.output("first.json"))
+        second = load_json(self.output("second.json"))
+        self.assertEqual(len(first["blocks"]), len(second["blocks"]))
+        self.assertFalse(set(first["blocks"]) & set(second["blocks"]))
+        for imported in [first, second]:
+            for block_id, block in imported["blocks"].items():
+                self.assertEqual(block["id"], block_id)
+        self.assertEqual(without_ids(first), without_ids(second))
+
+    def test_export_is_cached(self):
+        project = os.path.join(TEST_DIR, "listBlockProject.json")
+        self.assertEqual(self.convert_cached("to_genbank", project, self.output("first.zip")), "miss")
+        self.assertEqual(self.convert_cached("to_genbank", project, self.output("second.zip")), "hit")
+        self.assertEqual(load_json(os.path.join(self.cache_dir, "export", "stats.json"))["hits"], 1)
+        with open(self.output("first.zip"), "rb") as first:
+            with open(self.output("second.zip"), "rb") as second:
+                self.assertEqual(first.read(), second.read())
+
+if __name__ == "__main__":
+    unittest.main()
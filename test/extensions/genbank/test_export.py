@@ -0,0 +1,138 @@
+import json
+import os
+import unittest
+import zipfile
+from converter import EXPECTED_DIR, TEST_DIR, load_json, run_convert, temporary_directory
+from genbank_export import export_project
+
+# convert.py to_genbank --dry-run and --range, and export_project with workers, on listBlockProject.json: a construct
+# with a list block of 3 options and another of 2 (6 combinations), and a construct without list blocks
+# The files exported are the same, byte for byte, as the ones the export made before it wrote the features and the
+# sequence of the records itself (expected/<project>.gb, and expected/listBlockProject/ for the files of the zip).
+# hierarchyCasesProject.json and sampleMultiGenbankProject.json are the imports of hierarchyCases.gb and
+# test/res/sampleMultiGenbank.gb, as the export gets them.
+
+LIST_BLOCK_PROJECT = os.path.join(TEST_DIR, "listBlockProject.json")
+
+def zip_contents(filename):
+    with zipfile.ZipFile(filename) as archive:
+        return dict((name, archive.read(name)) for name in archive.namelist())
+
+# The files of a zip file, in order: [(name, contents)]
+def zip_entries(filename):
+    with zipfile.ZipFile(filename) as archive:
+        return [(name, archive.read(name)) for name in archive.namelist()]
+
+class ExportTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = temporary_directory(self)
+
+    def output(self, name):
+        return os.path.join(self.directory, name)
+
+    # The project with the options of its list blocks removed
+    def project_without_options(self):
+        project = load_json(LIST_BLOCK_PROJECT)
+        for block in project["blocks"]:
+            block["options"] = {}
+        filename = self.output("noOptions.json")
+        with open(filename, "w") as output:
+            json.dump(project, output)
+        return filename
+
+    def read_output(self, name):
+        with open(self.output(name), "rb") as handle:
+            return handle.read()
+
+    def test_records_are_the_same_as_before(self):
+        for name in ["hierarchyCases", "sampleMultiGenbank"]:
+            run_convert("to_genbank", os.path.join(TEST_DIR, name + "Project.json"), self.output(name + ".gb"))
+            with open(os.path.join(EXPECTED_DIR, name + ".gb"), "rb") as expected:
+                self.assertEqual(self.read_output(name + ".gb"), expected.read())
+
+    def test_combinations_are_the_same_as_before(self):
+        run_convert("to_genbank", LIST_BLOCK_PROJECT, self.output("full.zip"))
+        expected_dir = os.path.join(EXPECTED_DIR, "listBlockProject")
+        expected = {}
+        for name in os.listdir(expected_dir):
+            with open(os.path.join(expected_dir, name), "rb") as handle:
+                expected[name] = handle.read()
+        self.assertEqual(zip_contents(self.output("full.zip")), expected)
+
+    # Exports the combinations start to stop - 1 of listBlockProject.json with export_project, in this process
+    def export_list_blocks(self, name, workers, start=0, stop=None):
+        project = load_json(LIST_BLOCK_PROJECT)
+        stats = {}
+        export_project(self.output(name), project["project"], project["blocks"], workers, start, stop, stats)
+        self.assertEqual(stats.get("pool_workers"), workers if workers > 1 else None)
+        return zip_entries(self.output(name))
+
+    def test_workers_export_the_same_files(self):
+        serial = self.export_list_blocks("serial.zip", 1)
+        self.assertEqual(len(serial), 7)
+        for workers in [2, 3]:
+            self.assertEqual(self.export_list_blocks("parallel%d.zip" % workers, workers), serial)
+
+        # Ranges exported by workers add up to the whole export, in the same order
+        slices = [self.export_list_blocks("slice%d.zip" % index, 2, start, stop)
+                  for index, (start, stop) in enumerate([(0, 3), (3, 5), (5, None)])]
+        self.assertEqual([len(entries) for entries in slices], [3, 2, 2])
+        self.assertEqual(sum(slices, []), serial)
+
+    def test_dry_run_counts_the_combinations(self):
+        run_convert("to_genbank", LIST_BLOCK_PROJECT, self.output("count.json"), "--dry-run")
+        self.assertEqual(load_json(self.output("count.json")), {
+            "zip": True,
+            "total": 7,
+            "constructs": [
+                { "id": "library", "name": "Library", "count": 6 },
+                { "id": "plain", "name": "Plain", "count": 1 }
+            ]
+        })
+
+    def test_dry_run_matches_the_export(self):
+        run_convert("to_genbank", LIST_BLOCK_PROJECT, self.output("count.json"), "--dry-run")
+        run_convert("to_genbank", LIST_BLOCK_PROJECT, self.output("full.zip"))
+        self.assertEqual(len(zip_contents(self.output("full.zip"))), load_json(self.output("count.json"))["total"])
+
+    def test_ranges_add_up_to_the_full_export(self):
+        run_convert("to_genbank", LIST_BLOCK_PROJECT, self.output("full.zip"))
+        run_convert("to_genbank", LIST_BLOCK_PROJECT, self.output("first.zip"), "--range", "0:2")
+        run_convert("to_genbank", LIST_BLOCK_PROJECT, self.output("rest.zip"), "--range", "2:")
+
+        full = zip_contents(self.output("full.zip"))
+        first = zip_contents(self.output("first.zip"))
+        rest = zip_contents(self.output("rest.zip"))
+        self.assertEqual(sorted(first), ["List blocks - Library - 1.gb", "List blocks - Library - 2.gb"])
+        self.assertEqual(len(rest), 5)
+        combined = dict(first)
+        combined.update(rest)
+        self.assertEqual(combined, full)
+
+    def test_project_without_options(self):
+        project = self.project_without_options()
+        run_convert("to_genbank", project, self.output("count.json"), "--dry-run")
+        self.assertEqual(load_json(self.output("count.json")), {
+            "zip": False,
+            "total": 2,
+            "constructs": [
+                { "id": "library", "name": "Library", "count": 1 },
+                { "id": "plain", "name": "Plain", "count": 1 }
+            ]
+        })
+
+        run_convert("to_genbank", project, self.output("full.gb"))
+        self.assertFalse(zipfile.is_zipfile(self.output("full.gb")))
+        with open(self.output("full.gb"), "r") as handle:
+            records = handle.read()
+        self.assertEqual(records.count("LOCUS"), 2)
+
+        # A range of records of the single file
+        run_convert("to_genbank", project, self.output("second.gb"), "--range", "1:")
+        with open(self.output("second.gb"), "r") as handle:
+            second = handle.read()
+        self.assertEqual(second.count("LOCUS"), 1)
+        self.assertTrue(records.endswith(second))
+
+if __name__ == "__main__":
+    unittest.main()
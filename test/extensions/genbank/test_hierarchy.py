@@ -0,0 +1,87 @@
+import hashlib
+import json
+import os
+import random
+import time
+import unittest
+from converter import EXPECTED_DIR, RES_DIR, TEST_DIR, load_json, seed_uuids
+from genbank_import import ImportedBlock, build_block_hierarchy, genbank_to_project, imported_block_to_json
+
+# The projects the import makes of the fixtures, with seeded ids, are the same the importer made before the block
+# hierarchy was built with the interval index of find_containers (expected/<fixture>.json).
+# hierarchyCases.gb has features inside others, with the same range, partially overlapping, adjacent and of length 0.
+
+# Fixtures too big to keep the whole project of: the sha1 of the project instead (see project_digest)
+EXPECTED_DIGESTS = {
+    "chromosome": "2c2f82bb1a25e26aeeb569e82e54f7eeb8533ce0"
+}
+
+def import_fixture(filename):
+    restore = seed_uuids()
+    try:
+        project = genbank_to_project(filename)
+    finally:
+        restore()
+    return json.loads(json.dumps(project, default=imported_block_to_json))
+
+def project_digest(project):
+    return hashlib.sha1(json.dumps(project, sort_keys=True)).hexdigest()
+
+# A construct with count features side by side, none inside another, in random order of length: all of them end up
+# as children of the root, each inserted among the ones shorter than it
+def wide_construct(count):
+    generator = random.Random(count)
+    root_block = ImportedBlock("root")
+    all_blocks = { root_block.id: root_block }
+    position = 0
+    for k in range(count):
+        block = ImportedBlock("block%d" % k)
+        block.start = position
+        block.length = generator.randint(1, 30)
+        block.end = position + block.length
+        all_blocks[block.id] = block
+        position = block.end + generator.randint(0, 3)
+    root_block.end = root_block.length = position
+    return root_block, all_blocks
+
+# The seconds it takes to build the hierarchy of wide_construct(count), the best of a few times
+def wide_hierarchy_time(test, count, times=2):
+    best = None
+    for _ in range(times):
+        root_block, all_blocks = wide_construct(count)
+        started = time.time()
+        build_block_hierarchy(all_blocks, root_block, { "blocks": dict.fromkeys(all_blocks) })
+        elapsed = time.time() - started
+        best = elapsed if best is None else min(best, elapsed)
+
+        children = [all_blocks[child_id] for child_id in root_block.components]
+        test.assertEqual(len(children), count)
+        test.assertTrue(all(before.end <= after.start for before, after in zip(children, children[1:])))
+    return best
+
+class HierarchyTest(unittest.TestCase):
+    def assert_same_import(self, filename):
+        name = os.path.splitext(os.path.basename(filename))[0]
+        self.assertEqual(import_fixture(filename), load_json(os.path.join(EXPECTED_DIR, name + ".json")))
+
+    def test_sample_fixtures(self):
+        for name in ["sampleGenbank", "sampleGenbankContiguous", "sampleGenbankContiguousWithHoles",
+                     "sampleGenbankSimpleNested", "sampleMultiGenbank"]:
+            self.assert_same_import(os.path.join(RES_DIR, name + ".gb"))
+
+    def test_overlaps_and_zero_length_features(self):
+        self.assert_same_import(os.path.join(TEST_DIR, "hierarchyCases.gb"))
+
+    def test_chromosome(self):
+        project = import_fixture(os.path.join(RES_DIR, "chromosome.gb"))
+        self.assertEqual(project_digest(project), EXPECTED_DIGESTS["chromosome"])
+
+    # Inserting each child used to copy the siblings after it, which took minutes for a couple hundred thousand.
+    # With 4 times the children it takes about 4 times as long now (a bit more, it's O(n log n)), and 16 times before.
+    def test_wide_construct_scales(self):
+        small = wide_hierarchy_time(self, 15000)
+        large = wide_hierarchy_time(self, 60000)
+        self.assertLess(large / small, 9, "4 times the children took %.1f times as long" % (large / small))
+
+if __name__ == "__main__":
+    unittest.main()
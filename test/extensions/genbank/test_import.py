@@ -0,0 +1,78 @@
+import hashlib
+import json
+import os
+import re
+import unittest
+from converter import RES_DIR, load_json, run_convert, temporary_directory, without_ids
+
+# convert.py from_genbank with the options that change how the import is done, not what it makes of the file
+
+MULTI_GENBANK = os.path.join(RES_DIR, "sampleMultiGenbank.gb")
+
+# The names the server gives the files of the sequences it stores: the md5 of the sequence (see validRealMd5 in
+# src/utils/sequenceMd5.js and sequenceWrite in server/data/persistence/sequence.js)
+SEQUENCE_FILE_NAME = re.compile("^[a-f0-9]{32}$")
+
+class ImportTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = temporary_directory(self)
+
+    def output(self, name):
+        return os.path.join(self.directory, name)
+
+    # Imports a file with convert.py and the arguments given. Returns the import and its stats.
+    def convert(self, input_file, name, *arguments):
+        run_convert("from_genbank", input_file, self.output(name), "--stats", *arguments)
+        return load_json(self.output(name)), load_json(self.output(name) + ".stats.json")
+
+    def test_workers_import_the_same_project(self):
+        serial, serial_stats = self.convert(MULTI_GENBANK, "serial.json")
+        parallel, parallel_stats = self.convert(MULTI_GENBANK, "parallel.json", "--workers", "2")
+        self.assertNotIn("pool_workers", serial_stats)
+        self.assertEqual(parallel_stats["pool_workers"], 2)
+        self.assertEqual(len(serial["project"]["components"]), 3)
+        self.assertEqual(without_ids(parallel), without_ids(serial))
+
+    def test_stream_adds_up_to_the_project(self):
+        project, _ = self.convert(MULTI_GENBANK, "project.json")
+        run_convert("from_genbank", MULTI_GENBANK, self.output("stream.json"), "--stream")
+        with open(self.output("stream.json"), "r") as handle:
+            records = [json.loads(line) for line in handle]
+        self.assertEqual(len(records), 3)
+
+        # Put together as genbank_to_project_stream says: the components are appended, the last name and description win
+        streamed = { "project": { "components": [] }, "blocks": {}, "sequences": [] }
+        for record in records:
+            streamed["project"]["components"].extend(record["project"]["components"])
+            streamed["project"]["name"] = record["project"]["name"]
+            streamed["project"]["description"] = record["project"]["description"]
+            streamed["blocks"].update(record["blocks"])
+            streamed["sequences"].append(record["sequence"])
+        self.assertEqual(without_ids(streamed), without_ids(project))
+
+    def test_sequence_dir_holds_the_sequences(self):
+        project, _ = self.convert(MULTI_GENBANK, "project.json")
+        sequence_dir = self.output("sequences")
+        externalized, _ = self.convert(MULTI_GENBANK, "externalized.json", "--sequence-dir", sequence_dir)
+
+        # A file for each different sequence, named the way the server names them
+        sequences = {}
+        for name in os.listdir(sequence_dir):
+            self.assertRegexpMatches(name, SEQUENCE_FILE_NAME)
+            with open(os.path.join(sequence_dir, name), "r") as handle:
+                sequences[name] = handle.read()
+            self.assertEqual(hashlib.md5(sequences[name]).hexdigest(), name)
+        self.assertEqual(set(sequences.values()), set(sequence["sequence"] for sequence in project["sequences"]))
+
+        # The project has their md5 and length instead of the sequences, and the same ranges for the blocks
+        for sequence in externalized["sequences"]:
+            self.assertNotIn("sequence", sequence)
+            self.assertEqual(sequence["length"], len(sequences[sequence["md5"]]))
+        for sequence in project["sequences"]:
+            text = sequence.pop("sequence")
+            sequence["md5"] = hashlib.md5(text).hexdigest()
+            sequence["length"] = len(text)
+        self.assertEqual(without_ids(externalized), without_ids(project))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,47 @@
+import os
+import pstats
+import unittest
+from converter import RES_DIR, TEST_DIR, run_convert, temporary_directory
+
+# convert.py --profile-dir: the files of each kind of profile (see conversion_profile.py)
+
+class ProfileTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = temporary_directory(self)
+        self.profile_dir = os.path.join(self.directory, "profiles")
+
+    def output(self, name):
+        return os.path.join(self.directory, name)
+
+    def profile(self, name):
+        return os.path.join(self.profile_dir, name)
+
+    def test_cpu_profile(self):
+        run_convert("from_genbank", os.path.join(RES_DIR, "sampleGenbank.gb"), self.output("sample.json"),
+                    "--profile-dir", self.profile_dir)
+        self.assertEqual(sorted(os.listdir(self.profile_dir)),
+                         ["from_genbank-sample.json.prof", "from_genbank-sample.json.prof.txt"])
+        stats = pstats.Stats(self.profile("from_genbank-sample.json.prof"))
+        self.assertTrue(any(function == "genbank_to_project" for _, _, function in stats.stats))
+        with open(self.profile("from_genbank-sample.json.prof.txt"), "r") as handle:
+            self.assertIn("genbank_to_project", handle.read())
+
+    def test_memory_profile(self):
+        run_convert("from_genbank", os.path.join(RES_DIR, "sampleMultiGenbank.gb"), self.output("multi.json"),
+                    "--stream", "--profile-dir", self.profile_dir, "--profile", "memory")
+        self.assertEqual(os.listdir(self.profile_dir), ["from_genbank-multi.json.memory.txt"])
+        with open(self.profile("from_genbank-multi.json.memory.txt"), "r") as handle:
+            lines = handle.read().splitlines()
+        self.assertTrue(lines[0].startswith("Peak resident memory: "))
+        # A line for each checkpoint, the 3 records imported in one
+        checkpoints = [line.split(None, 3)[3] for line in lines[3:]]
+        self.assertEqual(checkpoints, ["start", "record imported (3 times)", "end"])
+
+    def test_both_profiles_of_an_export(self):
+        run_convert("to_genbank", os.path.join(TEST_DIR, "listBlockProject.json"), self.output("list.zip"),
+                    "--profile-dir", self.profile_dir, "--profile", "cpu,memory")
+        self.assertEqual(sorted(os.listdir(self.profile_dir)),
+                         ["to_genbank-list.zip.memory.txt", "to_genbank-list.zip.prof", "to_genbank-list.zip.prof.txt"])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,51 @@
+import json
+import os
+import unittest
+from Bio.SeqFeature import CompoundLocation
+from converter import RES_DIR, TEST_DIR, genbank_fixtures, seed_uuids
+from genbank_import import genbank_to_project, imported_block_to_json
+from genbank_scanner import ScannedFeature, scan_genbank_records
+
+# Importing with the fast scanner of genbank_scanner gives the same json as importing with Biopython's parser
+# (--full-parse), for every GenBank fixture.
+# locationCases.gb has features with the locations and qualifiers the scanner reads, and with those it leaves to
+# Biopython, side by side.
+
+def import_json(filename, fast_scan):
+    restore = seed_uuids()
+    try:
+        project = genbank_to_project(filename, fast_scan=fast_scan)
+    finally:
+        restore()
+    return json.dumps(project, default=imported_block_to_json, sort_keys=True)
+
+class ScannerTest(unittest.TestCase):
+    def test_same_import_as_full_parse(self):
+        for filename in genbank_fixtures():
+            self.assertEqual(import_json(filename, True), import_json(filename, False),
+                             os.path.basename(filename) + " imports differently with the fast scanner")
+
+    def scan(self, filename):
+        with open(filename, "r") as handle:
+            records = list(scan_genbank_records(handle))
+        self.assertEqual(len(records), 1)
+        return records[0]
+
+    def test_only_the_features_the_scanner_cannot_read_go_to_biopython(self):
+        record = self.scan(os.path.join(TEST_DIR, "locationCases.gb"))
+        labels = [(feature.qualifiers.get("label") or feature.qualifiers["note"])[0] for feature in record.features
+                  if not isinstance(feature, ScannedFeature)]
+        self.assertEqual(labels, ["join with fuzzy ends", "complement join", "order wrapped", "within position",
+                                  "zero length", "unusual continuation"])
+        self.assertEqual(len(record.features), 11)
+
+    # Most of the features of chromosome.gb have fuzzy ends, which the scanner reads, and some are joins
+    def test_chromosome_takes_the_fast_path(self):
+        record = self.scan(os.path.join(RES_DIR, "chromosome.gb"))
+        parsed = [feature for feature in record.features if not isinstance(feature, ScannedFeature)]
+        self.assertEqual(len(record.features), 3368)
+        self.assertEqual(len(parsed), 143)
+        self.assertTrue(all(isinstance(feature.location, CompoundLocation) for feature in parsed))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,181 @@
+import json
+import os
+import select
+import subprocess
+import sys
+import time
+import unittest
+from converter import CONVERTER_DIR, RES_DIR, load_json, temporary_directory
+
+# The protocol of conversion_server.py: the jobs written to the server's stdin and their results on its stdout.
+# Most of the tests serve a fake conversion, so jobs take as long as they say: "copy" writes its input to its output
+# after sleeping options["seconds"], and "fail" raises. With options["stubborn"], the job ignores SIGTERM.
+
+FAKE_SERVER = """
+import signal, sys, time
+sys.path.insert(0, %r)
+from conversion_server import serve
+
+def convert(conversion, input, output, seconds=0, stubborn=False):
+    if stubborn:
+        signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    time.sleep(seconds)
+    if conversion == "fail":
+        raise ValueError("failed on purpose")
+    with open(output, "w") as handle:
+        handle.write(input)
+
+serve(convert, int(sys.argv[1]), None, ["copy", "fail"])
+""" % CONVERTER_DIR
+
+class ServerTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = temporary_directory(self)
+
+    def start_server(self, command):
+        # What the server and the jobs print is of no interest here
+        errors = open(os.devnull, "w")
+        self.addCleanup(errors.close)
+        self.server = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=errors)
+        self.addCleanup(self.stop_server)
+
+    def start_fake_server(self, max_jobs=2):
+        self.start_server([sys.executable, "-c", FAKE_SERVER, str(max_jobs)])
+
+    def stop_server(self):
+        if self.server.poll() is None:
+            self.server.kill()
+            self.server.wait()
+
+    def send(self, request):
+        line = request if isinstance(request, str) else json.dumps(request)
+        self.server.stdin.write(line + "\n")
+        self.server.stdin.flush()
+
+    def job(self, job_id, seconds=0, conversion="copy", stubborn=False, **fields):
+        job = { "id": job_id, "conversion": conversion, "input": "from " + str(job_id),
+                "output": self.output(str(job_id)), "options": { "seconds": seconds, "stubborn": stubborn } }
+        job.update(fields)
+        return job
+
+    def output(self, name):
+        return os.path.join(self.directory, name)
+
+    # The next result the server writes, waiting for it up to timeout seconds
+    def result(self, timeout=10):
+        ready, _, _ = select.select([self.server.stdout], [], [], timeout)
+        self.assertTrue(ready, "No result in %s seconds" % timeout)
+        line = self.server.stdout.readline()
+        self.assertTrue(line, "The server closed its output")
+        return json.loads(line)
+
+    # Closes the server's input, and waits for it to finish the jobs it has and exit
+    def finish(self, timeout=20):
+        self.server.stdin.close()
+        deadline = time.time() + timeout
+        while self.server.poll() is None and time.time() < deadline:
+            time.sleep(0.05)
+        self.assertEqual(self.server.poll(), 0)
+        return [json.loads(line) for line in self.server.stdout.read().splitlines()]
+
+    def test_results_of_jobs(self):
+        self.start_fake_server()
+        self.send(self.job("slow", seconds=0.5))
+        self.send(self.job(2))
+        self.send(self.job("broken", conversion="fail"))
+
+        results = [self.result(), self.result(), self.result()]
+        self.assertEqual(results[0], { "id": 2, "success": True })
+        self.assertEqual(sorted(result["id"] for result in results), [2, "broken", "slow"])
+        broken = [result for result in results if result["id"] == "broken"][0]
+        self.assertFalse(broken["success"])
+        self.assertIn("failed on purpose", broken["error"])
+        with open(self.output("slow"), "r") as handle:
+            self.assertEqual(handle.read(), "from slow")
+        self.assertEqual(self.finish(), [])
+
+    def test_malformed_requests(self):
+        self.start_fake_server()
+        self.send(self.job("running", seconds=1))
+        self.send("not json")
+        self.send("[1, 2]")
+        self.send({ "cancel": ["not", "an", "id"] })
+        self.send(self.job("no timeout", timeout="soon"))
+        self.send(self.job("negative timeout", timeout=-1))
+        self.send(self.job("unknown", conversion="to_fasta"))
+        self.send(self.job("no input", input=None))
+        self.send(self.job("bad options", options=[1]))
+        self.send(self.job(["a", "list"]))
+        self.send({ "conversion": "copy" })
+
+        errors = [self.result() for _ in range(7)]
+        self.assertEqual([error["id"] for error in errors],
+                         ["no timeout", "negative timeout", "unknown", "no input", "bad options", ["a", "list"], None])
+        self.assertTrue(all(not error["success"] and error["error"] for error in errors))
+        # The job that was running when they came is still fine
+        self.assertEqual(self.result(), { "id": "running", "success": True })
+        self.assertEqual(self.finish(), [])
+
+    def test_duplicate_ids(self):
+        self.start_fake_server(max_jobs=1)
+        self.send(self.job("first", seconds=1))
+        self.send(self.job("queued"))
+        self.send(self.job("first"))
+        self.send(self.job("queued"))
+
+        duplicates = [self.result(), self.result()]
+        self.assertEqual([duplicate["id"] for duplicate in duplicates], ["first", "queued"])
+        self.assertTrue(all("already a job" in duplicate["error"] for duplicate in duplicates))
+        self.assertEqual(self.result(), { "id": "first", "success": True })
+        self.assertEqual(self.result(), { "id": "queued", "success": True })
+        self.assertEqual(self.finish(), [])
+
+    def test_cancel(self):
+        self.start_fake_server(max_jobs=1)
+        self.send(self.job("running", seconds=30))
+        self.send(self.job("queued", seconds=30))
+        self.send(self.job("next"))
+        started = time.time()
+        self.send({ "cancel": "queued" })
+        self.send({ "cancel": "running" })
+
+        self.assertEqual(self.result(), { "id": "queued", "success": False, "error": "Cancelled" })
+        self.assertEqual(self.result(), { "id": "running", "success": False, "error": "Cancelled" })
+        self.assertEqual(self.result(), { "id": "next", "success": True })
+        self.assertLess(time.time() - started, 5)
+        self.assertFalse(os.path.exists(self.output("running")))
+        self.assertEqual(self.finish(), [])
+
+    def test_timeout(self):
+        self.start_fake_server()
+        started = time.time()
+        self.send(self.job("slow", seconds=30, timeout=0.5))
+        self.assertEqual(self.result(), { "id": "slow", "success": False, "error": "Timed out" })
+        self.assertLess(time.time() - started, 5)
+
+    def test_stopping_a_job_does_not_hold_up_the_others(self):
+        self.start_fake_server()
+        self.send(self.job("stubborn", seconds=30, stubborn=True, timeout=0.5))
+        self.assertEqual(self.result(), { "id": "stubborn", "success": False, "error": "Timed out" })
+
+        # While the server waits for the stubborn job to give up, before killing it
+        started = time.time()
+        self.send(self.job("quick"))
+        self.assertEqual(self.result(), { "id": "quick", "success": True })
+        self.assertLess(time.time() - started, 3)
+        # Killed after the grace period, so the server can exit
+        self.assertEqual(self.finish(), [])
+
+    def test_real_conversion(self):
+        self.start_server([sys.executable, os.path.join(CONVERTER_DIR, "convert.py"), "server"])
+        self.send({ "id": 1, "conversion": "from_genbank", "input": os.path.join(RES_DIR, "sampleGenbank.gb"),
+                    "output": self.output("sampleGenbank.json"), "options": { "stats": True } })
+        self.assertEqual(self.result(timeout=60), { "id": 1, "success": True })
+        self.assertEqual(load_json(self.output("sampleGenbank.json"))["project"]["name"], "EU912544")
+        self.assertEqual(load_json(self.output("sampleGenbank.json.stats.json"))["conversion"], "from_genbank")
+        self.send({ "id": 2, "conversion": "server", "input": "a", "output": "b" })
+        self.assertIn("Unknown conversion", self.result()["error"])
+        self.assertEqual(self.finish(), [])
+
+if __name__ == "__main__":
+    unittest.main()
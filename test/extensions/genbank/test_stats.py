@@ -0,0 +1,57 @@
+import os
+import unittest
+from converter import RES_DIR, TEST_DIR, load_json, run_convert, temporary_directory
+
+# convert.py --stats: what <output>.stats.json says about conversions of known fixtures (see conversion_stats.py)
+
+MULTI_GENBANK = os.path.join(RES_DIR, "sampleMultiGenbank.gb")
+LIST_BLOCK_PROJECT = os.path.join(TEST_DIR, "listBlockProject.json")
+
+IMPORT_COUNTS = { "records": 3, "features": 18, "blocks": 23, "annotations": 0, "fillers": 5 }
+EXPORT_COUNTS = { "blocks": 10, "constructs": 2, "files": 7 }
+
+class StatsTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = temporary_directory(self)
+
+    def output(self, name):
+        return os.path.join(self.directory, name)
+
+    def convert(self, conversion, input_file, name, *arguments):
+        run_convert(conversion, input_file, self.output(name), "--stats", *arguments)
+        return load_json(self.output(name) + ".stats.json")
+
+    def assert_stats(self, stats, conversion, phases, counts, workers=None):
+        self.assertEqual(stats["conversion"], conversion)
+        self.assertEqual(sorted(stats["phases"]), sorted(phases))
+        self.assertTrue(all(seconds >= 0 for seconds in stats["phases"].values()))
+        self.assertEqual(stats["counts"], counts)
+        self.assertGreater(stats["total"], 0)
+        self.assertGreater(stats["peak_rss_mb"], 0)
+        if workers is None:
+            self.assertNotIn("pool_workers", stats)
+            self.assertNotIn("pool_peak_rss_mb", stats)
+        else:
+            self.assertEqual(stats["pool_workers"], workers)
+            self.assertGreater(stats["pool_peak_rss_mb"], 0)
+
+    def test_import(self):
+        phases = ["parse", "blocks", "hierarchy", "fillers", "json"]
+        self.assert_stats(self.convert("from_genbank", MULTI_GENBANK, "serial.json"), "from_genbank", phases,
+                          IMPORT_COUNTS)
+        self.assert_stats(self.convert("from_genbank", MULTI_GENBANK, "parallel.json", "--workers", "2"),
+                          "from_genbank", phases, IMPORT_COUNTS, workers=2)
+        self.assert_stats(self.convert("from_genbank", MULTI_GENBANK, "externalized.json", "--sequence-dir",
+                                       self.output("sequences")),
+                          "from_genbank", phases + ["sequences"], IMPORT_COUNTS)
+
+    def test_export(self):
+        self.assert_stats(self.convert("to_genbank", LIST_BLOCK_PROJECT, "serial.zip"), "to_genbank",
+                          ["load", "export"], EXPORT_COUNTS)
+        self.assert_stats(self.convert("to_genbank", LIST_BLOCK_PROJECT, "parallel.zip", "--workers", "2"),
+                          "to_genbank", ["load", "export"], EXPORT_COUNTS, workers=2)
+        self.assert_stats(self.convert("to_genbank", LIST_BLOCK_PROJECT, "count.json", "--dry-run"), "to_genbank",
+                          ["load", "count"], { "blocks": 10, "constructs": 2 })
+
+if __name__ == "__main__":
+    unittest.main()
@@ -15,7 +15,7 @@ import { promisedExec } from './lib/cp';
 
 async function installDependencies() {
   try {
-    await promisedExec('pip install --user biopython', {}, {
+    await promisedExec('pip install --user "biopython>=1.68,<1.77"', {}, {
       comment: 'Installing Biopython...',
       forceOutput: true,
     });